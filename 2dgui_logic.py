@@ -4,11 +4,22 @@ import the2dgui
 import numpy as np
 from util_2d import *
 from util_misc import *
+from analysis_worker import AnalysisWorker
+from movie_cache import MovieCache
+from files import MyPrincetonSPEFile
 import matplotlib.cm as cm
-from matplotlib.patches import Rectangle
+from mymplcanvas import image_to_rgba, mask_to_rgba
 
 class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
 
+    # contrast maps which can be shown on top of the image:
+    # layer name : ( Movie image, value shown at the bottom and top of the colormap )
+    contrast_layers = { 'M_ex':     ( 'M_ex_image',     0, 1 ), \
+                        'M_em':     ( 'M_em_image',     0, 1 ), \
+                        'phase_ex': ( 'phase_ex_image', -np.pi/2, np.pi/2 ), \
+                        'phase_em': ( 'phase_em_image', -np.pi/2, np.pi/2 ), \
+                        'ET_ruler': ( 'ET_ruler_image', 0, 1 ) }
+
     def __init__(self,parent=None,app=None):
         """
             Initialization of the class. Call the __init__ for the super classes
@@ -20,13 +31,56 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
         self.spefiles = []
         self.m = None
         self.pwd = os.path.dirname(os.path.abspath(__file__))
-        self.optical_element = 'Polarizer'
+        self.optical_element = 'L/2 Plate' if self.isLambda2PlateCheckBox.isChecked() else 'Polarizer'
         self.which_setup = self.whichSetupComboBox.currentIndex()
         self.setup_list = ['old setup','new setup','cool new setup']
         self.phase_offset = self.phaseOffsetLineEdit.text().toDouble()[0]        
         self.current_spot = None
         self.app = app
 
+        # analysis stages run in a worker thread, see run_analysis()
+        self.worker = None
+
+        # recently loaded movies, and the neighbours of the current file, see load_and_display_spe_file()
+        self.movie_cache = MovieCache()
+        # disabled while the worker runs; this includes the spot buttons, since
+        # spots added during a run would never be analysed
+        self.analysisButtons = [ self.initAnalysisPushButton, self.checkSpotValidityPushButton, \
+                                     self.cosineFitPushButton, self.findModDepthsPushButton, \
+                                     self.ETrulerPushButton, self.toolButton1, self.toolButton2, \
+                                     self.toolButton3, self.createSpotArrayPushButton, self.addSignalSpotPushButton, \
+                                     self.setBGSpotPushButton ]
+        self.progressBar = QtGui.QProgressBar()
+        self.progressBar.setVisible(False)
+        self.cancelPushButton = QtGui.QPushButton('cancel')
+        self.cancelPushButton.setVisible(False)
+        self.cancelPushButton.clicked.connect( self.cancelAnalysis )
+        self.statusbar.addPermanentWidget( self.progressBar )
+        self.statusbar.addPermanentWidget( self.cancelPushButton )
+
+        # frame scrubber below the image view; frames are read one at a time
+        # (see CameraData.get_frame()) and blitted into the image view
+        self.resize( self.width(), self.height()+30 )
+        self.framePlayPushButton = QtGui.QPushButton('play', self.centralwidget)
+        self.framePlayPushButton.setGeometry(QtCore.QRect(10, 855, 61, 25))
+        self.framePlayPushButton.setCheckable(True)
+        self.framePlayPushButton.setFocusPolicy(QtCore.Qt.NoFocus)
+        self.frameSlider = QtGui.QSlider(QtCore.Qt.Horizontal, self.centralwidget)
+        self.frameSlider.setGeometry(QtCore.QRect(80, 855, 571, 25))
+        self.frameSlider.setFocusPolicy(QtCore.Qt.NoFocus)
+        self.frameSlider.setEnabled(False)
+        self.framePlayPushButton.setEnabled(False)
+        self.frameTimer = QtCore.QTimer(self)
+        self.frameTimer.setInterval(40)
+        self.frameSlider.valueChanged.connect( self.showFrame )
+        self.framePlayPushButton.toggled.connect( self.playFrames )
+        self.frameTimer.timeout.connect( self.nextFrame )
+        # while a file is loaded in the background, see load_and_display_spe_file()
+        self.loadingFileindex = None
+        self.loadTimer = QtCore.QTimer(self)
+        self.loadTimer.setInterval(50)
+        self.loadTimer.timeout.connect( self.checkLoading )
+
     def keyPressEvent(self, event):
         if event.key()==QtCore.Qt.Key_Up:
             self.move_crosshairs('up')
@@ -36,6 +90,8 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
             self.move_crosshairs('left')
         if event.key()==QtCore.Qt.Key_Right:
             self.move_crosshairs('right')
+        if event.key()==QtCore.Qt.Key_Delete:
+            self.removeCurrentSpot()
 
     def move_crosshairs( self, direction ):
         x = self.imageview.crosshairs_x
@@ -73,15 +129,14 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
         self.current_spot = None
         if (not self.m==None) and hasattr(self.m,'spots'):
             # find the spot which covers these coordinates
-            for si,s in enumerate(self.m.spots):
-                if (s.coords[0] <= x) and (s.coords[0]+s.width > x):
-                    if (s.coords[1] <= y) and (s.coords[1]+s.height > y):
-                        self.current_spot = si
-                        x = s.coords[0]+.5*s.width
-                        y = s.coords[1]+.5*s.height
-                        print 'picked spot #%d' % si
-                        sys.stdout.flush()
-                        break
+            si = self.m.spot_at( x, y )
+            if si is not None:
+                s = self.m.spots[si]
+                self.current_spot = si
+                x = s.coords[0]+.5*s.width
+                y = s.coords[1]+.5*s.height
+                print 'picked spot #%d' % si
+                sys.stdout.flush()
         self.imageview.crosshairs_x = x
         self.imageview.crosshairs_y = y
         self.imageview.hline.set_ydata( np.array([y,y]) )
@@ -103,6 +158,7 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
         """Connect the user interface controls to the logic """
         self.selectDataDirPushButton.clicked.connect( self.selectDataDir )
         self.phaseOffsetLineEdit.editingFinished.connect( self.setPhaseOffset )
+        self.isLambda2PlateCheckBox.stateChanged.connect( self.setOpticalElement )
         self.whichSetupComboBox.activated.connect( self.setWhichSetup )
         self.selectSPEComboBox.activated.connect( self.selectSPE )
         self.setBGSpotPushButton.clicked.connect( self.setBGSpot )
@@ -123,20 +179,107 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
         self.toolButton3.clicked.connect( self.tool3 )
 
     def tool3(self):
-        self.tool2()
-        self.findModDepths()
-        time.sleep(.1)
+        self.set_angle_grids()
+        self.run_analysis( ['init','validity','fit','moddepths'], self.toolButton3 )
 
     def tool2(self):
-        self.tool1()
-        self.cosineFit()
-        time.sleep(.1)
+        self.set_angle_grids()
+        self.run_analysis( ['init','validity','fit'], self.toolButton2 )
 
     def tool1(self):
-        self.initAnalysis()
-        time.sleep(.1)
-        self.checkSpotValidity()
-        time.sleep(.1)
+        self.run_analysis( ['init','validity'], self.toolButton1 )
+
+    def run_analysis( self, stages, button ):
+        """Runs the given analysis stages (see AnalysisWorker) in a worker thread.
+        The analysis buttons are disabled until the worker is done, progress is 
+        shown in the status bar, and the display is updated as the worker 
+        reports finished stages and chunks of spots.
+        """
+        if self.m==None or (self.worker is not None and self.worker.isRunning()):
+            return
+
+        self.busyButton = button
+        self.busyButtonText = button.text()
+        button.setText('wait')
+        button.setStyleSheet('QPushButton {color: red}')
+        for b in self.analysisButtons:
+            b.setEnabled(False)
+        self.progressBar.setValue(0)
+        self.progressBar.setVisible(True)
+        self.cancelPushButton.setEnabled(True)
+        self.cancelPushButton.setVisible(True)
+
+        self.worker = AnalysisWorker( self.m, stages, SNR=self.SNRSpinBox.value(), parent=self )
+        self.worker.progress.connect( self.analysisProgress )
+        self.worker.chunkDone.connect( self.analysisChunkDone )
+        self.worker.stageDone.connect( self.analysisStageDone )
+        self.worker.done.connect( self.analysisFinished )
+        self.worker.cancelled.connect( self.analysisCancelled )
+        self.worker.failed.connect( self.analysisFailed )
+        self.worker.start()
+
+    def cancelAnalysis(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.cancelPushButton.setEnabled(False)
+
+    def stopAnalysis(self):
+        """Cancels a running analysis and waits for the worker to stop, which
+        must be done before the movie is changed or replaced."""
+        if self.worker is not None:
+            if self.worker.isRunning():
+                self.cancelAnalysis()
+                self.worker.wait()
+            # signals the worker emitted before it stopped may still be queued,
+            # drop them so that they don't update the movie replacing this one
+            for signal in [ self.worker.progress, self.worker.chunkDone, self.worker.stageDone, \
+                            self.worker.done, self.worker.cancelled, self.worker.failed ]:
+                try:
+                    signal.disconnect()
+                except TypeError:
+                    pass
+            self.worker = None
+            self.analysisFinished()
+
+    def analysisProgress( self, stage, done, total ):
+        self.progressBar.setFormat( '%s %%p%%' % stage )
+        self.progressBar.setMaximum( max(total,1) )
+        self.progressBar.setValue( done )
+
+    def analysisChunkDone( self, stage, first, last ):
+        if stage=='moddepths':
+            self.update_contrast_layers( ['M_ex','M_em','phase_ex','phase_em'] )
+        elif stage=='ETruler':
+            self.update_contrast_layers( ['ET_ruler'] )
+
+    def analysisStageDone( self, stage ):
+        if stage=='init':
+            self.initAnalysisPushButton.setChecked(False)
+        elif stage=='validity':
+            self.show_spot_validity()
+        elif stage=='moddepths':
+            self.imageview.show_stuff(what='M_ex')
+            self.showStuffComboBox.setCurrentIndex(1)
+        elif stage=='update':
+            self.update_spot_layer()
+            self.update_contrast_layers( ['M_ex','M_em','phase_ex','phase_em'] )
+            self.imageview.show_stuff( what=getattr(self.imageview, 'current_layer', 'spots') )
+
+    def analysisFinished(self):
+        self.busyButton.setText( self.busyButtonText )
+        self.busyButton.setStyleSheet('')
+        for b in self.analysisButtons:
+            b.setEnabled(True)
+        self.progressBar.setVisible(False)
+        self.cancelPushButton.setVisible(False)
+
+    def analysisCancelled(self):
+        print "Analysis cancelled."
+        self.analysisFinished()
+
+    def analysisFailed( self, message ):
+        self.analysisFinished()
+        QtGui.QMessageBox.warning( self, 'Analysis failed', message )
 
     def tryToUpdateFile( self, basefilename, what ):
         filename = basefilename+'_'+what+'_image.txt'
@@ -179,20 +322,26 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
 
 
     def ETruler(self):
-        oldtext = self.setButtonWait( self.ETrulerPushButton )
-
-        self.imageview.ET_ruler_rects = []
-        self.m.ETrulerFFT()
-        # ruler = []
-        # for s in self.m.validspots:
-        #     ruler.append(s.ET_ruler)
-        for s in self.m.validspots:
-            color = cm.jet(s.ET_ruler)
-            r = Rectangle( (s.coords[0],s.coords[1]), s.width, s.height, \
-                               facecolor=color, edgecolor=color, alpha=1, zorder=7 )
-            self.imageview.ET_ruler_rects.append( r )
-
-        self.setButtonWait( self.ETrulerPushButton, oldtext )
+        self.run_analysis( ['ETruler'], self.ETrulerPushButton )
+
+    def update_contrast_layers( self, whats ):
+        """Re-renders the overlay layers of the given contrast maps from the
+        current Movie images. This costs the same no matter how many spots
+        there are."""
+        for what in whats:
+            image, vmin, vmax = self.contrast_layers[what]
+            self.imageview.set_layer( what, image_to_rgba( getattr(self.m, image), \
+                                                               cmap=cm.jet, vmin=vmin, vmax=vmax ) )
+
+    def update_spot_layer( self ):
+        """Renders the spots layer: spots in red, valid spots (if the validity
+        has been checked) in green."""
+        coverage = self.m.spot_coverage_image==1
+        rgba = mask_to_rgba( coverage, 'red', alpha=.3 )
+        if hasattr(self.m, 'SNR_threshold'):
+            valid = coverage & (self.m.SNR_image > self.m.SNR_threshold)
+            mask_to_rgba( valid, 'green', alpha=.3, rgba=rgba )
+        self.imageview.set_layer( 'spots', rgba )
 
 
     def showStuff(self):
@@ -213,36 +362,7 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
 
 
     def findModDepths(self):
-        oldtext = self.setButtonWait( self.findModDepthsPushButton )
-
-        self.imageview.M_ex_rects = []
-        self.imageview.M_em_rects = []
-        self.imageview.phase_ex_rects = []
-        self.imageview.phase_em_rects = []
-        self.m.find_modulation_depths_and_phases()
-        for s in self.m.validspots:
-            color = cm.jet(s.M_ex)
-            r = Rectangle( (s.coords[0],s.coords[1]), s.width, s.height, \
-                               facecolor=color, edgecolor=color, alpha=1, zorder=7 )
-            self.imageview.M_ex_rects.append( r )
-            color = cm.jet(s.M_em)
-            r = Rectangle( (s.coords[0],s.coords[1]), s.width, s.height, \
-                               facecolor=color, edgecolor=color, alpha=1, zorder=7 )
-            self.imageview.M_em_rects.append( r )
-            color = cm.jet(s.phase_ex/np.pi+.5)
-            r = Rectangle( (s.coords[0],s.coords[1]), s.width, s.height, \
-                               facecolor=color, edgecolor=color, alpha=1, zorder=7 )
-            self.imageview.phase_ex_rects.append( r )
-            color = cm.jet(s.phase_em/np.pi+.5)
-            r = Rectangle( (s.coords[0],s.coords[1]), s.width, s.height, \
-                               facecolor=color, edgecolor=color, alpha=1, zorder=7 )
-            self.imageview.phase_em_rects.append( r )
-#            self.imageview.axes.add_patch( self.imageview.spot_rects[-1] )
-#        self.imageview.show_stuff( what='M_ex' )
-        self.imageview.show_stuff(what='M_ex')
-        self.showStuffComboBox.setCurrentIndex(1)
-
-        self.unsetButtonWait( self.findModDepthsPushButton, oldtext)
+        self.run_analysis( ['moddepths'], self.findModDepthsPushButton )
 
     def setButtonWait( self, button ):
         oldtext = button.text()
@@ -256,42 +376,29 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
         button.setStyleSheet('')
         self.app.processEvents()
         
-    def cosineFit(self):
-        oldtext = self.setButtonWait( self.cosineFitPushButton )
+    def set_angle_grids(self):
         self.m.excitation_angles_grid = np.linspace( 0, np.pi, self.NanglesSpinBox.value() )
         self.m.emission_angles_grid = np.linspace( 0, np.pi, self.NanglesSpinBox.value() )
-        self.m.fit_all_portraits_spot_parallel()
-        self.unsetButtonWait( self.cosineFitPushButton, oldtext )
+
+    def cosineFit(self):
+        if self.m==None:
+            return
+        self.set_angle_grids()
+        self.run_analysis( ['fit'], self.cosineFitPushButton )
 
     def checkSpotValidity(self):
-        oldtext = self.setButtonWait( self.checkSpotValidityPushButton )
-
-        self.m.are_spots_valid( SNR=self.SNRSpinBox.value() )
-        # reset color back to red 
-        for r in self.imageview.spot_rects:
-            r.set_facecolor('red')
-        # turn valid spots back on green
-        for vsi in self.m.validspotindices:
-            self.imageview.spot_rects[vsi].set_facecolor('green')
-            self.imageview.spot_rects[vsi].set_edgecolor('green')
-#        self.imageview.figure.canvas.draw()
-        self.imageview.show_stuff(what='spots')
+        self.run_analysis( ['validity'], self.checkSpotValidityPushButton )
 
-        self.unsetButtonWait( self.checkSpotValidityPushButton, oldtext )
+    def show_spot_validity(self):
+        self.update_spot_layer()
+        self.imageview.show_stuff(what='spots')
 
 
     def initAnalysis(self):
-        oldtext = self.setButtonWait( self.initAnalysisPushButton )
-        self.m.collect_data()
-        self.m.startstop()
-        self.m.assign_portrait_data()
-        self.initAnalysisPushButton.setChecked(False)
-        self.unsetButtonWait( self.initAnalysisPushButton, oldtext )
+        self.run_analysis( ['init'], self.initAnalysisPushButton )
 
 
     def createSpotArray(self):
-        oldtext = self.setButtonWait( self.createSpotArrayPushButton )
-
         res = self.spotEdgeLengthSpinBox.value()
         coords = np.round( np.array( [self.imageview.x0, self.imageview.y0, \
                                           self.imageview.x1, self.imageview.y1] ) ).astype(np.int)
@@ -306,13 +413,8 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
 
         # now add spots
         grid_image_section_into_squares_and_define_spots( self.m, res, coords )
-
-        # now populate that list
-        for s in self.m.spots[nspotsbefore:]:
-            r = Rectangle( (s.coords[0],s.coords[1]), s.width, s.height, \
-                               facecolor='red', edgecolor='red', alpha=.3, zorder=7 )
-            self.imageview.spot_rects.append( r )
-            self.imageview.axes.add_patch( self.imageview.spot_rects[-1] )
+        self.update_spot_layer()
+        self.update_analysis( self.createSpotArrayPushButton )
 
         # reset selection rectangle
         self.imageview.rect.set_xy((0,0))
@@ -322,8 +424,6 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
         self.imageview.figure.canvas.draw()
         self.imageview.show_stuff()
 
-        self.unsetButtonWait( self.createSpotArrayPushButton, oldtext )
-
     def setBGSpot(self):
         coords = np.round( np.array( [self.imageview.x0, self.imageview.y0, \
                                           self.imageview.x1, self.imageview.y1] ) ).astype(np.int)
@@ -354,27 +454,41 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
         if coords[1]>coords[3]:
             coords[1],coords[3]=coords[3],coords[1]
 
-        r = Rectangle( (coords[0],coords[1]), coords[2]-coords[0], \
-                           coords[3]-coords[1], facecolor='green', edgecolor='green', alpha=.3, zorder=8 )
-        self.imageview.spot_rects.append( r )
-        self.imageview.axes.add_patch( self.imageview.spot_rects[-1] )
+        self.m.define_spot( coords, intensity_type='mean' )
+        self.update_spot_layer()
 
         # reset selection rectangle
         self.imageview.rect.set_xy((0,0))
         self.imageview.rect.set_width(0)
         self.imageview.rect.set_height(0)
         # update canvas
-        self.imageview.figure.canvas.draw()
-        self.m.define_spot( coords, intensity_type='mean' )
+        self.imageview.show_stuff(what='spots')
+        self.showStuffComboBox.setCurrentIndex(0)
+        self.update_analysis( self.addSignalSpotPushButton )
+
+
+    def update_analysis( self, button ):
+        """If the movie has been analysed already, analyses the spots which
+        have been added since, and only those (see Movie.update_analysis())."""
+        if hasattr(self.m, 'portrait_indices') and hasattr(self.m, 'validspots'):
+            self.run_analysis( ['update'], button )
+
+
+    def removeCurrentSpot(self):
+        if self.current_spot==None or (self.worker is not None and self.worker.isRunning()):
+            return
+        self.m.remove_spot( self.current_spot )
+        self.current_spot = None
+        self.update_spot_layer()
+        self.update_contrast_layers( ['M_ex','M_em','phase_ex','phase_em'] )
+        self.imageview.show_stuff( what=getattr(self.imageview, 'current_layer', 'spots') )
 
 
     def clearAllSpots(self):
-        for r in self.imageview.spot_rects:
-            r.remove()
-        self.imageview.spot_rects = []
-        self.m.spots = []
-        self.m.initContrastImages()
-        self.imageview.figure.canvas.draw()
+        self.stopAnalysis()
+        self.m.clear_spots()
+        self.current_spot = None
+        self.imageview.clear_layers()
 
 
     def dataview_updater(self):
@@ -439,11 +553,8 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
 
     def spotInfo_updater(self):
         # is this a valid spot?
-        isvalid = False
         s = self.m.spots[self.current_spot]
-        if hasattr(self.m, 'validspotindices'):
-            if self.m.validspotindices.count( self.current_spot )>0:
-                isvalid = True
+        isvalid = self.m.is_spot_valid( self.current_spot )
 
         # prepare info
         infostring  = "area=( %d--%d, %d--%d )<br>" % (s.coords[0],s.coords[0]+s.width, \
@@ -474,6 +585,30 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
         self.spotInfoTextBrowser.setHtml(infostring)
 
 
+    def showFrame( self, frameindex ):
+        if self.m==None:
+            return
+        frame = self.m.camera_data.get_frame( frameindex )
+        text = 'frame %d' % frameindex
+        if hasattr(self.m, 'emangles'):
+            if self.m.emangles[frameindex]==-1:
+                text += '   (shutter closed)'
+            else:
+                text += '   ex=%.1f deg   em=%.1f deg' % (self.m.exangles[frameindex]*180/np.pi, \
+                                                             self.m.emangles[frameindex]*180/np.pi)
+        self.imageview.show_frame( frame, text )
+
+    def playFrames( self, play ):
+        if play:
+            self.framePlayPushButton.setText('stop')
+            self.frameTimer.start()
+        else:
+            self.framePlayPushButton.setText('play')
+            self.frameTimer.stop()
+
+    def nextFrame(self):
+        self.frameSlider.setValue( (self.frameSlider.value()+1) % (self.frameSlider.maximum()+1) )
+
     def selectSPE(self):
         print self.selectSPEComboBox.currentIndex()
         self.load_and_display_spe_file(fileindex=self.selectSPEComboBox.currentIndex())
@@ -483,8 +618,50 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
         self.which_setup = self.whichSetupComboBox.currentIndex()        
 
     def setPhaseOffset(self):
-        self.phaseOffset = self.phaseOffsetLineEdit.text().toDouble()[0]
-        print "Phase offset set to %f [deg]" % self.phaseOffset
+        old_kwargs = self.movie_kwargs()
+        phase_offset = self.phaseOffsetLineEdit.text().toDouble()[0]
+        if phase_offset==self.phase_offset:
+            return
+        self.phase_offset = phase_offset
+        print "Phase offset set to %f [deg]" % self.phase_offset
+        if self.m==None:
+            return
+        self.stopAnalysis()
+        self.m.set_phase_offset( self.movie_kwargs()['phase_offset_excitation'] )
+        self.update_movie_parameters( old_kwargs )
+
+    def setOpticalElement(self):
+        old_kwargs = self.movie_kwargs()
+        optical_element = 'L/2 Plate' if self.isLambda2PlateCheckBox.isChecked() else 'Polarizer'
+        if optical_element==self.optical_element:
+            return
+        self.optical_element = optical_element
+        print "Optical element set to %s" % self.optical_element
+        if self.m==None:
+            return
+        self.stopAnalysis()
+        self.m.set_optical_element( self.optical_element )
+        self.update_movie_parameters( old_kwargs )
+
+    def showOpticalElement(self):
+        """Where the motor data of the movie says which optical element there 
+        was (cool new setup, archives), the checkbox shows it and can't be 
+        changed; otherwise it shows the element chosen."""
+        motor = self.m.excitation_motor_object()
+        from_file = getattr( motor, 'optical_element_in_file', False )
+        optical_element = motor.optical_element if from_file else self.optical_element
+        self.isLambda2PlateCheckBox.blockSignals(True)
+        self.isLambda2PlateCheckBox.setChecked( optical_element=='L/2 Plate' )
+        self.isLambda2PlateCheckBox.blockSignals(False)
+        self.isLambda2PlateCheckBox.setEnabled( not from_file )
+
+    def update_movie_parameters(self, old_kwargs):
+        """After the phase offset or the optical element of the movie on display 
+        have been changed (see Movie.set_phase_offset()), files it in the movie
+        cache under the new settings, and shows the results anew."""
+        self.movie_cache.rekey( *self.movie_files(self.fileindex), old_kwargs=old_kwargs, new_kwargs=self.movie_kwargs() )
+        self.update_contrast_layers( ['M_ex','M_em','phase_ex','phase_em'] )
+        self.imageview.show_stuff( what=getattr(self.imageview, 'current_layer', 'spots') )
 
     def selectDataDir(self):
         fname = QtGui.QFileDialog.getExistingDirectory(self, 'Show me where the data is', \
@@ -539,19 +716,81 @@ class the2dlogic(QtGui.QMainWindow,the2dgui.Ui_MainWindow):
         if not len(self.spefiles)==0:
             self.load_and_display_spe_file(0)
 
+    def movie_files(self,fileindex):
+        return ( self.data_directory+"/"+self.spefiles[fileindex], \
+                     self.data_directory+"/"+self.motorfiles[fileindex] )
+
+    def movie_kwargs(self):
+        return dict( phase_offset_excitation=self.phase_offset*np.pi/180.0, \
+                         use_new_fitter=True, \
+                         which_setup=self.setup_list[self.which_setup], \
+                         excitation_optical_element=self.optical_element )
+
     def load_and_display_spe_file(self,fileindex=0):
-        del(self.m)
+        """Shows the movie of file #fileindex. If it isn't cached yet, a preview 
+        (see MyPrincetonSPEFile.getPreview) is shown right away, and the movie is
+        loaded in the background; checkLoading() finishes up once it's there."""
+        self.stopAnalysis()
+        self.m = None
+        self.loadTimer.stop()
+        self.framePlayPushButton.setChecked(False)
+        self.frameSlider.setEnabled(False)
+        self.framePlayPushButton.setEnabled(False)
         # from guppy import hpy; h=hpy()
         # w=h.heap()
         # print w
         print "loading file %s ... " % (self.spefiles[fileindex]),
         sys.stdout.flush()        
-        self.m = Movie( self.data_directory+"/"+self.spefiles[fileindex], \
-                            self.data_directory+"/"+self.motorfiles[fileindex], \
-                            phase_offset_excitation=self.phase_offset*np.pi/180.0, \
-                            use_new_fitter=True, \
-                            which_setup=self.setup_list[self.which_setup], \
-                            excitation_optical_element=self.optical_element)
+
+        if self.movie_cache.is_cached( *self.movie_files(fileindex), **self.movie_kwargs() ):
+            self.show_loaded_movie( fileindex )
+            return
+
+        spe = MyPrincetonSPEFile( self.movie_files(fileindex)[0] )
+        frameindices, average, trace = spe.getPreview()
+        spe.close_file()
+        self.imageview.show_image( average, zorder=1, cmap=cm.gray )
+        self.dataview.clear()
+        self.dataview.axes.plot( frameindices, trace, 'bx-' )
+        self.dataview.figure.canvas.draw()
+        self.statusbar.showMessage( 'preview of %s (average of %d frames), loading...' % \
+                                        (self.spefiles[fileindex], frameindices.size) )
+
+        self.movie_cache.prefetch( *self.movie_files(fileindex), **self.movie_kwargs() )
+        self.loadingFileindex = fileindex
+        self.loadTimer.start()
+
+    def checkLoading(self):
+        fileindex = self.loadingFileindex
+        if fileindex is None:
+            self.loadTimer.stop()
+            return
+        if self.movie_cache.is_cached( *self.movie_files(fileindex), **self.movie_kwargs() ) \
+                or not self.movie_cache.is_loading( *self.movie_files(fileindex), **self.movie_kwargs() ):
+            # loaded, or failed, in which case get() tries again and says why
+            self.loadTimer.stop()
+            self.loadingFileindex = None
+            self.statusbar.clearMessage()
+            self.show_loaded_movie( fileindex )
+
+    def show_loaded_movie(self,fileindex):
+        self.m = self.movie_cache.get( *self.movie_files(fileindex), **self.movie_kwargs() )
+        self.fileindex = fileindex
+        # the movie may have been used before
+        self.m.reset()
+        self.showOpticalElement()
+
+        # have the files next to this one ready by the time the user gets there
+        for i in [fileindex+1, fileindex-1]:
+            if 0 <= i < len(self.spefiles):
+                self.movie_cache.prefetch( *self.movie_files(i), **self.movie_kwargs() )
+
+        self.frameSlider.blockSignals(True)
+        self.frameSlider.setRange( 0, self.m.camera_data.Nframes-1 )
+        self.frameSlider.setValue( self.m.camera_data.frameindices[0] )
+        self.frameSlider.blockSignals(False)
+        self.frameSlider.setEnabled(True)
+        self.framePlayPushButton.setEnabled(True)
 
         self.imageview.show_image( self.m.camera_data.rawdata[0,:,:], zorder=1, cmap=cm.gray )
 #        self.imageview.axes.imshow( 
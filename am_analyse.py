@@ -23,7 +23,8 @@ sig_coords = [sig_c_1, sig_c_2, sig_c_3, sig_c_4]
 m = Movie( spefilename, motorfilename, \
         phase_offset_excitation=global_phase*np.pi/180.0, \
         use_new_fitter=True, \
-        which_setup='cool new setup' )
+        which_setup='cool new setup', \
+        skip_invalid_frames=True )
 
 m.define_background_spot( bg_coords )
 m.define_spot( sig_coords )
@@ -21,6 +21,8 @@ import numpy as np
 #from pyspec.ccd.files import PrincetonSPEFile
 
 from util_2d import *
+from movie_cache import MovieCache
+from files import MyPrincetonSPEFile
 import spot_picker
 
 class MyStaticMplCanvas(FigureCanvas):
@@ -28,8 +30,8 @@ class MyStaticMplCanvas(FigureCanvas):
     def __init__(self, parent=None, width=5, height=4, dpi=100):
         self.fig = Figure(figsize=(width, height), dpi=dpi)
         self.axes = self.fig.add_subplot(111)
-        i = self.axes.imshow(np.outer( np.linspace(0,1,10),np.linspace(0,2,10) ), zorder=1 )
-        self.cbar = self.fig.colorbar(i)
+        self.image = self.axes.imshow(np.outer( np.linspace(0,1,10),np.linspace(0,2,10) ), zorder=1 )
+        self.cbar = self.fig.colorbar(self.image)
         # We want the axes cleared every time plot() is called
 #        self.axes.hold(False)
 
@@ -60,6 +62,15 @@ class MyStaticMplCanvas(FigureCanvas):
         self.fig.clear()
 #        self.axes = self.fig.add_subplot(111)
 
+    def show_image(self,image):
+        """Shows image (in gray) in place of the one shown before; the image 
+        artist is reused, so that browsing through files doesn't pile them up."""
+        self.image.set_data( image )
+        self.image.set_cmap( cmap.gray )
+        self.image.set_clim( np.min(image), np.max(image) )
+        self.image.set_extent( (-.5, image.shape[1]-.5, image.shape[0]-.5, -.5) )
+        self.draw()
+
     def show_portrait(self,portrait):
         self.fig.clear()
         self.axes = self.fig.add_subplot(111)
@@ -99,6 +110,13 @@ class ApplicationWindow(QtGui.QMainWindow):
 
         self.spefiles = []
         self.m = None
+        # recently loaded movies, and the neighbours of the current file
+        self.movie_cache = MovieCache()
+        # while a file is loaded in the background, see load_and_display_spe_file()
+        self.loadingFileindex = None
+        self.loadTimer = QtCore.QTimer()
+        self.loadTimer.setInterval(50)
+        self.loadTimer.timeout.connect( self.checkLoading )
         self.pwd = os.path.dirname(os.path.abspath(__file__))
         self.optical_element = 'Polarizer'
 
@@ -183,9 +201,9 @@ class ApplicationWindow(QtGui.QMainWindow):
 
     def optical_element_change(self):
         if self.lambdaOver2Checkbox.isChecked():
-            self.optical_element = 'l/2'
+            self.optical_element = 'L/2 Plate'
         else:
-            self.optical_element = 'polarizer'
+            self.optical_element = 'Polarizer'
 
     def runAnalysis(self,fileindex=None):
         if fileindex==None or fileindex==False:
@@ -253,8 +271,15 @@ class ApplicationWindow(QtGui.QMainWindow):
         self.sc.figure.canvas.draw()                       
 
     def update_global_phase(self):
+        if self.m is not None:
+            old_kwargs = self.movie_kwargs()
         self.global_phase = self.globalPhaseOffsetEdit.text().toDouble()[0]
         print "Global phase offset set to %f [deg]" % self.globalPhaseOffsetEdit.text().toDouble()[0]
+        # the movie on display needn't be loaded again for that, see Movie.set_phase_offset()
+        if self.m is not None:
+            self.m.set_phase_offset( self.global_phase*np.pi/180.0 )
+            self.movie_cache.rekey( *self.movie_files(self.fileindex), old_kwargs=old_kwargs, \
+                                         new_kwargs=self.movie_kwargs() )
 #            self.sc.update_figure(self.data)
 
     def update_file_change(self):
@@ -313,21 +338,67 @@ class ApplicationWindow(QtGui.QMainWindow):
         if not len(self.spefiles)==0:
             self.load_and_display_spe_file(0)
 
+    def movie_files(self,fileindex):
+        return ( self.data_directory+"/"+self.spefiles[fileindex], \
+                     self.data_directory+"/"+self.motorfiles[fileindex] )
+
+    def movie_kwargs(self):
+        return dict( phase_offset_excitation=self.global_phase*np.pi/180.0, \
+                         use_new_fitter=True, \
+                         which_setup='cool new setup', \
+                         excitation_optical_element=self.optical_element )
+
     def load_and_display_spe_file(self,fileindex=0):
-        del(self.m)
+        """Shows the movie of file #fileindex. If it isn't cached yet, a preview 
+        (see MyPrincetonSPEFile.getPreview) is shown right away, and the movie is
+        loaded in the background; checkLoading() finishes up once it's there."""
+        self.m = None
+        self.loadTimer.stop()
         # from guppy import hpy; h=hpy()
         # w=h.heap()
         # print w
-        print "loading file %s ... " % (self.spefiles[0]),
+        print "loading file %s ... " % (self.spefiles[fileindex]),
         sys.stdout.flush()
-        self.m = Movie( self.data_directory+"/"+self.spefiles[fileindex], \
-                            self.data_directory+"/"+self.motorfiles[fileindex], \
-                            phase_offset_excitation=self.global_phase*np.pi/180.0, \
-                            use_new_fitter=True, \
-                            which_setup='cool new setup', \
-                            excitation_optical_element=self.optical_element)
-        self.sc.axes.imshow( self.m.camera_data.rawdata[0,:,:], zorder=1, cmap=cmap.gray )
-        self.sc.draw()
+
+        if self.movie_cache.is_cached( *self.movie_files(fileindex), **self.movie_kwargs() ):
+            self.show_loaded_movie( fileindex )
+            return
+
+        spe = MyPrincetonSPEFile( self.movie_files(fileindex)[0] )
+        frameindices, average, trace = spe.getPreview()
+        spe.close_file()
+        self.sc.show_image( average )
+        self.statusBar().showMessage( 'preview (average of %d frames), loading...' % frameindices.size )
+
+        self.movie_cache.prefetch( *self.movie_files(fileindex), **self.movie_kwargs() )
+        self.loadingFileindex = fileindex
+        self.loadTimer.start()
+
+    def checkLoading(self):
+        fileindex = self.loadingFileindex
+        if fileindex is None:
+            self.loadTimer.stop()
+            return
+        if self.movie_cache.is_cached( *self.movie_files(fileindex), **self.movie_kwargs() ) \
+                or not self.movie_cache.is_loading( *self.movie_files(fileindex), **self.movie_kwargs() ):
+            # loaded, or failed, in which case get() tries again and says why
+            self.loadTimer.stop()
+            self.loadingFileindex = None
+            self.statusBar().clearMessage()
+            self.show_loaded_movie( fileindex )
+
+    def show_loaded_movie(self,fileindex):
+        self.m = self.movie_cache.get( *self.movie_files(fileindex), **self.movie_kwargs() )
+        self.fileindex = fileindex
+        # the movie may have been used before
+        self.m.reset()
+
+        # have the files next to this one ready by the time the user gets there
+        for i in [fileindex+1, fileindex-1]:
+            if 0 <= i < len(self.spefiles):
+                self.movie_cache.prefetch( *self.movie_files(i), **self.movie_kwargs() )
+
+        self.sc.show_image( self.m.camera_data.rawdata[0,:,:] )
         print "done"
 
 
@@ -2,6 +2,7 @@ import sys
 from util_2d import *
 from util_misc import grid_image_section_into_squares_and_define_spots, show_spot_data, save_spot_data, update_image_files
 import time as stopwatch
+from profiler import Profiler
 
 from mpi4py import MPI
 comm = MPI.COMM_WORLD
@@ -40,7 +41,8 @@ tstart = stopwatch.time()
 # m = Movie( prefix+"olle_single_layer_x40_488_OD2.SPE", prefix+"MS-olle_single_layer_x40_488_OD2.txt", \
 #                phase_offset_excitation=global_phase, which_setup='cool new setup' )
 m = Movie( prefix+"olle_single_layer_x40_488_OD2.SPE", prefix+"MS-olle_single_layer_x40_488_OD2.txt", \
-               phase_offset_excitation=global_phase, which_setup='cool new setup' )
+               phase_offset_excitation=global_phase, which_setup='cool new setup', \
+               skip_invalid_frames=True, profiler=Profiler(), verbosity=0 )
 
 #m.define_background_spot( [260,200,340,260] )
 #m.define_background_spot( [100,100,300,150] )
@@ -78,6 +80,8 @@ else:
 #     print "si=%d\tLS=%f\tM_ex=%f\tM_em=%f" % (si, s.LS, s.M_ex, s.M_em)
 
 print 'p=',myrank,': done. ',(stopwatch.time()-tstart)
+m.profiler.report()
+m.profiler.dump( prefix+'profile_%d.json' % myrank )
 
 #raise SystemExit
 
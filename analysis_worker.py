@@ -0,0 +1,121 @@
+from PyQt4 import QtCore
+import sys, traceback
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+class AnalysisWorker(QtCore.QThread):
+    """Runs stages of the Movie analysis pipeline in a thread of its own, so
+    that the GUI stays responsive.
+
+    The stages to run are given as a list of names, and are run in order:
+      'init'        collect_data(), startstop(), assign_portrait_data()
+      'validity'    are_spots_valid( SNR )
+      'fit'         fit_all_portraits_spot_parallel()
+      'moddepths'   find_modulation_depths_and_phases()
+      'ETruler'     ETrulerFFT()
+      'update'      update_analysis(), for spots added since the last analysis
+    except that 'validity' goes before 'init' if both are asked for, so that
+    only the valid spots are made into portraits.
+    The last three work on chunks of movie.validspots, one chunk after the
+    other. After each chunk, chunkDone is emitted with the stage name and the
+    range [first,last) of valid spot indices which have been done, so that the
+    GUI can update the display while the rest is still being worked on.
+
+    The movie object must not be touched by the GUI while the worker runs
+    (reading results of finished chunks is fine).
+
+    Cancellation is cooperative: cancel() asks the worker to stop, which
+    it does after the current step (i.e. chunk) is done. Results of the
+    chunks done so far are kept.
+    """
+
+    # stage name, steps done, steps total
+    progress  = QtCore.pyqtSignal(str, int, int)
+    # stage name, first and last (exclusive) valid spot index of the chunk
+    chunkDone = QtCore.pyqtSignal(str, int, int)
+    # stage name
+    stageDone = QtCore.pyqtSignal(str)
+    # emitted once all stages are done
+    done      = QtCore.pyqtSignal()
+    cancelled = QtCore.pyqtSignal()
+    # error message
+    failed    = QtCore.pyqtSignal(str)
+
+    chunked_stages = { 'fit':       'fit_all_portraits_spot_parallel', \
+                       'moddepths': 'find_modulation_depths_and_phases', \
+                       'ETruler':   'ETrulerFFT' }
+
+    def __init__( self, movie, stages, SNR=10, chunksize=200, parent=None ):
+        super(AnalysisWorker,self).__init__(parent)
+        self.movie     = movie
+        self.stages    = list(stages)
+        # validity only needs the spots' mean intensities, see Movie.are_spots_valid()
+        if 'init' in self.stages and 'validity' in self.stages:
+            self.stages.remove( 'validity' )
+            self.stages.insert( self.stages.index('init'), 'validity' )
+        self.validity_done = False
+        self.SNR       = SNR
+        self.chunksize = chunksize
+        self._cancel_requested = False
+
+    def cancel( self ):
+        self._cancel_requested = True
+
+    def check_cancel( self ):
+        if self._cancel_requested:
+            raise AnalysisCancelled()
+
+    def run( self ):
+        try:
+            for stage in self.stages:
+                self.check_cancel()
+                self.run_stage( stage )
+                self.stageDone.emit( stage )
+        except AnalysisCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            traceback.print_exc()
+            sys.stdout.flush()
+            self.failed.emit( "%s: %s" % (type(e).__name__, str(e)) )
+        else:
+            self.done.emit()
+
+    def run_stage( self, stage ):
+        m = self.movie
+        if stage=='init':
+            spots = m.validspots if self.validity_done else None
+            steps = [ lambda: m.collect_data( spots=spots ), m.startstop, m.assign_portrait_data ]
+            for i,step in enumerate(steps):
+                self.progress.emit( stage, i, len(steps) )
+                step()
+                self.check_cancel()
+            self.progress.emit( stage, len(steps), len(steps) )
+
+        elif stage=='validity':
+            self.progress.emit( stage, 0, 1 )
+            m.are_spots_valid( SNR=self.SNR )
+            self.validity_done = True
+            self.progress.emit( stage, 1, 1 )
+
+        elif stage=='update':
+            # new spots are checked against the threshold the others were checked against
+            self.progress.emit( stage, 0, 1 )
+            m.update_analysis( SNR=getattr(m, 'SNR_threshold', self.SNR) )
+            self.progress.emit( stage, 1, 1 )
+
+        elif stage in self.chunked_stages:
+            method = getattr( m, self.chunked_stages[stage] )
+            Nspots = len(m.validspots)
+            self.progress.emit( stage, 0, Nspots )
+            for first in range(0, Nspots, self.chunksize):
+                last = min( first+self.chunksize, Nspots )
+                method( spots=m.validspots[first:last] )
+                self.chunkDone.emit( stage, first, last )
+                self.progress.emit( stage, last, Nspots )
+                self.check_cancel()
+
+        else:
+            raise ValueError("Unknown analysis stage: %s" % stage)
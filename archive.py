@@ -0,0 +1,200 @@
+import os, json
+import numpy as np
+from files import MyPrincetonSPEFile
+from motors import canonical_optical_element
+
+
+FORMAT_VERSION = 1
+
+
+def is_archive( filename ):
+    """True if filename is a directory written by convert()."""
+    return filename is not None and os.path.isfile( os.path.join(filename, 'meta.json') )
+
+
+class PolimArchive:
+    """Reads a movie archive as written by convert(). An archive is a directory:
+
+        meta.json         size, data type, exposure time, chunking, and where it came from
+        frames_NNNNN.npy  chunks of chunk_frames raw frames each (frames_NNNNN.npz if compressed)
+        motors.npz        per frame: time stamps, excitation and emission angles (-1: shutter
+                          closed) for phase offset 0, validity; the portrait indices
+        stats.npz         per frame mean, min and max; average image (all raw counts)
+
+    Uncompressed chunks are read through memory maps, so reading a few frames, or
+    a small tile of the image (see read_frames()), only touches that part of the
+    files. Compressed chunks have to be decompressed as a whole; the last one read
+    is kept.
+    """
+
+    def __init__( self, dirname ):
+        self.dirname = dirname
+        fhandle = open( os.path.join(dirname, 'meta.json'), 'rt' )
+        self.meta = json.load( fhandle )
+        fhandle.close()
+        if self.meta['version'] > FORMAT_VERSION:
+            raise ValueError("Archive %s has format version %d, can only read up to %d" \
+                                 % (dirname, self.meta['version'], FORMAT_VERSION))
+        self.shape        = tuple( self.meta['shape'] )
+        self.dtype        = np.dtype( self.meta['dtype'] )
+        self.exposure     = self.meta['exposure']
+        self.chunk_frames = self.meta['chunk_frames']
+        self.compressed   = self.meta['compressed']
+        self.cached_chunk = (None, None)
+
+    def chunk_filename( self, chunkindex ):
+        return os.path.join( self.dirname, 'frames_%05d.%s' % (chunkindex, 'npz' if self.compressed else 'npy') )
+
+    def read_chunk( self, chunkindex ):
+        if self.cached_chunk[0]==chunkindex:
+            return self.cached_chunk[1]
+        if self.compressed:
+            npz    = np.load( self.chunk_filename(chunkindex) )
+            frames = npz['frames']
+            npz.close()
+        else:
+            frames = np.load( self.chunk_filename(chunkindex), mmap_mode='r' )
+        self.cached_chunk = (chunkindex, frames)
+        return frames
+
+    def read_frames( self, frameindices=None, tile=None ):
+        """Returns the frames listed in frameindices (default: all), in raw counts.
+        If a tile [ymin,ymax,xmin,xmax] is given (python ranges), only that part
+        of the frames is returned."""
+        if frameindices is None:
+            frameindices = np.arange( self.shape[0] )
+        frameindices = np.asarray( frameindices )
+        if tile is None:
+            tile = [0, self.shape[1], 0, self.shape[2]]
+        ys, xs = slice(tile[0], tile[1]), slice(tile[2], tile[3])
+
+        result = np.empty( (frameindices.size, tile[1]-tile[0], tile[3]-tile[2]), dtype=self.dtype )
+        chunkindices = frameindices // self.chunk_frames
+        for ci in np.unique( chunkindices ):
+            where  = np.nonzero( chunkindices==ci )[0]
+            frames = self.read_chunk( ci )
+            result[where] = frames[ frameindices[where]-ci*self.chunk_frames, ys, xs ]
+        return result
+
+    def motor_data( self ):
+        """Returns the contents of motors.npz as a dict."""
+        npz  = np.load( os.path.join(self.dirname, 'motors.npz') )
+        data = dict( [(k, npz[k]) for k in npz.files] )
+        npz.close()
+        return data
+
+    def frame_statistics( self ):
+        """Returns the contents of stats.npz as a dict."""
+        npz  = np.load( os.path.join(self.dirname, 'stats.npz') )
+        data = dict( [(k, npz[k]) for k in npz.files] )
+        npz.close()
+        return data
+
+
+class ArchiveMotors:
+    """Motor data from an archive, for Movie; takes the place of BothMotors etc.
+    The angles in the archive are for phase offset 0, the offset is added here,
+    the same way the motor classes do it for the setup the archive came from.
+    The optical element is the one the archive was made for."""
+
+    optical_element_in_file = True
+
+    def __init__( self, dirname, phase_offset=0 ):
+        archive = PolimArchive( dirname )
+        data = archive.motor_data()
+        self.filename = dirname
+        self.which_setup  = archive.meta['which_setup']
+        self.optical_element = canonical_optical_element( archive.meta['optical_element'] )
+        self.timestamps = data['timestamps']
+        self.emission_angles   = data['emission_angles']
+        self.excitation_angles_without_offset = data['excitation_angles']
+        self.set_phase_offset( phase_offset )
+
+    def set_phase_offset( self, phase_offset ):
+        self.phase_offset = phase_offset
+        self.excitation_angles = self.excitation_angles_without_offset + phase_offset
+        if not self.which_setup=='cool new setup':
+            # the other setups keep angles within [0,pi), and mark closed shutters
+            valid = self.excitation_angles_without_offset != -1
+            self.excitation_angles[valid] = np.mod( self.excitation_angles[valid], np.pi )
+            self.excitation_angles[~valid] = -1
+
+    def set_optical_element( self, optical_element ):
+        if not canonical_optical_element( optical_element )==self.optical_element:
+            raise ValueError("%s holds the angles for optical element '%s', convert the SPE file again for '%s'" \
+                                 % (self.filename, self.optical_element, optical_element))
+
+
+def convert( spe_filename, motor_filename, dirname, which_setup='cool new setup', \
+                 excitation_optical_element='Polarizer', chunk_frames=64, compress=False ):
+    """Writes the SPE file and its motor file(s) as an archive in directory dirname
+    (see PolimArchive). The motor file is parsed here once, and the angles for
+    phase offset 0 are stored for every frame. motor_filename may be a tuple of
+    excitation and emission motor files for the old setup."""
+    from util_2d import Movie
+
+    if os.path.exists( dirname ):
+        raise IOError("%s exists already, won't overwrite it" % dirname)
+
+    if isinstance( motor_filename, tuple ):
+        ex_motor_filename, em_motor_filename = motor_filename
+    else:
+        ex_motor_filename, em_motor_filename = motor_filename, None
+    # this reads only the SPE header and the motor data
+    m = Movie( spe_filename, ex_motor_filename, em_motor_filename, phase_offset_excitation=0, \
+                   which_setup=which_setup, excitation_optical_element=excitation_optical_element, \
+                   load_data=False, verbosity=0 )
+    try:
+        m.startstop()
+        portrait_indices = m.portrait_indices
+    except ValueError as e:
+        print "%s: %s (archiving it anyway, without portraits)" % (spe_filename, str(e))
+        portrait_indices = np.zeros( (0,2), dtype=np.int )
+
+    spe = MyPrincetonSPEFile( spe_filename )
+    frames_map = spe.getMemmap()
+    Nframes = frames_map.shape[0]
+
+    os.makedirs( dirname )
+    frame_mean = np.zeros( (Nframes,) )
+    frame_min  = np.zeros( (Nframes,) )
+    frame_max  = np.zeros( (Nframes,) )
+    image_sum  = np.zeros( frames_map.shape[1:] )
+    for ci,first in enumerate( range(0, Nframes, chunk_frames) ):
+        frames = np.array( frames_map[first:first+chunk_frames] )
+        flat   = frames.reshape( (frames.shape[0],-1) )
+        frame_mean[first:first+chunk_frames] = np.mean( flat, axis=1 )
+        frame_min[first:first+chunk_frames]  = np.min( flat, axis=1 )
+        frame_max[first:first+chunk_frames]  = np.max( flat, axis=1 )
+        image_sum += np.sum( frames, axis=0, dtype=np.float64 )
+        if compress:
+            np.savez_compressed( os.path.join(dirname, 'frames_%05d.npz' % ci), frames=frames )
+        else:
+            np.save( os.path.join(dirname, 'frames_%05d.npy' % ci), frames )
+    del(frames_map)
+    spe.close_file()
+
+    np.savez( os.path.join(dirname, 'motors.npz'), \
+                  timestamps=m.timeaxis, \
+                  excitation_angles=m.exangles, \
+                  emission_angles=m.emangles, \
+                  validframes=m.emangles != -1, \
+                  portrait_indices=portrait_indices )
+    np.savez( os.path.join(dirname, 'stats.npz'), \
+                  frame_mean=frame_mean, frame_min=frame_min, frame_max=frame_max, \
+                  average_image=image_sum/Nframes )
+
+    meta = { 'format': 'polim archive', \
+                 'version': FORMAT_VERSION, \
+                 'shape': [int(s) for s in m.camera_data.datasize], \
+                 'dtype': np.dtype(spe._dataType).str, \
+                 'exposure': float(m.camera_data.exposuretime), \
+                 'chunk_frames': chunk_frames, \
+                 'compressed': compress, \
+                 'which_setup': which_setup, \
+                 'optical_element': m.excitation_motor_object().optical_element, \
+                 'source_spe': os.path.abspath(spe_filename), \
+                 'source_motor': [os.path.abspath(f) for f in [ex_motor_filename, em_motor_filename] if f is not None] }
+    fhandle = open( os.path.join(dirname, 'meta.json'), 'wt' )
+    json.dump( meta, fhandle, indent=1 )
+    fhandle.close()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""Converts all SPE files in a directory, which have a motor file (MS-<name>.txt),
+into archives (<name>.polim, see archive.py), which Movie reads without parsing
+the motor file again:
+
+    m = Movie( 'data.polim', 'data.polim', phase_offset_excitation=... )
+"""
+import sys, os, argparse, time
+from archive import convert
+
+
+parser = argparse.ArgumentParser( description='Convert SPE and motor files into archives.' )
+parser.add_argument( 'directory', help='directory with the SPE and motor files' )
+parser.add_argument( '--outdir', default=None, help='where to put the archives (default: same directory)' )
+parser.add_argument( '--setup', default='cool new setup', \
+                         choices=['old setup','new setup','cool new setup'] )
+parser.add_argument( '--optical-element', default='Polarizer', \
+                         help='optical element in excitation (ignored by the cool new setup)' )
+parser.add_argument( '--chunk-frames', type=int, default=64, help='frames per chunk file' )
+parser.add_argument( '--compress', action='store_true', help='compress the chunks' )
+args = parser.parse_args()
+
+outdir = args.outdir if args.outdir is not None else args.directory
+
+spefiles = sorted( [f for f in os.listdir(args.directory) if f.endswith('.spe') or f.endswith('.SPE')] )
+for spe in spefiles:
+    motorfile = os.path.join( args.directory, 'MS-'+spe[:-4]+'.txt' )
+    if not os.path.isfile( motorfile ):
+        print "SPE file %s doesn't have a motor file... skipped." % spe
+        continue
+    dirname = os.path.join( outdir, spe[:-4]+'.polim' )
+    if os.path.exists( dirname ):
+        print "%s exists already... skipped." % dirname
+        continue
+    print "converting %s ..." % spe,
+    sys.stdout.flush()
+    t = time.time()
+    convert( os.path.join(args.directory, spe), motorfile, dirname, which_setup=args.setup, \
+                 excitation_optical_element=args.optical_element, \
+                 chunk_frames=args.chunk_frames, compress=args.compress )
+    print "done (%.1fs)" % (time.time()-t)
@@ -24,9 +24,6 @@ import numpy
 import time
 import struct
 
-from scipy import *
-from pylab import *
-
 
 __version__   = "$Revision: 229 $"
 __author__    = "Stuart B. Wilkins <stuwilkins@mac.com>"
@@ -271,13 +268,41 @@ class MyPrincetonSPEFile():
         self._fid.seek(self.DATASTART)
         return numpy.fromfile(self._fid, dtype = self._dataType, count = -1).reshape(self._size)
 
+    def getMemmap(self):
+        """Return a read-only memory map of the data array
+
+        Nothing is read from disk until frames of the map are accessed."""
+        return numpy.memmap(self._fid, dtype = self._dataType, mode = 'r', \
+                                offset = self.DATASTART, \
+                                shape = tuple([int(s) for s in self._size]))
+
+    def return_Frames(self, frameindices):
+        """Return only the frames listed in frameindices
+
+        The frames are picked from a memory map, so only those parts of the
+        file are read which hold the requested frames."""
+        return numpy.array(self.getMemmap()[numpy.asarray(frameindices)])
+
+    def getPreview(self, nframes = 32):
+        """Return a quick look at the data, from nframes frames only
+
+        The frames are spread evenly over the file, and are read through a
+        memory map (see getMemmap), so this takes a fraction of the time of
+        reading everything. Returns the indices of the frames read, their
+        average image and their mean intensities (a trace of the intensity
+        over the whole movie, sampled at those frames), all in raw counts."""
+        zdim = int(self._size[0])
+        frameindices = numpy.unique(numpy.linspace(0, zdim-1, min(nframes, zdim)).astype(int))
+        frames = self.return_Frames(frameindices).astype(numpy.float64)
+        return frameindices, frames.mean(0), frames.reshape((frames.shape[0], -1)).mean(1)
+
     def close_file(self):
         self._fid.close()
 
 
 if __name__ == "__main__":
     # Run a test
-    data = PrincetonSPEFile("../../tests/testimage.spe")
+    data = MyPrincetonSPEFile("../../tests/testimage.spe")
     print data
     
     
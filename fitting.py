@@ -1,4 +1,63 @@
 import numpy as np
+import threading
+from collections import OrderedDict
+
+
+class AngleBasis:
+    """Tables for one grid of angles which the cosine fitter and the portrait 
+    reconstructions need over and over. Get these from basis_cache, don't make 
+    them yourself.
+
+    harmonics      -- (Nangles,3) array [1, cos(2a), sin(2a)]; a*harmonics[:,0] +
+                      b*harmonics[:,1] + c*harmonics[:,2] is any I0*(1+M*cos(2(a-phase)))
+    phases         -- the Nphases trial phases of the cosine fitter, on [0,pi/2]
+    shiftcos       -- (Nangles,Nphases) array of cos(2(a-phase)), the second column
+                      of the fitter's design matrix [1, cos(2(a-phase))] for each phase
+    shiftcos_mean  -- (Nphases,) mean of each column of shiftcos
+    shiftcos_ss    -- (Nphases,) sum of squares of each column after removing its mean
+    slope_pinv     -- (Nphases,Nangles) the row of the pseudo-inverse of each design
+                      matrix which gives the cosine coefficient
+    """
+    def __init__( self, angles, Nphases ):
+        self.angles    = angles.copy()
+        self.harmonics = np.vstack( [ np.ones(angles.size), np.cos(2*angles), np.sin(2*angles) ] ).T
+        self.phases    = np.linspace( 0, np.pi/2, Nphases )
+        self.shiftcos  = np.cos( 2*(angles[:,None]-self.phases[None,:]) )
+        self.shiftcos_mean = np.mean( self.shiftcos, axis=0 )
+        centered = self.shiftcos - self.shiftcos_mean
+        self.shiftcos_ss = np.sum( centered**2, axis=0 )
+        self.slope_pinv  = centered.T / self.shiftcos_ss[:,None]
+        for a in self.__dict__.values():
+            a.flags.writeable = False
+
+
+class BasisCache:
+    """Least-recently-used cache of AngleBasis objects, keyed by the angles
+    (by value) and the number of phases. At most maxsize bases are kept."""
+    def __init__( self, maxsize=16 ):
+        self.maxsize = maxsize
+        self.bases   = OrderedDict()
+        self.lock    = threading.Lock()
+
+    def get( self, angles, Nphases=91 ):
+        angles = np.ascontiguousarray( angles, dtype=np.float )
+        key = ( angles.size, hash(angles.tostring()), Nphases )
+        with self.lock:
+            basis = self.bases.pop( key, None )
+            if basis is None or not np.array_equal( basis.angles, angles ):
+                basis = AngleBasis( angles, Nphases )
+            self.bases[key] = basis
+            while len(self.bases) > self.maxsize:
+                self.bases.popitem( last=False )
+        return basis
+
+    def clear( self ):
+        with self.lock:
+            self.bases.clear()
+
+
+# shared by all fitters and portrait reconstructions of the process
+basis_cache = BasisCache()
 
 
 # def err_portrait_single_funnel_symmetric( params, ex_angles, em_angles, Ftot,\
@@ -20,19 +79,159 @@ import numpy as np
 #         raise ValueError("Unknown value for which_error: %s  (should be 'chi2' or 'R2')" % (which_error))
 
 
-def wrapper_for_de( params, extras ):
-    ex_angles = extras[0]
-    em_angles = extras[1]
-    Ftot      = extras[2]
-    mod_depth_excitation = extras[3] 
-    phase_excitation     = extras[4]
-    mode                 = extras[5]
-    use_least_sq         = extras[6]
+def cosine_values( angles, phase, I0, M ):
+    """Evaluates I0*(1+M*cos(2(angles-phase))), for 1d-arrays (or scalars) phase,
+    I0 and M, giving an array of shape (angles.size, phase.size) (or (angles.size,))."""
+    phase = np.asarray( phase, dtype=np.float )
+    I0    = np.asarray( I0, dtype=np.float )
+    IM    = I0*np.asarray( M, dtype=np.float )
+    coeffs = np.array( [ I0*np.ones_like(phase), IM*np.cos(2*phase), IM*np.sin(2*phase) ] )
+    return np.dot( basis_cache.get( angles ).harmonics, coeffs )
+
+
+def single_funnel_scores( params, ex_angles, em_angles, Ftot, md_ex, ph_ex ):
+    """Vectorised version of fit_portrait_single_funnel_symmetric( ..., mode='fitting',
+    use_least_sq=False ), for many spots and many parameter sets per spot at once.
+
+    params     -- array (Nspots, Npop, 4) of [md_fu, th_fu, gr, et]
+    ex_angles  -- 1d-array of excitation angles (columns of Ftot)
+    em_angles  -- 1d-array of emission angles (rows of Ftot)
+    Ftot       -- array (Nspots, N_em_angles, N_ex_angles) of portraits
+    md_ex, ph_ex -- 1d-arrays (Nspots,) of excitation modulation depth and phase
+
+    Returns the (Nspots, Npop) array of residuals.
+
+    All terms of the model are products of a function of the excitation angle
+    and a function of the emission angle, so a model portrait is built as a
+    matrix product of a few vectors (instead of evaluating the cosines on the
+    whole grid), and the cosines of the angles are only needed once. 
+    """
+    md_fu = params[:,:,0]
+    th_fu = params[:,:,1]
+    gr    = params[:,:,2]
+    et    = params[:,:,3]
+    Nspots, Npop = md_fu.shape
+
+    md_ex = np.asarray(md_ex).reshape((Nspots,1))
+    ph_ex = np.asarray(ph_ex).reshape((Nspots,1))
+
+    # shared tables: cos(2(x-p))  = cos(2x)cos(2p) + sin(2x)sin(2p),
+    # and            cos^2(x-p)   = .5*( 1 + cos(2(x-p)) )
+    c2ex, s2ex = basis_cache.get( ex_angles ).harmonics[:,1:].T
+    c2em, s2em = basis_cache.get( em_angles ).harmonics[:,1:].T
+    cos2  = lambda c2, s2, p: np.cos(2*p)[...,None]*c2 + np.sin(2*p)[...,None]*s2
 
-    result = fit_portrait_single_funnel_symmetric( params, ex_angles, em_angles, Ftot, \
-                                                       mod_depth_excitation, phase_excitation, \
-                                                       mode, use_least_sq )
-    return result
+    alpha = 0.5 * np.arccos( .5*(((gr+2)*md_ex)-gr) )
+    if np.any(np.isnan(alpha)):
+        raise ValueError( "alpha is nan; gr is out of bounds for md_ex" )
+
+    ph_ex = ph_ex*np.ones_like(gr)
+    wnoet = (1-et)/(2.0+gr)
+
+    # the four terms of the model, as emission vectors (weighted)...
+    U = np.empty( (Nspots, Npop, 4, em_angles.size) )
+    # ... and excitation vectors
+    V = np.empty( (Nspots, Npop, 4, ex_angles.size) )
+    for k,(p,w) in enumerate( [(ph_ex-alpha, wnoet), (ph_ex, gr*wnoet), (ph_ex+alpha, wnoet)] ):
+        U[:,:,k,:] = w[...,None] * .5*(1+cos2(c2em, s2em, p))
+        V[:,:,k,:] = .5*(1+cos2(c2ex, s2ex, p))
+    U[:,:,3,:] = et[...,None] * (1+md_fu[...,None]*cos2(c2em, s2em, th_fu+ph_ex))
+    V[:,:,3,:] = .25*(1+(md_ex*np.ones_like(gr))[...,None]*cos2(c2ex, s2ex, ph_ex))
+
+    # Fem[spot,pop,em,ex] = sum_k U[spot,pop,k,em] * V[spot,pop,k,ex]
+    Fem  = np.matmul( U.transpose(0,1,3,2), V )
+    Fem /= np.max( np.max( Fem, axis=3 ), axis=2 )[:,:,None,None]
+
+    Ftot = Ftot / np.max( Ftot.reshape((Nspots,-1)), axis=1 )[:,None,None]
+
+    return np.sum( np.sum( (Ftot[:,None,:,:]-Fem)**2, axis=3 ), axis=2 )
+
+
+def differential_evolution( scorefunction, lower, upper, Npop=40, F=.8, CR=.9, \
+                                maxiter=1000, tol=1e-8, patience=30, seed=None ):
+    """Minimises many independent problems at once by differential evolution
+    (DE/rand/1/bin).
+
+    scorefunction -- called as scorefunction( params, active ), where params
+                     is an array (Nactive, Npop, Nparams) of parameter sets, and 
+                     active the indices of the problems they belong to. Must
+                     return an array (Nactive, Npop) of scores.
+    lower, upper  -- arrays (Nproblems, Nparams) of parameter bounds
+    F, CR         -- differential weight and crossover probability
+    maxiter       -- maximum number of generations
+    tol           -- a problem is converged once the spread of scores in its
+                     population is below tol*(|best score|+tol) ...
+    patience      -- ... or its best score did not improve by more than that 
+                     for this many generations
+    seed          -- seed for the random number generator
+
+    Converged problems are not evaluated any further.
+
+    Returns the best parameters (Nproblems, Nparams), their scores (Nproblems,)
+    and the number of generations run for each problem (Nproblems,).
+    """
+    rng   = np.random.RandomState(seed)
+    lower = np.atleast_2d( np.asarray(lower, dtype=np.float) )
+    upper = np.atleast_2d( np.asarray(upper, dtype=np.float) )
+    assert lower.shape == upper.shape
+    assert Npop >= 4
+    Nprob, Npar = lower.shape
+    span = (upper-lower)[:,None,:]
+
+    pop    = lower[:,None,:] + rng.rand( Nprob, Npop, Npar )*span
+    scores = scorefunction( pop, np.arange(Nprob) )
+
+    best_index  = np.argmin( scores, axis=1 )
+    best_scores = scores[ np.arange(Nprob), best_index ]
+    stale       = np.zeros( (Nprob,), dtype=np.int )
+    generations = np.zeros( (Nprob,), dtype=np.int )
+    active      = np.arange(Nprob)
+
+    for gen in range(maxiter):
+        if active.size==0:
+            break
+        Na = active.size
+        apop = pop[active]
+
+        # pick three distinct partners for each member, none of them the member itself
+        order = np.argsort( rng.rand( Na, Npop, Npop-1 ), axis=2 )[:,:,:3]
+        order += order >= np.arange(Npop)[None,:,None]
+        ai = np.arange(Na)[:,None]
+        a = apop[ ai, order[:,:,0] ]
+        b = apop[ ai, order[:,:,1] ]
+        c = apop[ ai, order[:,:,2] ]
+        mutant = a + F*(b-c)
+
+        # binomial crossover, at least one parameter comes from the mutant
+        cross = rng.rand( Na, Npop, Npar ) < CR
+        cross[ ai, np.arange(Npop)[None,:], rng.randint( Npar, size=(Na,Npop) ) ] = True
+        trial = np.where( cross, mutant, apop )
+
+        # parameters which left the bounds are put back at random, between
+        # the parent and the bound
+        lo, up = lower[active][:,None,:], upper[active][:,None,:]
+        r = rng.rand( *trial.shape )
+        trial = np.where( trial < lo, lo + r*(apop-lo), trial )
+        trial = np.where( trial > up, up - r*(up-apop), trial )
+
+        tscores = scorefunction( trial, active )
+        better  = tscores <= scores[active]
+        pop[active]    = np.where( better[:,:,None], trial, apop )
+        scores[active] = np.where( better, tscores, scores[active] )
+
+        newbest = np.min( scores[active], axis=1 )
+        thresh  = tol*(np.abs(newbest)+tol)
+        improved = best_scores[active]-newbest > thresh
+        stale[active] = np.where( improved, 0, stale[active]+1 )
+        best_scores[active] = newbest
+        generations[active] += 1
+
+        spread = np.max( scores[active], axis=1 ) - newbest
+        done = (spread <= thresh) | (stale[active] >= patience)
+        active = active[~done]
+
+    best_index = np.argmin( scores, axis=1 )
+    return pop[ np.arange(Nprob), best_index ], scores[ np.arange(Nprob), best_index ], generations
 
 
 def fit_portrait_single_funnel_symmetric( params, ex_angles, em_angles, Ftot, \
@@ -184,14 +383,17 @@ def CosineFitter_mpi_master( angles, data ):
 
 
 def CosineFitter_new( angles, data, Nphases=91 ):
-
+    """Fits I0*(1+M*cos(2(angles-phase))) to each column of data, by a linear
+    fit of [1, cos(2(angles-phase))] for each of Nphases trial phases, keeping 
+    the phase with the smallest residual. The fits for all phases and columns
+    are done at once, with the tables from basis_cache.
+
+    Returns phase, I0, M, residual, fit (shape of data), the raw fit coefficients
+    (2,Ncolumns) and the index of the best trial phase of each column.
+    """
     assert angles.ndim == 1
     assert data.shape[0] == angles.size
 
-    # import matplotlib.pyplot as plt
-    # plt.plot(angles, data[:,0],'o:')
-    # print data.shape
-
     # if data is a 1d-array, then turn it into a 2d with singleton dimension
     if data.ndim==1:
         data = data.reshape( (data.size,1) )
@@ -199,84 +401,46 @@ def CosineFitter_new( angles, data, Nphases=91 ):
     # how many data columns do we have?
     Nspots = data.shape[1]
 
-#    Nphases = 91
-    phases  = np.linspace( 0, np.pi/2, Nphases )
-
-    rm = np.zeros( (phases.size, Nspots) )    # residual matrix
-    cm = np.zeros( (phases.size, 2, Nspots) ) # coefficient matrix
+    basis  = basis_cache.get( angles, Nphases )
 
-    # we'll init all phase-shifts at once, giving
-    # a separate column for each phase offset
-    # (these next two lines are beautiful, enjoy)
-    shiftcos = np.cos( 2*reduce( np.add, np.meshgrid( -phases, angles ) ) )
-    er=np.vstack((np.ones(shiftcos.shape),shiftcos)).reshape((shiftcos.shape[0],shiftcos.shape[1]*2), order='F')
-
-    # now er starts with a columns of ones, followed by a phase-shifted cosine,
-    # followed by another column of ones, followed by the next phase-shifted cosine, etc ...
-    # Why this arrangement? --- first, we have the cosines still available when the fits are done,
-    # and second, I can pass contiguous arrays to np.linalg.lstsq(), which should help speed-wise
-    # (though i haven't tested this).
-
-    # bestpis   = np.zeros( (Nspots,), dtype=np.int )
-    # bestresis = np.ones( (Nspots,) )*np.inf
-    # bestfitpa = np.zeros( (2,Nspots) )
-    for pi,phase in enumerate( phases ):
-        # perform linear fit
-        f = np.linalg.lstsq( er[:,2*pi:2*pi+2], data )
-        # if f[1].size==0:
-        #     print f
-        #     print np.dot(er[:,2*pi:2*pi+2],f[0])
-        #     print angles
-        #     print data
-        # print "f[1].shape=",f[1].shape
-        # print "residualmatrix[pi,:].shape=",residualmatrix[pi,:].shape
-        rm[pi,:] = f[1]
-        cm[pi,:,:] = f[0][:]
+    # the fit is done in double precision, whatever the data
+    data   = np.asarray( data, dtype=np.float )
+    mean   = np.mean( data, axis=0 )
 
-        # # for which spots is the current fit better than anythings we've seen before?
-        # wherebetter = f[1]<bestresis
-        # # update the list of best known residuals
-        # bestresis[wherebetter] = f[1][wherebetter]
-        # # write the phase index into a similar list
-        # bestpis[wherebetter]   = pi
-        # # as well as the resulting fit parameters
-        # bestfitpa[:,wherebetter] = f[0][:,wherebetter]
+    # cosine coefficient for each phase (rows) and column; with the column mean
+    # removed, it's a one-parameter fit, and the residual is what's left of the
+    # variance of the column
+    slopes = np.dot( basis.slope_pinv, data )
+    rm     = np.sum( (data-mean)**2, axis=0 )[None,:] - slopes**2*basis.shiftcos_ss[:,None]
+    # ... which can't be negative, apart from roundoff
+    rm     = np.maximum( rm, 0 )
 
     mm = minindices = np.argmin( rm, axis=0 )
-    rp = resultingphases = phases[minindices]
-
-    I_0 = np.zeros( (Nspots,) )
-    M_0 = np.zeros( (Nspots,) )
-    resi = np.zeros( (Nspots,) )
-    fit  = np.zeros( (angles.size, Nspots) )
+    rp = resultingphases = basis.phases[minindices]
 
-    rawfitpars = np.zeros( (2,Nspots) )
+    cols = np.arange(Nspots)
+    c1   = slopes[ mm, cols ]
+    c0   = mean - c1*basis.shiftcos_mean[mm]
 
-    for i in range(Nspots):
+    rawfitpars = np.vstack( (c0, c1) )
+    fit  = c0[None,:] + basis.shiftcos[:,mm]*c1[None,:]
+    resi = rm[ mm, cols ]
 
-        fit[:,i]     = np.dot( er[:,2*mm[i]:2*mm[i]+2], cm[mm[i],:,i] )
-        rawfitpars[:,i] = cm[mm[i],:,i]
+    # phases are given by the minimum index, but
+    # need correction if second coeff is <0
+    negative = c1 < 0
+    rp[negative] -= np.pi/2
+    c1 = np.abs(c1)
 
-        # phases are given by the minimum index, but
-        # need correction if second coeff is <0
-        if cm[mm[i],1,i] < 0:
-            rp[i] -= np.pi/2
-            # fix that coeff for use below
-            cm[mm[i],1,i] *= -1
-        
-        # I_0 is given by the first coefficient
-        I_0[i] = cm[mm[i],0,i]
-
-        # now modulation is given by the ratio of c2/c1
-        M_0[i] = cm[mm[i],1,i]/cm[mm[i],0,i]
-
-        # also collect residuals of these minima
-        resi[i] = rm[mm[i],i]
+    # I_0 is given by the first coefficient,
+    # and modulation is given by the ratio of c2/c1
+    I_0 = c0
+    M_0 = c1/c0
 
     return rp, I_0, M_0, resi, fit, rawfitpars, mm
 
 
-def CosineFitter( angles, data ):
+def CosineFitter( angles, data, Nphases=91 ):
 
     assert angles.ndim == 1
     assert data.shape[0] == angles.size
@@ -288,8 +452,8 @@ def CosineFitter( angles, data ):
     # how many data columns do we have?
     Nspots = data.shape[1]
 
-    Nphases = 91
-    phases  = np.linspace( 0, np.pi/2, Nphases )
+    basis   = basis_cache.get( angles, Nphases )
+    phases  = basis.phases.copy()
 
     rm = residualmatrix    = np.zeros( (phases.size, Nspots) )
     cm = coefficientmatrix = np.zeros( (phases.size, 2, Nspots) )
@@ -299,7 +463,7 @@ def CosineFitter( angles, data ):
 
     for pi,phase in enumerate( phases ):
         # write phase-shifted cos**2 into second column
-        er[:,1] = np.cos( 2*(angles-phase) )
+        er[:,1] = basis.shiftcos[:,pi]
         # perform linear fit
         f = np.linalg.lstsq( er, data )
         residualmatrix[pi,:] = f[1]
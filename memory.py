@@ -40,3 +40,24 @@ def stacksize(since=0.0):
     '''Return stack size in bytes.
     '''
     return _VmB('VmStk:') - since
+
+
+def peak(since=0.0):
+    '''Return peak resident memory usage in bytes (since the start of the
+    process, or since the last reset_peak()).
+    '''
+    return _VmB('VmHWM:') - since
+
+
+def reset_peak():
+    '''Reset the peak resident memory usage to the current usage.
+    Returns False if that is not possible (non-Linux, or kernel < 4.0),
+    in which case peak() keeps counting from the start of the process.
+    '''
+    try:
+        t = open('/proc/%d/clear_refs' % os.getpid(), 'w')
+        t.write('5')
+        t.close()
+    except:
+        return False
+    return True
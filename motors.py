@@ -2,6 +2,18 @@ import numpy as np
 from util_misc import deal_with_date_time_string
 
 
+def canonical_optical_element( optical_element ):
+    """Returns the name of the optical element in the excitation path the way 
+    the motor classes compare it, 'L/2 Plate' or 'Polarizer', whichever way it 
+    is capitalised (or 'l/2' for the L/2 plate, as am_gui used to call it)."""
+    name = optical_element.strip().lower()
+    if name in ['l/2 plate','l/2']:
+        return 'L/2 Plate'
+    elif name=='polarizer':
+        return 'Polarizer'
+    raise ValueError("Unknown optical element in excitation: '%s' (should be 'L/2 Plate' or 'Polarizer')" % optical_element)
+
+
 def is_number(s):
     try:
         float(s)
@@ -52,12 +64,15 @@ class BothMotorsWithHeader:
 
 
 class BothMotors:
-    def __init__( self, filename, phase_offset=0, optical_element='L/2 plate' ):
-        """Initialize the class: read in the file"""
+    # the motor file says which optical element there was, see set_optical_element()
+    optical_element_in_file = True
+
+    def __init__( self, filename, phase_offset=0, optical_element='L/2 Plate' ):
+        """Initialize the class: read in the file. The optical element is 
+        taken from the file, the argument is ignored."""
         self.experiment_start_datetime = None
         self.filename = filename
         self.phase_offset = phase_offset
-        self.optical_element = optical_element
 
         # deal with motor file
         f = open(filename,'r')
@@ -77,14 +92,28 @@ class BothMotors:
                              skiprows=2 )
 
         self.framenumbers = md[:,0]
-        self.excitation_angles_raw = md[:,1] * np.pi/180.0
+        # motor position of the excitation optical element
+        self.excitation_motor_angles = md[:,1] * np.pi/180.0
         self.emission_angles_raw   = md[:,2] * np.pi/180.0
 
+        self.compute_excitation_angles()
+        self.emission_angles       = np.mod( self.emission_angles_raw, 2*np.pi )
+
+    def compute_excitation_angles( self ):
+        self.excitation_angles_raw = self.excitation_motor_angles.copy()
         if self.optical_element=='L/2 Plate':
             self.excitation_angles_raw *= 2
-
         self.excitation_angles     = np.mod( self.excitation_angles_raw, 2*np.pi ) + self.phase_offset
-        self.emission_angles       = np.mod( self.emission_angles_raw, 2*np.pi )
+
+    def set_phase_offset( self, phase_offset ):
+        self.phase_offset = phase_offset
+        self.compute_excitation_angles()
+
+    def set_optical_element( self, optical_element ):
+        """The optical element is given by the motor file, and can't be changed."""
+        if not canonical_optical_element( optical_element )==self.optical_element:
+            raise ValueError("%s was taken with optical element '%s', it can't be changed to '%s'" \
+                                 % (self.filename, self.optical_element, optical_element))
 
 
 
@@ -124,7 +153,7 @@ class NewSetupMotor:
         self.experiment_start_datetime = None
         self.filename = filename
         self.phase_offset = phase_offset
-        self.optical_element = optical_element
+        self.optical_element = canonical_optical_element( optical_element )
 
         self.load_motor_file( filename, which_motor )
 
@@ -156,13 +185,21 @@ class NewSetupMotor:
 
         self.timestamps = timestamps
         if which_motor=='excitation':
-            self.angles     = exciangles * np.pi/180.0
+            self.motor_angles = exciangles * np.pi/180.0
         elif which_motor=='emission':
-            self.angles     = emisangles * np.pi/180.0
+            self.motor_angles = emisangles * np.pi/180.0
         else:
             raise ValueError("Input argument which_motor to class NewSetupMotor must take values 'excitation' or 'emission'. Got: %s" % (which_motor))
         self.shutter    = shutter
 
+        self.set_optical_element( self.optical_element )
+
+    def set_phase_offset( self, phase_offset ):
+        self.phase_offset = phase_offset
+
+    def set_optical_element( self, optical_element ):
+        self.optical_element = canonical_optical_element( optical_element )
+        self.angles = self.motor_angles.copy()
         if self.optical_element=='L/2 Plate':
             self.angles *= 2
 
@@ -233,7 +270,7 @@ class ExcitationMotor:
         self.filename = filename
         self.phase_offset_excitation = phase_offset_excitation
         self.rotation_direction = rotation_direction
-        self.optical_element = optical_element
+        self.optical_element = canonical_optical_element( optical_element )
         
         self.load_excitation_motor_file( filename )
         self.determine_function()
@@ -268,6 +305,13 @@ class ExcitationMotor:
         self.starttime  = timestamps[0]
         self.endtime    = timestamps[-1]
 
+    def set_phase_offset( self, phase_offset ):
+        self.phase_offset_excitation = phase_offset
+
+    def set_optical_element( self, optical_element ):
+        self.optical_element = canonical_optical_element( optical_element )
+        self.determine_function()
+
 
     def angle(self, time, raw_angles=True):
         """This function will return the angle of the excitation polarization given
@@ -0,0 +1,114 @@
+import sys, threading, traceback
+from collections import OrderedDict
+import numpy as np
+from util_2d import Movie
+
+
+def movie_nbytes( movie ):
+    """Rough size of a movie in memory: its arrays and those of its camera data."""
+    nbytes = 0
+    for obj in [movie, movie.camera_data]:
+        for value in obj.__dict__.values():
+            if isinstance(value, np.ndarray) and not isinstance(value, np.memmap):
+                nbytes += value.nbytes
+    for b in getattr(movie, 'blanks', []):
+        nbytes += b.nbytes
+    return nbytes
+
+
+class MovieCache:
+    """Keeps recently loaded movies, so that going back to a file does not read
+    it from disk again. Movies are dropped, least recently used first, once they
+    take up more than max_bytes together (the most recent one is always kept).
+
+    Movies are identified by their file names together with the keyword arguments
+    given to Movie(); get() returns the cached movie, or loads it. prefetch() 
+    loads a movie in a background thread, so that a later get() finds it ready
+    (or waits only for the rest of the load). 
+
+    Cached movies are shared, so whoever gets one should reset() it before 
+    defining spots, unless the previous spots and results are wanted.
+    """
+
+    def __init__( self, max_bytes=2*1024**3 ):
+        self.max_bytes = max_bytes
+        # key -> (movie, nbytes), most recently used last
+        self.movies  = OrderedDict()
+        # key -> thread loading it
+        self.loading = {}
+        self.lock    = threading.Lock()
+
+    def key( self, spe_filename, motor_filename, kwargs ):
+        return (spe_filename, motor_filename, tuple(sorted(kwargs.items())))
+
+    def is_cached( self, spe_filename, motor_filename, **kwargs ):
+        """True if get() would return at once."""
+        with self.lock:
+            return self.key( spe_filename, motor_filename, kwargs ) in self.movies
+
+    def is_loading( self, spe_filename, motor_filename, **kwargs ):
+        """True while the movie is being prefetched."""
+        with self.lock:
+            return self.key( spe_filename, motor_filename, kwargs ) in self.loading
+
+    def get( self, spe_filename, motor_filename, **kwargs ):
+        key = self.key( spe_filename, motor_filename, kwargs )
+        with self.lock:
+            thread = self.loading.get( key )
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            if key in self.movies:
+                movie, nbytes = self.movies.pop( key )
+                self.movies[key] = (movie, nbytes)
+                return movie
+        # not cached, or the prefetch failed: load it here (and fail here)
+        movie = Movie( spe_filename, motor_filename, **kwargs )
+        self.insert( key, movie )
+        return movie
+
+    def prefetch( self, spe_filename, motor_filename, **kwargs ):
+        key = self.key( spe_filename, motor_filename, kwargs )
+        with self.lock:
+            if key in self.movies or key in self.loading:
+                return
+            thread = threading.Thread( target=self.load_in_background, \
+                                           args=(key, spe_filename, motor_filename, kwargs) )
+            thread.daemon = True
+            self.loading[key] = thread
+            # started while holding the lock, so that get() never joins an unstarted thread
+            thread.start()
+
+    def load_in_background( self, key, spe_filename, motor_filename, kwargs ):
+        try:
+            movie = Movie( spe_filename, motor_filename, **kwargs )
+            self.insert( key, movie )
+        except Exception:
+            print "Prefetching %s failed:" % spe_filename
+            traceback.print_exc()
+            sys.stdout.flush()
+        finally:
+            with self.lock:
+                self.loading.pop( key, None )
+
+    def insert( self, key, movie ):
+        with self.lock:
+            self.movies.pop( key, None )
+            self.movies[key] = (movie, movie_nbytes(movie))
+            total = sum( [nbytes for m,nbytes in self.movies.values()] )
+            while total > self.max_bytes and len(self.movies) > 1:
+                oldkey, (oldmovie, oldnbytes) = self.movies.popitem( last=False )
+                total -= oldnbytes
+
+    def rekey( self, spe_filename, motor_filename, old_kwargs, new_kwargs ):
+        """Files a cached movie under new keyword arguments, after it has been
+        changed to match them (see Movie.set_phase_offset())."""
+        old = self.key( spe_filename, motor_filename, old_kwargs )
+        new = self.key( spe_filename, motor_filename, new_kwargs )
+        with self.lock:
+            if old in self.movies:
+                self.movies[new] = self.movies.pop( old )
+
+    def clear( self ):
+        with self.lock:
+            self.movies.clear()
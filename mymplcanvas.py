@@ -11,6 +11,25 @@ import numpy as np
 
 import spot_picker
 
+
+def image_to_rgba( image, cmap=cm.jet, vmin=0, vmax=1, alpha=1 ):
+    """Turns a contrast image (e.g. Movie.M_ex_image) into an RGBA image for
+    the overlay layer of MyMplCanvas. Pixels which are nan (not covered by any
+    spot) are fully transparent."""
+    isnan = np.isnan(image)
+    rgba = cmap( (np.where(isnan, vmin, image)-vmin)/float(vmax-vmin) )
+    rgba[...,3] = alpha
+    rgba[isnan,3] = 0
+    return rgba
+
+def mask_to_rgba( mask, color, alpha=.3, rgba=None ):
+    """Paints the pixels where mask is True in the given color. If rgba is
+    given, paints into it, otherwise into a new transparent RGBA image."""
+    if rgba is None:
+        rgba = np.zeros( mask.shape+(4,) )
+    rgba[mask] = matplotlib.colors.colorConverter.to_rgba( color, alpha )
+    return rgba
+
 class MyMplCanvas(FigureCanvas):
     """Simple canvas with a sine plot."""
     def __init__(self, parent=None, width=5, height=4, dpi=100):
@@ -49,11 +68,14 @@ class MyMplCanvas(FigureCanvas):
         # self.signal_rect = Rectangle((0,0), 0, 0, facecolor='red', edgecolor='red', alpha=.3, zorder=9 )
         # self.axes.add_patch(self.signal_rect)
 
-        self.M_ex_rects = []
-        self.M_em_rects = []
-        self.phase_ex_rects = []
-        self.phase_em_rects = []
-        self.spot_rects = []
+        # spots and contrast maps are shown as a single RGBA image on top of
+        # the camera image, layers holds one RGBA image for each of 'spots',
+        # 'M_ex', 'M_em', 'phase_ex', 'phase_em', 'ET_ruler' (see set_layer())
+        self.image_artist = None
+        self.frame_text = None
+        self.overlay = None
+        self.layers = {}
+        self.current_layer = ''
 
 #        self.anno = spot_picker.Annotate(self.axes)
 
@@ -147,36 +169,73 @@ class MyMplCanvas(FigureCanvas):
     def show_image(self,image, origin='upper', zorder=1, cmap=cm.gray):
         # self.fig.clear()
         # self.axes = self.fig.add_subplot(111)
-        self.axes.imshow( image, origin=origin, zorder=zorder, cmap=cmap )
+        # the image artist is reused as long as the image size stays the same
+        if self.image_artist is not None and self.image_artist.get_array().shape==image.shape:
+            self.image_artist.set_data( image )
+            self.image_artist.set_cmap( cmap )
+            self.image_artist.set_clim( np.nanmin(image), np.nanmax(image) )
+        else:
+            if self.image_artist is not None:
+                self.image_artist.remove()
+            self.image_artist = self.axes.imshow( image, origin=origin, zorder=zorder, cmap=cmap )
+
+            # (re-)create the overlay on top of the image, with the same geometry
+            if self.overlay is not None:
+                self.overlay.remove()
+            self.overlay = self.axes.imshow( np.zeros( image.shape+(4,) ), origin=origin, \
+                                                 zorder=7, interpolation='nearest' )
+        self.layers = {}
+
         self.figure.canvas.draw()
         self.show_stuff(what='')
 
+    def show_frame( self, image, text=None ):
+        """Swaps the image shown for another one of the same size (e.g. the next
+        frame of the movie) and blits it, without redrawing the whole figure.
+        The color scale set by show_image() is kept. If text is given, it is
+        shown in the top left corner of the image."""
+        if self.image_artist is None:
+            self.show_image( image )
+            return
+        self.image_artist.set_data( image )
+        if self.frame_text is None:
+            self.frame_text = self.axes.text( .02, .98, '', transform=self.axes.transAxes, \
+                                                  color='w', va='top', zorder=11 )
+        self.frame_text.set_text( '' if text is None else text )
+
+        # the image covers the whole axes, so everything on top of it has to be
+        # redrawn too; what we get is the new background for the crosshairs
+        self.axes.draw_artist( self.image_artist )
+        if self.overlay is not None and self.overlay.get_visible():
+            self.axes.draw_artist( self.overlay )
+        self.axes.draw_artist( self.bg_rect )
+        self.axes.draw_artist( self.rect )
+        self.axes.draw_artist( self.frame_text )
+        self.blitbackground = self.figure.canvas.copy_from_bbox(self.axes.bbox)
+        self.axes.draw_artist( self.hline )
+        self.axes.draw_artist( self.vline )
+        self.figure.canvas.blit(self.axes.bbox)
+
+    def set_layer( self, what, rgba ):
+        """Stores the RGBA image to show for what (see show_stuff()). If that
+        layer is currently shown, the overlay is updated right away."""
+        self.layers[what] = rgba
+        if what==self.current_layer:
+            self.show_stuff( what )
+
+    def clear_layers( self ):
+        self.layers = {}
+        self.show_stuff( self.current_layer )
+
     def show_stuff(self, what='spots' ):        
 
-        while len(self.axes.patches)>0:
-            self.axes.patches[0].remove()
-
-        self.axes.add_patch( self.rect )
-        self.axes.add_patch( self.bg_rect )
-
-        if what=='spots':
-            for r in self.spot_rects:
-                self.axes.add_patch( r )
-        elif what=='M_ex':
-            for r in self.M_ex_rects:
-                self.axes.add_patch( r )
-        elif what=='M_em':
-            for r in self.M_em_rects:
-                self.axes.add_patch( r )
-        elif what=='phase_ex':
-            for r in self.phase_ex_rects:
-                self.axes.add_patch( r )
-        elif what=='phase_em':
-            for r in self.phase_em_rects:
-                self.axes.add_patch( r )
-        elif what=='ET_ruler':
-            for r in self.ET_ruler_rects:
-                self.axes.add_patch( r )
+        self.current_layer = what
+        if self.overlay is not None:
+            if what in self.layers:
+                self.overlay.set_data( self.layers[what] )
+                self.overlay.set_visible(True)
+            else:
+                self.overlay.set_visible(False)
 
         self.hline.set_visible(False)
         self.vline.set_visible(False)
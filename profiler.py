@@ -0,0 +1,184 @@
+import os, sys, time, json, subprocess
+from functools import wraps
+import memory
+
+
+class Profiler:
+    """Collects a trace of timed stages of the analysis pipeline.
+
+    Each stage records wall time, CPU time (user+system, as by os.times()),
+    the resident memory at its start, the peak resident memory during the
+    stage above that (see memory.peak()), and optionally how many spots and
+    frames it worked on, from which the throughput is derived.
+    Stages may be nested; each record knows its depth.
+
+    Use either the context manager
+
+        p = Profiler()
+        with p.stage('fit', spots=len(m.validspots)):
+            m.fit_all_portraits_spot_parallel()
+
+    or hand the profiler to a Movie (Movie(..., profiler=p)), which then
+    records its pipeline stages by itself (see profiled_stage()).
+    The trace can be printed with report() or saved with dump().
+    """
+
+    def __init__( self ):
+        self.trace = []
+        self.depth = 0
+        # stages which have started but not finished yet
+        self.open_stages = []
+
+    def stage( self, name, spots=None, frames=None ):
+        return _Stage( self, name, spots, frames )
+
+    def dump( self, filename ):
+        """Saves the trace as JSON."""
+        fhandle = open( filename, 'wt' )
+        json.dump( self.trace, fhandle, indent=1 )
+        fhandle.close()
+
+    def report( self ):
+        for r in self.trace:
+            line = "%s%-40s wall=%8.3fs  cpu=%8.3fs  peak+=%7.1fMB" % \
+                ('  '*r['depth'], r['name'], r['wall'], r['cpu'], r['peak_rss_delta']/(1024*1024))
+            if 'spots_per_sec' in r:
+                line += "  %10.1f spots/s" % r['spots_per_sec']
+            if 'frames_per_sec' in r:
+                line += "  %10.1f frames/s" % r['frames_per_sec']
+            print line
+
+
+class _Stage:
+    """Context manager which times one stage, see Profiler.stage()."""
+    def __init__( self, profiler, name, spots, frames ):
+        self.profiler = profiler
+        self.record   = {'name': name, 'depth': profiler.depth}
+        if spots:
+            self.record['spots'] = spots
+        if frames:
+            self.record['frames'] = frames
+
+    def __enter__( self ):
+        # the trace is kept in the order in which stages start, so that
+        # nested stages come right after the stage they belong to
+        self.profiler.trace.append( self.record )
+        self.profiler.depth += 1
+        # resetting the peak also resets it for the enclosing stage, which
+        # therefore keeps its peak so far, and gets to know the peak of this
+        # stage in __exit__
+        if len(self.profiler.open_stages) > 0:
+            parent = self.profiler.open_stages[-1]
+            parent.nested_peak = max( parent.nested_peak, memory.peak() )
+        self.profiler.open_stages.append( self )
+        self.nested_peak = 0.0
+        memory.reset_peak()
+        self.rss0 = memory.resident()
+        t = os.times()
+        self.cpu0  = t[0]+t[1]
+        self.wall0 = time.time()
+        return self.record
+
+    def __exit__( self, exc_type, exc_value, tb ):
+        wall = time.time()-self.wall0
+        t = os.times()
+        r = self.record
+        r['wall'] = wall
+        r['cpu']  = t[0]+t[1]-self.cpu0
+        r['rss_start'] = self.rss0
+        peak = max( memory.peak(), self.nested_peak )
+        r['peak_rss_delta'] = max( peak-self.rss0, 0.0 )
+        if wall > 0:
+            if 'spots' in r:
+                r['spots_per_sec'] = r['spots']/wall
+            if 'frames' in r:
+                r['frames_per_sec'] = r['frames']/wall
+        if exc_type is not None:
+            r['error'] = exc_type.__name__
+        self.profiler.depth -= 1
+        self.profiler.open_stages.pop()
+        if len(self.profiler.open_stages) > 0:
+            parent = self.profiler.open_stages[-1]
+            parent.nested_peak = max( parent.nested_peak, peak )
+        return False
+
+
+class _NoStage:
+    """Stands in for _Stage when there is no profiler."""
+    def __enter__( self ):
+        return {}
+    def __exit__( self, exc_type, exc_value, tb ):
+        return False
+
+
+def stage( profiler, name, spots=None, frames=None ):
+    """Profiler.stage(), or a context manager which does nothing if profiler is None."""
+    if profiler is None:
+        return _NoStage()
+    return profiler.stage( name, spots=spots, frames=frames )
+
+
+def profiled_stage( name=None, count_arg=None ):
+    """Decorator for Movie methods: if the movie has a profiler, the method is
+    recorded as a stage, together with the number of spots it works on (the
+    spots argument if given, otherwise the valid spots, otherwise all spots)
+    and the number of frames loaded. If the spots are only made by the method,
+    count_arg gives the position of the argument holding their list."""
+    def decorator( method ):
+        stagename = name if name is not None else method.__name__
+        @wraps(method)
+        def wrapper( self, *args, **kwargs ):
+            profiler = getattr( self, 'profiler', None )
+            if profiler is None:
+                return method( self, *args, **kwargs )
+            if count_arg is not None and len(args) > count_arg:
+                Nspots = len(args[count_arg])
+            elif kwargs.get('spots') is not None:
+                Nspots = len(kwargs['spots'])
+            elif hasattr(self, 'validspots'):
+                Nspots = len(self.validspots)
+            else:
+                Nspots = len(self.spots)
+            Nframes = None
+            if hasattr(self.camera_data, 'frameindices'):
+                Nframes = int(self.camera_data.frameindices.size)
+            with profiler.stage( stagename, spots=Nspots, frames=Nframes ):
+                return method( self, *args, **kwargs )
+        return wrapper
+    return decorator
+
+
+# modules which the compute-only core (SPE files, motors, fitting, Movie) does
+# not load when it is imported: plotting and scipy are imported where used
+HEAVY_MODULES = ['matplotlib', 'pylab', 'scipy', 'PyQt4', 'mpi4py']
+
+_startup_code = """
+import sys, time, json
+t = time.time()
+import %s
+t = time.time()-t
+print json.dumps( {'seconds': t, 'loaded': sorted( [m for m in %r if m in sys.modules] )} )
+"""
+
+def startup_time( module='util_2d', target=None ):
+    """Measures how long a fresh python process takes to import module, as
+    each worker of runner.py or MPI rank of analyse.py has to. Returns the time
+    in seconds, and the list of HEAVY_MODULES which the import has loaded.
+    With a target (in seconds), raises a RuntimeError if the import takes
+    longer than that, or loads any of HEAVY_MODULES."""
+    output = subprocess.check_output( [sys.executable, '-c', _startup_code % (module, HEAVY_MODULES)], \
+                                          cwd=os.path.dirname( os.path.abspath(__file__) ) )
+    result = json.loads( output.strip().splitlines()[-1] )
+    if target is not None:
+        if len(result['loaded']) > 0:
+            raise RuntimeError("Importing %s loads %s" % (module, ', '.join(result['loaded'])))
+        if result['seconds'] > target:
+            raise RuntimeError("Importing %s takes %.2fs, more than %.2fs" % (module, result['seconds'], target))
+    return result['seconds'], result['loaded']
+
+
+if __name__=='__main__':
+    # import times of the compute-only core
+    for module in ['files', 'motors', 'fitting', 'archive', 'util_misc', 'util_2d', 'runner']:
+        seconds, loaded = startup_time( module )
+        print "%-10s %6.3fs  %s" % (module, seconds, ' '.join(loaded))
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""Runs the analysis of several movies without the GUI, as described in a
+manifest, on a pool of local processes:
+
+    python runner.py manifest.json [--processes 4] [--restart]
+
+The manifest is a JSON file like this:
+
+    { "output":    "results",
+      "processes": 4,
+      "defaults":  { "which_setup": "cool new setup", "phase_offset": 1.0, "SNR": 10,
+                     "skip_invalid_frames": true, "stages": ["ETruler"] },
+      "datasets":  [
+          { "name": "single_layer",
+            "spe": "olle_single_layer_x40_488_OD2.SPE",
+            "motor": "MS-olle_single_layer_x40_488_OD2.txt",
+            "background": [0,100,50,300],
+            "grid": {"bounds": [300,160,400,440], "res": 1},
+            "tiles": 8 },
+          { "name": "blob",
+            "spe": "blob.polim", "motor": "blob.polim",
+            "background": [0,0,20,20],
+            "spots": [[60,76,85,95]] } ] }
+
+Each dataset takes the entries of "defaults" which it doesn't set itself:
+
+    spe, motor             SPE file (or archive) and motor file (or archive)
+    emission_motor         emission motor file of the old setup
+    blank                  blank sample file(s)
+    phase_offset           excitation phase offset, in degrees
+    which_setup, optical_element, skip_invalid_frames, precision
+                           as for Movie
+    correct_drift          estimate the drift before the spots are defined
+    background             coordinates of the background spot
+    spots                  list of spot coordinates, or
+    grid                   {"bounds": ..., "res": ...} for a grid of squares (see
+                           util_misc.grid_image_section_into_squares_and_define_spots()), or
+    auto                   keyword arguments of Movie.auto_define_spots()
+    tiles                  number of jobs the spots are split into (default 1; not
+                           for auto): the grid bounds are cut into stripes, as in
+                           analyse.py, the list of spots into parts; there are
+                           never more tiles than squares across the grid or spots
+    SNR                    validity threshold
+    stages                 stages to run besides validity, fit and moddepths, which
+                           are always run: ETruler, ETmodel (see STAGES)
+    ETmodel                keyword arguments of Movie.ETmodel_de()
+    profile                record and save a profile of each job (see profiler.py)
+
+Every job (one tile of one dataset) works in the directory <output>/<name>/tile_NN,
+and saves the outputs of each stage there as soon as it is done. A job which is
+run again picks up after the last stage it got done; only the movie is read again.
+If the description of the job in the manifest has changed since, it starts over.
+Once all tiles of a dataset are done, their images are put together in
+<output>/<name>/images.npz.
+"""
+import sys, os, json, time, argparse, traceback, shutil
+import multiprocessing
+import numpy as np
+
+
+# the stages of the pipeline, in the order in which they are run
+STAGES = ['validity', 'fit', 'moddepths', 'ETruler', 'ETmodel']
+
+# per stage, the spot attributes which it yields, and the images they go to
+STAGE_RESULTS = { 'moddepths': [ ('phase_ex','phase_ex'), ('M_ex','M_ex'), ('phase_em','phase_em'), \
+                                     ('M_em','M_em'), ('LS','LS') ], \
+                  'ETruler':   [ ('ET_ruler','ET_ruler') ], \
+                  'ETmodel':   [ ('ETmodel_md_fu','ET_model_md_fu'), ('ETmodel_th_fu','ET_model_th_fu'), \
+                                     ('ETmodel_gr','ET_model_gr'), ('ETmodel_et','ET_model_et') ] }
+
+# the images which make up the results of a job
+IMAGES = [ 'spot_coverage', 'mean_intensity', 'SNR', 'M_ex', 'M_em', 'phase_ex', 'phase_em', 'LS', \
+               'ET_ruler', 'ET_model_md_fu', 'ET_model_th_fu', 'ET_model_gr', 'ET_model_et' ]
+
+DATASET_DEFAULTS = { 'emission_motor': None, 'blank': None, 'phase_offset': 0.0, \
+                         'which_setup': 'cool new setup', 'optical_element': 'Polarizer', \
+                         'skip_invalid_frames': True, 'precision': 'float64', 'correct_drift': False, \
+                         'tiles': 1, 'SNR': 10, 'stages': [], 'ETmodel': {}, 'profile': False }
+
+
+def read_manifest( filename ):
+    """Returns the output directory, the number of processes, and the list of
+    datasets of the manifest, with the defaults filled in. Relative file
+    names are taken relative to the manifest."""
+    fhandle = open( filename, 'rt' )
+    manifest = json.load( fhandle )
+    fhandle.close()
+    basedir = os.path.dirname( os.path.abspath(filename) )
+    place = lambda f: f if f is None else os.path.join( basedir, f )
+
+    datasets = []
+    for entry in manifest['datasets']:
+        d = dict( DATASET_DEFAULTS )
+        d.update( manifest.get('defaults', {}) )
+        d.update( entry )
+        for what in ['name','spe','motor','background']:
+            if not what in d:
+                raise ValueError("%s: dataset #%d has no '%s'" % (filename, len(datasets), what))
+        if sum( [what in d for what in ['spots','grid','auto']] ) != 1:
+            raise ValueError("%s: dataset '%s' needs exactly one of 'spots', 'grid' or 'auto'" % (filename, d['name']))
+        if not isinstance( d['tiles'], int ) or d['tiles'] < 1:
+            raise ValueError("%s: dataset '%s' needs a whole number of tiles >= 1, got %r" \
+                                 % (filename, d['name'], d['tiles']))
+        if 'grid' in d:
+            b, res = d['grid']['bounds'], d['grid']['res']
+            if (b[2]-b[0])//res < 1 or (b[3]-b[1])//res < 1:
+                raise ValueError("%s: dataset '%s' has grid bounds %s smaller than one square of %d" \
+                                     % (filename, d['name'], str(b), res))
+        for stage in d['stages']:
+            if not stage in STAGES:
+                raise ValueError("%s: dataset '%s' has unknown stage '%s' (should be one of %s)" \
+                                     % (filename, d['name'], stage, ', '.join(STAGES)))
+        for what in ['spe','motor','emission_motor']:
+            d[what] = place( d[what] )
+        if isinstance( d['blank'], list ):
+            d['blank'] = [ place(b) for b in d['blank'] ]
+        else:
+            d['blank'] = place( d['blank'] )
+        datasets.append( d )
+
+    names = [ d['name'] for d in datasets ]
+    if len(set(names)) < len(names):
+        raise ValueError("%s: dataset names must be unique" % filename)
+    outdir = place( manifest.get('output', 'results') )
+    return outdir, manifest.get('processes', None), datasets
+
+
+def make_jobs( outdir, datasets ):
+    """Splits the datasets into jobs, one per tile. Each tile gets at least
+    one stripe of squares, or one spot."""
+    jobs = []
+    for d in datasets:
+        tiles = 1 if 'auto' in d else d['tiles']
+        if 'grid' in d:
+            tiles = min( tiles, (d['grid']['bounds'][2]-d['grid']['bounds'][0])//d['grid']['res'] )
+        elif 'spots' in d:
+            tiles = max( 1, min( tiles, len(d['spots']) ) )
+        for t in range(tiles):
+            job = dict( d )
+            job['tile'] = t
+            job['tiles'] = tiles
+            job['workdir'] = os.path.join( outdir, d['name'], 'tile_%02d' % t )
+            if 'grid' in d:
+                # stripes along the first coordinate, on the grid of squares
+                b, res = d['grid']['bounds'], d['grid']['res']
+                Nsquares = (b[2]-b[0])//res
+                job['grid'] = { 'res': res, 'bounds': [ b[0]+res*(t*Nsquares//tiles), b[1], \
+                                                            b[0]+res*((t+1)*Nsquares//tiles), b[3] ] }
+            elif 'spots' in d:
+                N = len(d['spots'])
+                job['spots'] = d['spots'][ t*N//tiles:(t+1)*N//tiles ]
+            jobs.append( job )
+    return jobs
+
+
+def job_stages( job ):
+    return [ s for s in STAGES if s in ['validity','fit','moddepths'] or s in job['stages'] ]
+
+
+def checkpoint_filename( job, stage ):
+    return os.path.join( job['workdir'], stage+'.npz' )
+
+
+def save_checkpoint( job, stage, **arrays ):
+    """Writes the arrays under a temporary name first, so that a checkpoint
+    which is there is always complete."""
+    filename = checkpoint_filename( job, stage )
+    tmpname  = filename[:-4]+'.tmp.npz'
+    np.savez( tmpname, **arrays )
+    os.rename( tmpname, filename )
+
+
+def load_checkpoint( job, stage ):
+    npz  = np.load( checkpoint_filename(job, stage) )
+    data = dict( [(k, npz[k]) for k in npz.files] )
+    npz.close()
+    return data
+
+
+def data_file_mtimes( job ):
+    """The modification times of the files the job reads, by file name."""
+    filenames = [ job['spe'], job['motor'], job['emission_motor'] ]
+    filenames += job['blank'] if isinstance( job['blank'], list ) else [ job['blank'] ]
+    return dict( [ (f, os.path.getmtime(f)) for f in filenames if f is not None and os.path.exists(f) ] )
+
+
+def prepare_workdir( job, restart=False ):
+    """Makes the job's directory. Checkpoints which were made for a different
+    description of the job (or all of them, with restart=True) are removed.
+    The description includes the modification times of the data files, so that
+    replacing one of them also starts the job over."""
+    description = dict( [(k,v) for k,v in job.items() if k!='workdir'] )
+    description['mtimes'] = data_file_mtimes( job )
+    jobfile = os.path.join( job['workdir'], 'job.json' )
+    if os.path.isfile( jobfile ):
+        fhandle = open( jobfile, 'rt' )
+        old = json.load( fhandle )
+        fhandle.close()
+        if restart or old != json.loads( json.dumps(description) ):
+            print "%s: the job has changed, starting over" % job['workdir']
+            shutil.rmtree( job['workdir'] )
+    if not os.path.isdir( job['workdir'] ):
+        os.makedirs( job['workdir'] )
+        fhandle = open( jobfile, 'wt' )
+        json.dump( description, fhandle, indent=1, sort_keys=True )
+        fhandle.close()
+
+
+def make_movie( job ):
+    """The movie of the job, with its background spot and its spots defined."""
+    from util_2d import Movie
+    from util_misc import grid_image_section_into_squares_and_define_spots
+    from profiler import Profiler
+
+    m = Movie( job['spe'], job['motor'], job['emission_motor'], blank_sample_filename=job['blank'], \
+                   phase_offset_excitation=job['phase_offset']*np.pi/180.0, \
+                   which_setup=job['which_setup'], excitation_optical_element=job['optical_element'], \
+                   skip_invalid_frames=job['skip_invalid_frames'], precision=job['precision'], \
+                   profiler=Profiler() if job['profile'] else None, verbosity=0 )
+    if job['correct_drift']:
+        m.correct_drift()
+    m.define_background_spot( job['background'] )
+    if 'spots' in job:
+        m.define_spots( job['spots'] )
+    elif 'grid' in job:
+        grid_image_section_into_squares_and_define_spots( m, res=job['grid']['res'], bounds=job['grid']['bounds'] )
+    else:
+        m.auto_define_spots( **job['auto'] )
+    return m
+
+
+def run_stage( m, job, stage ):
+    """Runs the stage, and returns its outputs (to be checkpointed)."""
+    if stage=='validity':
+        m.are_spots_valid( SNR=job['SNR'], quiet=True )
+        return { 'spot_is_valid': m.spot_is_valid, \
+                     'SNR': np.array( [s.SNR for s in m.spots], dtype=np.float64 ) }
+
+    elif stage=='fit':
+        m.collect_data( spots=m.validspots )
+        m.startstop()
+        m.assign_portrait_data()
+        m.fit_all_portraits_spot_parallel()
+        names = ['phase','I0','M','resi','mm']
+        out = dict( [ (name, np.array( [ [s.portraits[pi].vertical_fit_params[i] for s in m.validspots] \
+                                             for pi in range(m.portrait_indices.shape[0]) ] )) \
+                          for i,name in enumerate(names) ] )
+        out['residual'] = np.array( [s.residual for s in m.validspots], dtype=np.float64 )
+        out['portrait_indices'] = m.portrait_indices
+        return out
+
+    if stage=='moddepths':
+        m.find_modulation_depths_and_phases()
+    elif stage=='ETruler':
+        m.ETrulerFFT()
+    elif stage=='ETmodel':
+        m.ETmodel_de( **job['ETmodel'] )
+    return dict( [ (attr, np.array( [getattr(s, attr) for s in m.validspots], dtype=np.float64 )) \
+                       for attr,image in STAGE_RESULTS[stage] ] )
+
+
+def restore_stage( m, stage, data ):
+    """Puts the outputs of a stage, as returned by run_stage(), back into the movie."""
+    if stage=='validity':
+        if data['spot_is_valid'].size != len(m.spots):
+            raise ValueError("The validity checkpoint is for %d spots, but there are %d" \
+                                 % (data['spot_is_valid'].size, len(m.spots)))
+        m.spot_is_valid = data['spot_is_valid']
+        m.validspotindices = np.flatnonzero( m.spot_is_valid ).tolist()
+        m.validspots = [ m.spots[si] for si in m.validspotindices ]
+        for s,snr in zip( m.spots, data['SNR'] ):
+            s.SNR = snr
+            m.SNR_image[ s.image_index ] = snr
+
+    elif stage=='fit':
+        # the portraits are made anew from the movie, only the fits are taken over
+        m.collect_data( spots=m.validspots )
+        m.startstop()
+        if not np.array_equal( m.portrait_indices, data['portrait_indices'] ):
+            raise ValueError("The portraits of the fit checkpoint are not those of the movie")
+        m.assign_portrait_data()
+        for si,s in enumerate(m.validspots):
+            s.residual = data['residual'][si]
+            for pi,p in enumerate(s.portraits):
+                p.vertical_fit_params = [ data[name][pi,si] for name in ['phase','I0','M','resi','mm'] ]
+
+    else:
+        for attr,image in STAGE_RESULTS[stage]:
+            for s,value in zip( m.validspots, data[attr] ):
+                setattr( s, attr, value )
+                getattr( m, image+'_image' )[ s.image_index ] = value
+
+
+def run_job( job ):
+    """Runs one job, picking up after its last checkpoint. Returns the job's
+    working directory, whether it went through, and a message."""
+    try:
+        resultsfile = os.path.join( job['workdir'], 'results.npz' )
+        stages = job_stages( job )
+        done = [ s for s in stages if os.path.isfile( checkpoint_filename(job, s) ) ]
+        if len(done)==len(stages) and os.path.isfile( resultsfile ):
+            return job['workdir'], True, 'done already'
+
+        t = time.time()
+        m = make_movie( job )
+        for stage in stages:
+            if stage in done:
+                restore_stage( m, stage, load_checkpoint(job, stage) )
+            else:
+                save_checkpoint( job, stage, **run_stage( m, job, stage ) )
+
+        np.savez( resultsfile, **dict( [ (what, getattr(m, what+'_image')) for what in IMAGES ] ) )
+        if m.profiler is not None:
+            m.profiler.dump( os.path.join( job['workdir'], 'profile.json' ) )
+        message = '%d valid spots, %d of %d stages resumed, %.1fs' \
+            % (len(m.validspots), len(done), len(stages), time.time()-t)
+        return job['workdir'], True, message
+    except Exception:
+        return job['workdir'], False, traceback.format_exc()
+
+
+def merge_tiles( outdir, dataset, jobs ):
+    """Puts the images of all tiles of the dataset together, if all are done.
+    Returns True if they were."""
+    workdirs = [ j['workdir'] for j in jobs if j['name']==dataset['name'] ]
+    resultsfiles = [ os.path.join( w, 'results.npz' ) for w in workdirs ]
+    if not all( [os.path.isfile(f) for f in resultsfiles] ):
+        return False
+    merged = {}
+    for f in resultsfiles:
+        npz = np.load( f )
+        for what in npz.files:
+            image = npz[what]
+            if not what in merged:
+                merged[what] = image.copy()
+            else:
+                merged[what][~np.isnan(image)] = image[~np.isnan(image)]
+        npz.close()
+    np.savez( os.path.join( outdir, dataset['name'], 'images.npz' ), **merged )
+    return True
+
+
+def run_manifest( filename, processes=None, restart=False ):
+    outdir, manifest_processes, datasets = read_manifest( filename )
+    if processes is None:
+        processes = manifest_processes
+    jobs = make_jobs( outdir, datasets )
+    for job in jobs:
+        prepare_workdir( job, restart=restart )
+
+    print "%d datasets, %d jobs" % (len(datasets), len(jobs))
+    failed = 0
+    # one job per process, so that each movie's memory goes back when it is done
+    pool = multiprocessing.Pool( processes=processes, maxtasksperchild=1 )
+    for workdir, ok, message in pool.imap_unordered( run_job, jobs ):
+        if ok:
+            print "%s: %s" % (workdir, message)
+        else:
+            failed += 1
+            print "%s: FAILED\n%s" % (workdir, message)
+        sys.stdout.flush()
+    pool.close()
+    pool.join()
+
+    for d in datasets:
+        if merge_tiles( outdir, d, jobs ):
+            print "%s: images in %s" % (d['name'], os.path.join( outdir, d['name'], 'images.npz' ))
+    if failed > 0:
+        print "%d of %d jobs failed; run again to resume them" % (failed, len(jobs))
+    return failed
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser( description='Analyse the datasets of a manifest on a pool of processes.' )
+    parser.add_argument( 'manifest', help='JSON file describing the datasets' )
+    parser.add_argument( '--processes', type=int, default=None, \
+                             help='number of processes (default: as in the manifest, or one per CPU)' )
+    parser.add_argument( '--restart', action='store_true', help='ignore the checkpoints of earlier runs' )
+    args = parser.parse_args()
+    sys.exit( 1 if run_manifest( args.manifest, processes=args.processes, restart=args.restart ) > 0 else 0 )
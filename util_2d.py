@@ -1,10 +1,26 @@
 import numpy as np
-import matplotlib.pyplot as plt
-plt.interactive(1)
+import os
 from files import MyPrincetonSPEFile
-from motors import NewSetupMotor, ExcitationMotor, EmissionMotor, BothMotors
-from fitting import CosineFitter, CosineFitter_new, CosineFitter_mpi_master
-import scipy.optimize as so
+from motors import NewSetupMotor, ExcitationMotor, EmissionMotor, BothMotors, canonical_optical_element
+from fitting import CosineFitter, CosineFitter_new, CosineFitter_mpi_master, cosine_values, basis_cache
+from multiprocessing.pool import ThreadPool
+from profiler import profiled_stage, stage as profiler_stage
+from archive import PolimArchive, ArchiveMotors, is_archive
+
+
+def load_concurrently( jobs ):
+    """Runs the jobs, given as (function, args, kwargs), in threads of their own,
+    and returns their results in the same order once all are done. Reading files 
+    mostly waits for the disk (numpy releases the interpreter lock meanwhile), so 
+    this takes about as long as the longest job. An exception in a job is raised
+    here."""
+    pool = ThreadPool( len(jobs) )
+    try:
+        results = [ pool.apply_async( f, args, kwargs ) for f,args,kwargs in jobs ]
+        return [ r.get() for r in results ]
+    finally:
+        pool.close()
+        pool.join()
 
 
 class Movie:
@@ -12,7 +28,7 @@ class Movie:
                       datadir, filename, \
                       which_setup='new setup', \
                       phase_offset_excitation=0, \
-                      excitation_optical_element='l/2 plate',\
+                      excitation_optical_element='Polarizer',\
                   ):
 
         self.cos_fitter = CosineFitter_new
@@ -33,8 +49,6 @@ class Movie:
         self.excitation_angles_grid = np.linspace(0,np.pi,91)
         self.emission_angles_grid = np.linspace(0,np.pi,91)
         self.Nphases_for_cos_fitter = 91
-        self.precomputed_cosines = [ np.cos(2*(self.emission_angles_grid-ph)) \
-                                         for ph in np.linspace(0,np.pi/2,self.Nphases_for_cos_fitter) ]
 
 
     def __init__( self, \
@@ -46,12 +60,24 @@ class Movie:
                       datamode='validdata', \
                       which_setup='new setup', \
                       use_new_fitter=True, \
-                      excitation_optical_element='L/2 plate'):        
-
-        # if not blank_sample_filename==None:
-        #     self.blank_sample = CameraData( blank_sample_filename )
-
-        self.camera_data    = CameraData( spe_filename, compute_frame_average=True )
+                      excitation_optical_element='Polarizer', \
+                      skip_invalid_frames=False, \
+                      load_data=True, \
+                      profiler=None, \
+                      verbosity=1, \
+                      precision='float64' ):        
+
+        # optional profiler.Profiler, which records the pipeline stages
+        self.profiler = profiler
+        # 0: quiet, 1: report stages, 2: also report on every single spot
+        self.verbosity = verbosity
+
+        # floating point type in which frames, intensities, portrait data, fit
+        # results and images are kept; 'float32' halves memory use and is plenty
+        # for the fits. Sums over many values are still done in float64.
+        if not precision in ['float32','float64']:
+            raise ValueError("Movie did not understand precision='%s' (should be float32|float64)" % (precision))
+        self.dtype = np.dtype(precision)
 
         if use_new_fitter:
             self.cos_fitter = CosineFitter_new
@@ -59,7 +85,69 @@ class Movie:
             self.cos_fitter = CosineFitter
 
         self.which_setup = which_setup
-            
+
+        # The SPE file (mostly waiting for the disk), the motor file(s) (mostly
+        # parsing) and the blank(s) are read at the same time, see load_concurrently().
+        # When skipping invalid frames, only the SPE header is read for now.
+        jobs = [ ( CameraData, (spe_filename,), dict( compute_frame_average=True, \
+                                                          load_data=load_data and not skip_invalid_frames, \
+                                                          dtype=self.dtype ) ), \
+                 ( self.init_motors, (excitation_motor_filename, emission_motor_filename, \
+                                          phase_offset_excitation, excitation_optical_element), {} ) ]
+        if isinstance( blank_sample_filename, basestring ):
+            blank_sample_filename = [blank_sample_filename]
+        if blank_sample_filename is not None:
+            jobs += [ ( CameraData, (b,), dict( compute_frame_average=True, dtype=self.dtype ) ) \
+                          for b in blank_sample_filename ]
+
+        with profiler_stage( self.profiler, 'load_files' ):
+            results = load_concurrently( jobs )
+
+        self.camera_data = results[0]
+        if blank_sample_filename is not None:
+            self.blanks = [ b.average_image for b in results[2:] ]
+
+        # where do we get our time axis from?  
+        self.timeaxis = self.camera_data.timestamps
+
+        # init list of spots
+        self.spots = []
+
+        # init contrast images
+        self.initContrastImages()
+
+        # store phase offset
+#        self.phase_offset_excitation = phase_offset_excitation
+        # set data mode, used by collect_data() and startstop()
+        self.datamode = datamode
+
+        # fix the excitation and emission angle grids for now
+        self.excitation_angles_grid = np.linspace(0,np.pi,91)
+        self.emission_angles_grid = np.linspace(0,np.pi,91)
+        self.Nphases_for_cos_fitter = 91
+
+        # angles for each frame, these only depend on the motor data
+        self.compute_motor_angles()
+
+        # if requested, work out valid frames and portraits from the motor data,
+        # and only then read those frames which are actually needed
+        if skip_invalid_frames and load_data:
+            self.plan_frames()
+            with profiler_stage( self.profiler, 'load_frames', frames=self.frames_to_load.size ):
+                self.camera_data.load_frames( self.frames_to_load, compute_frame_average=True )
+
+
+    def init_motors( self, excitation_motor_filename, emission_motor_filename, \
+                         phase_offset_excitation, excitation_optical_element ):
+        which_setup = self.which_setup
+        # see set_phase_offset()
+        self.phase_offset_excitation = phase_offset_excitation
+
+        # archives (see archive.py) come with their motor data
+        if is_archive( excitation_motor_filename ):
+            self.motors = ArchiveMotors( excitation_motor_filename, phase_offset_excitation )
+            return
+
         # set up motors --- phase offset in radians!!!
         if which_setup=='old setup':
             self.excitation_motor = ExcitationMotor( excitation_motor_filename, \
@@ -85,32 +173,27 @@ class Movie:
         else:
             raise hell
 
-        # where do we get our time axis from?  
-        self.timeaxis = self.camera_data.timestamps
-
-        # init list of spots
-        self.spots = []
-
-        # init contrast images
-        self.initContrastImages()
-
-        # store phase offset
-#        self.phase_offset_excitation = phase_offset_excitation
-        # set data mode, used by collect_data() and startstop()
-        self.datamode = datamode
-
-        # fix the excitation and emission angle grids for now
-        self.excitation_angles_grid = np.linspace(0,np.pi,91)
-        self.emission_angles_grid = np.linspace(0,np.pi,91)
-        self.Nphases_for_cos_fitter = 91
-        self.precomputed_cosines = [ np.cos(2*(self.emission_angles_grid-ph)) \
-                                         for ph in np.linspace(0,np.pi/2,self.Nphases_for_cos_fitter) ]
-
 
     def read_in_EVERYTHING(self):
         # change to the data directory
         os.chdir( self.data_directory )
 
+        ###### start reading the data file and the blank, while we look at the motors ######
+        if not os.path.exists( self.data_filename ):
+            print "Couldn't find data SPE file! Bombing out..."
+            raise SystemExit
+        pool = ThreadPool( 2 )
+        camera_job = pool.apply_async( CameraData, (self.data_filename,), dict(compute_frame_average=True) )
+
+        print 'Looking for blank...',
+        blank_job = None
+        for file in os.listdir("."):
+            if file.startswith("blank-") and (file.endswith(".spe") or file.endswith(".SPE")):
+                print '\t found file %s' % file
+                blank_job = pool.apply_async( CameraData, (file,), dict(compute_frame_average=True) )
+                break
+        pool.close()
+
         ###### look for motor files ######
         print 'Looking for motor file(s)...'
         got_motors = 0
@@ -152,6 +235,7 @@ class Movie:
                     else:
                         raise hell
 
+                    self.camera_data = camera_job.get()
                     self.exangles = np.array( [self.excitation_motor.angle(t,exposuretime=self.camera_data.exposuretime) for t in self.timeaxis] )
 
                     got_motor_file_ex = 1
@@ -172,6 +256,7 @@ class Movie:
                     else:
                         raise hell
 
+                    self.camera_data = camera_job.get()
                     emangles = np.array( [self.emission_motor.angle(t,exposuretime=self.camera_data.exposuretime) for t in self.timeaxis] )
 
                     got_motor_file_em = 1
@@ -180,27 +265,17 @@ class Movie:
                         break
 
 
-        ###### look if we can find the data file, and import it ######
-        if os.path.exists( self.data_filename ):
-            self.camera_data    = CameraData( self.data_filename, compute_frame_average=True )
-            print 'Imported data file %s' % self.data_filename
-        else:
-            print "Couldn't find data SPE file! Bombing out..."
-            raise SystemExit
-        
-        ###### look for blank sample ######
-        print 'Looking for blank...',
-        for file in os.listdir("."):
-            if file.startswith("blank-") and (file.endswith(".spe") or file.endswith(".SPE")):
-                print '\t found file %s' % file
-                b = CameraData( file, compute_frame_average=True )
-                self.blank = b.average_image.copy()
-                del(b)
-                break
+        ###### wait for the data file and the blank ######
+        self.camera_data = camera_job.get()
+        print 'Imported data file %s' % self.data_filename
+        if blank_job is not None:
+            self.blank = blank_job.get().average_image.copy()
+        pool.join()
 
 
     def initContrastImages(self):
-        self.spot_coverage_image  = np.ones( (self.camera_data.datasize[1],self.camera_data.datasize[2]) )*np.nan
+        self.spot_coverage_image  = np.ones( (self.camera_data.datasize[1],self.camera_data.datasize[2]), \
+                                                 dtype=self.dtype )*np.nan
         self.mean_intensity_image = self.spot_coverage_image.copy()
         self.SNR_image            = self.spot_coverage_image.copy()
         self.M_ex_image           = self.spot_coverage_image.copy()
@@ -213,6 +288,69 @@ class Movie:
         self.ET_model_th_fu_image = self.spot_coverage_image.copy()
         self.ET_model_gr_image    = self.spot_coverage_image.copy()
         self.ET_model_et_image    = self.spot_coverage_image.copy()
+        # bootstrap standard errors, see bootstrap_modulation_depths_and_phases()
+        self.M_ex_se_image        = self.spot_coverage_image.copy()
+        self.M_em_se_image        = self.spot_coverage_image.copy()
+        self.phase_ex_se_image    = self.spot_coverage_image.copy()
+        self.phase_em_se_image    = self.spot_coverage_image.copy()
+        self.LS_se_image          = self.spot_coverage_image.copy()
+        # index of the spot covering each pixel (-1 if none); where spots
+        # overlap, the spot defined first wins
+        self.spot_label_image     = -np.ones( self.spot_coverage_image.shape, dtype=np.int )
+        # validity of each spot, by spot index (see are_spots_valid())
+        self.spot_is_valid        = np.zeros( (0,), dtype=np.bool )
+
+
+    def label_spot_pixels( self, image_index, spotindex ):
+        """Records spot #spotindex in spot_label_image, for all pixels in 
+        image_index which are not yet covered by another spot."""
+        labels = self.spot_label_image[ image_index ]
+        labels[ labels==-1 ] = spotindex
+        self.spot_label_image[ image_index ] = labels
+
+
+    def spot_at( self, x, y ):
+        """Returns the index of the spot covering pixel (x,y), or None."""
+        x = int(np.round(x))
+        y = int(np.round(y))
+        if not ( 0 <= y < self.spot_label_image.shape[0] and 0 <= x < self.spot_label_image.shape[1] ):
+            return None
+        si = self.spot_label_image[ y, x ]
+        if si==-1:
+            return None
+        return si
+
+
+    def is_spot_valid( self, spotindex ):
+        """Was spot #spotindex found valid by the last are_spots_valid()?"""
+        return spotindex < self.spot_is_valid.size and self.spot_is_valid[spotindex]
+
+
+    def clear_spots( self ):
+        """Removes all (signal) spots, and all results derived from them."""
+        self.spots = []
+        for attr in ['validspots','validspotindices','SNR_threshold','data','data_spots']:
+            if hasattr(self, attr):
+                delattr(self, attr)
+        self.initContrastImages()
+
+
+    def reset( self ):
+        """Removes all spots, including the background spot, and all results, so
+        that the movie is as good as freshly loaded (see movie_cache.MovieCache)."""
+        self.clear_spots()
+        for attr in ['bg_spot','blank_image','peaks', \
+                         'M_ex_stack','M_em_stack','phase_ex_stack','phase_em_stack','LS_stack','intensity_stack']:
+            if hasattr(self, attr):
+                delattr(self, attr)
+
+
+    @profiled_stage()
+    def correct_drift( self, reference=None, chunksize=64 ):
+        """Estimates the drift of the loaded frames (see CameraData.estimate_drift()),
+        so that the intensities of all spots defined from now on are corrected
+        for it. Spots defined before are left as they are."""
+        self.camera_data.estimate_drift( reference=reference, chunksize=chunksize )
 
 
     def define_background_spot( self, coords, intensity_type='mean' ):
@@ -228,23 +366,29 @@ class Movie:
             self.blank_image = np.zeros_like(self.blanks[0])
             # go through all blanks
             for b in self.blanks:
-                # get that background spot
-                s = Spot( b.resize((1,b.shape[0],b.shape[1])), coords, bg=0, int_type=intensity_type, \
-                              label='background area', is_bg_spot=True, parent=self )
+                # get that background spot, from the blank's average image as a single frame
+                bs = Spot( b.reshape((1,)+b.shape), coords, bg=0, int_type=intensity_type, \
+                               label='background area', is_bg_spot=True, parent=self )
                 # add bg-corrected blank to blank_image
-                self.blank_image += b-s.I
+                self.blank_image += b-bs.mean_intensity
             # divide blank image by number of blanks
             self.blank_image /= len(self.blanks)
 
         # record background spot in spot coverage image
-        self.spot_coverage_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = -1
+        self.spot_coverage_image[ s.image_index ] = -1
         
 
     def define_spot( self, coords, intensity_type='mean', label=None ):
         """Defines a new spot object and adds it to the list.
         FIXME: make sure coordinate definitions do not exceed frame size
-        TO-DO: how about being able to specify center+radius ?
+        For spots which are not boxes, see define_circular_spot(), 
+        define_polygon_spot() and define_spots_from_masks().
         """
+        # drift-corrected intensities (see correct_drift()) are worked out for
+        # the spot's surroundings only, see spot_intensities()
+        if hasattr( self.camera_data, 'shifts' ):
+            self.define_spots( [coords], intensity_type=intensity_type, labels=[label] )
+            return
 
         if hasattr( self, 'bg_spot' ):
             bgself = self.bg_spot.intensity
@@ -257,17 +401,158 @@ class Movie:
             bgblank=False
 
         # create new spot object
-        s = Spot( self.camera_data.rawdata, coords, bg=bgself, int_type='mean', \
+        s = Spot( self.camera_data.rawdata, coords, bg=bgself, int_type=intensity_type, \
                       label=label, parent=self, blankdata=bgblank )
         # append spot object to spots list
         self.spots.append( s )
 
-        self.spot_coverage_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = 1
-        self.mean_intensity_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = s.mean_intensity
+        self.spot_coverage_image[ s.image_index ] = 1
+        self.label_spot_pixels( s.image_index, len(self.spots)-1 )
+        self.mean_intensity_image[ s.image_index ] = s.mean_intensity
+
+
+    @profiled_stage( count_arg=0 )
+    def define_spots_from_pixels( self, pixel_lists, coords_list=None, intensity_type='mean', labels=None ):
+        """Defines many spots in one go. Each spot is given as an array of flat
+        pixel indices into a frame, so spots can have any shape. The intensities
+        of all spots are computed together (see spot_intensities()), which is 
+        much faster than defining the spots one by one.
+        If coords_list is given, its entries are taken to be boxes which cover
+        exactly the pixels of the corresponding spot (so that the spots behave
+        just like the ones from define_spot()), otherwise each spot keeps its 
+        pixel list and gets its bounding box as coords.
+        """
+        if len(pixel_lists)==0:
+            return
+        framesize = self.camera_data.rawdata.shape[1:]
+        if labels is None:
+            labels = [None]*len(pixel_lists)
+
+        if hasattr( self, 'bg_spot' ):
+            bgself = self.bg_spot.intensity
+        else:
+            bgself = 0
+        bgblank = hasattr( self, 'blank_image' )
+
+        I = spot_intensities( self.camera_data.rawdata, pixel_lists, intensity_type, dtype=self.dtype, \
+                                  shifts=getattr(self.camera_data, 'shifts', None) )
+
+        for si,pixels in enumerate(pixel_lists):
+            if coords_list is None:
+                coords = bounding_box( pixels, framesize )
+                spotpixels = pixels
+            else:
+                coords = coords_list[si]
+                spotpixels = None
+            s = Spot( self.camera_data.rawdata, coords, bg=bgself, int_type=intensity_type, \
+                          label=labels[si], parent=self, blankdata=bgblank, \
+                          pixels=spotpixels, intensity=I[:,si].copy() )
+            self.spots.append( s )
+        del(I)
+
+        # label the new spots' pixels; going backwards and overwriting makes
+        # the first of several overlapping spots win, as in label_spot_pixels()
+        Nbefore = len(self.spots)-len(pixel_lists)
+        newlabels = -np.ones( self.spot_label_image.size, dtype=np.int )
+        for si in range(len(pixel_lists)-1,-1,-1):
+            newlabels[ pixel_lists[si] ] = Nbefore+si
+        unlabelled = self.spot_label_image.ravel()==-1
+        self.spot_label_image.flat[ unlabelled ] = newlabels[ unlabelled ]
+
+        allpixels = np.concatenate( pixel_lists )
+        self.spot_coverage_image.flat[ allpixels ] = 1
+
+
+    def define_spots( self, coords_list, intensity_type='mean', labels=None ):
+        """Defines many box-shaped spots (see define_spot()) in one go."""
+        framesize = self.camera_data.rawdata.shape[1:]
+        pixel_lists = []
+        for coords in coords_list:
+            rows, cols = np.mgrid[ coords[1]:coords[3]+1, coords[0]:coords[2]+1 ]
+            pixel_lists.append( np.ravel_multi_index( (rows.flatten(), cols.flatten()), framesize ) )
+        self.define_spots_from_pixels( pixel_lists, coords_list=coords_list, \
+                                           intensity_type=intensity_type, labels=labels )
+
+
+    def define_spots_from_masks( self, masks, intensity_type='mean', labels=None ):
+        """Defines one spot for each boolean mask (of frame size) in masks."""
+        pixel_lists = [ np.flatnonzero(mask) for mask in masks ]
+        self.define_spots_from_pixels( pixel_lists, intensity_type=intensity_type, labels=labels )
+
+
+    def define_spots_from_labels( self, label_image, intensity_type='mean' ):
+        """Defines one spot for each label in a segmentation label image (of frame
+        size), in which zero (or anything negative) marks pixels that do not 
+        belong to any spot. The spots are labelled with their label values.
+        """
+        flatlabels = label_image.flatten()
+        pixels = np.flatnonzero( flatlabels > 0 )
+        # sort the pixels by label, then split wherever the label changes
+        pixels = pixels[ np.argsort( flatlabels[pixels], kind='mergesort' ) ]
+        values, starts = np.unique( flatlabels[pixels], return_index=True )
+        pixel_lists = np.split( pixels, starts[1:] )
+        self.define_spots_from_pixels( pixel_lists, intensity_type=intensity_type, labels=list(values) )
+
+
+    def auto_define_spots( self, SNR=10, min_pixels=1, split=None, intensity_type='mean' ):
+        """Finds the spots by itself: pixels whose mean intensity (corrected as
+        in Spot) exceeds SNR times the background standard deviation are grouped
+        into connected areas, and areas of fewer than min_pixels pixels are
+        dropped. If split is given, each area is further cut along a grid of
+        split x split squares. All spots are defined in one go (see
+        define_spots_from_labels()). Needs the background spot.
+        Returns the number of spots defined.
+        """
+        import scipy.ndimage
+
+        if not hasattr( self, 'bg_spot' ):
+            raise ValueError("auto_define_spots needs the background spot to be defined first")
+
+        if hasattr( self.camera_data, 'average_image' ):
+            average = self.camera_data.average_image.astype( np.float64 )
+        else:
+            average = np.mean( self.camera_data.rawdata, axis=0, dtype=np.float64 )
+        average -= self.bg_spot.mean_intensity
+        if hasattr( self, 'blank_image' ):
+            average -= self.blank_image
+
+        labels, Nlabels = scipy.ndimage.label( average/self.bg_spot.std > SNR )
+        if min_pixels > 1:
+            too_small = np.bincount( labels.ravel() ) < min_pixels
+            too_small[0] = False
+            labels[ too_small[labels] ] = 0
+
+        if split is not None:
+            rows, cols = np.indices( labels.shape )
+            square = (rows//split)*((labels.shape[1]+split-1)//split) + cols//split
+            # one new label for each (area, square) pair that occurs
+            pieces = np.where( labels > 0, labels.astype(np.int64)*square.size + square + 1, 0 )
+            labels = np.unique( pieces, return_inverse=True )[1].reshape( labels.shape )
+
+        Nbefore = len(self.spots)
+        self.define_spots_from_labels( labels, intensity_type=intensity_type )
+        return len(self.spots)-Nbefore
 
-    def collect_data( self ):
+
+    def define_circular_spot( self, center, radius, intensity_type='mean', label=None ):
+        """Defines a spot from all pixels within radius of center=[x,y]."""
+        mask = circle_mask( self.camera_data.rawdata.shape[1:], center, radius )
+        self.define_spots_from_masks( [mask], intensity_type=intensity_type, labels=[label] )
+
+
+    def define_polygon_spot( self, vertices, intensity_type='mean', label=None ):
+        """Defines a spot from all pixels inside the polygon vertices=[[x0,y0],...]."""
+        mask = polygon_mask( self.camera_data.rawdata.shape[1:], vertices )
+        self.define_spots_from_masks( [mask], intensity_type=intensity_type, labels=[label] )
+
+
+    @profiled_stage()
+    def collect_data( self, spots=None, append=False ):
         """This is a helper-function which collects all the necessary 
-        information for further analysis in one array.
+        information for further analysis in one array, for the given spots
+        (default: all spots). Pass spots=self.validspots after are_spots_valid()
+        to keep invalid spots out of the portraits and fits altogether.
+        With append=True, the spots are added to the data collected before.
 
         Outputs:
         If mode is 'truedata' then an array with columns:
@@ -276,22 +561,20 @@ class Movie:
         [FrameNumber, excitation angle, emission angle, Intensities (Nspot columns)]    
         """
 
-        if self.which_setup=='cool new setup':
-            exangles = self.motors.excitation_angles
-            emangles = self.motors.emission_angles
-        else:
-            exangles = np.array( [self.excitation_motor.angle(t,exposuretime=self.camera_data.exposuretime) \
-                                      for t in self.timeaxis] )
-            emangles = np.array( [self.emission_motor.angle(t,exposuretime=self.camera_data.exposuretime) \
-                                      for t in self.timeaxis] )
+        exangles = self.exangles
+        emangles = self.emangles
         validframes = emangles != -1
         self.Nvalidframes = np.sum(validframes)
 
-        Intensity = np.zeros( (self.timeaxis.size, len(self.spots)) )
-        for i,s in enumerate(self.spots):
-            Intensity[:,i] = self.spots[i].intensity
+        # spot intensities are only known for the frames which have been read
+        # from disk (all of them, unless we skipped invalid frames)
+        if spots is None:
+            spots = self.spots
+        Intensity = np.zeros( (self.timeaxis.size, len(spots)), dtype=self.dtype )
+        for i,s in enumerate(spots):
+            Intensity[self.camera_data.frameindices,i] = s.intensity
 #            self.spots[i].mean_intensity = np.mean( self.spots[i].intensity )
-            del( self.spots[i].intensity )
+            del( s.intensity )
 
         # if Intensity.ndim==1:
         #     Nspots = 1
@@ -310,7 +593,7 @@ class Movie:
             exangles = np.round(exangles, decimals=2)
             emangles = np.round(emangles, decimals=2)
 
-            output = np.zeros( (self.timeaxis.size, 4+Nspots) )
+            output = np.zeros( (self.timeaxis.size, 4+Nspots), dtype=self.dtype )
             for i in range( self.timeaxis.size ):
                 output[i,0] = i
                 output[i,1] = np.int( validframes[i] )
@@ -324,7 +607,7 @@ class Movie:
 
 #            print emangles.shape
 
-            output = np.zeros( (self.Nvalidframes, 3+Nspots) )
+            output = np.zeros( (self.Nvalidframes, 3+Nspots), dtype=self.dtype )
             trueindices = validframes.nonzero()[0]
             for i in range( self.timeaxis[validframes].size ):            
                 output[i,0] = trueindices[i]
@@ -333,10 +616,17 @@ class Movie:
                 output[i,3:3+Nspots] = Intensity[trueindices[i],:]
         else:
             raise ValueError("Don't understand datamode: %s" % (self.datamode))
-                
-        self.data = output
 
+        # assign_portrait_data() needs to know which spot is in which column
+        if append and hasattr( self, 'data' ):
+            self.data = np.hstack( (self.data, output[:, output.shape[1]-Nspots:]) )
+            self.data_spots = self.data_spots + list(spots)
+        else:
+            self.data = output
+            self.data_spots = list(spots)
 
+
+    @profiled_stage()
     def startstop( self ):
         """
         This function determines the indices at which portraits start and end.
@@ -346,16 +636,16 @@ class Movie:
         thoroughly in the future, but for now: Handle with care.
         """
 
-        if self.which_setup=='cool new setup':
-            emangles = self.motors.emission_angles
-        else:
-            emangles = np.array( [self.emission_motor.angle(t, exposuretime=self.camera_data.exposuretime) \
-                                      for t in self.timeaxis] )
+        emangles = self.emangles
 #        print emangles[:10]
 
         # frames are valid where emangles is not equal to -1
         validframes = emangles != -1
-    
+        if not np.any(validframes):
+            raise ValueError("No valid frames in the motor data (was the shutter ever open?)")
+        self.validframes  = validframes
+        self.Nvalidframes = np.sum(validframes)
+
         emangles_rounded_valid = np.round(emangles[validframes], decimals=2)
 
 #        print emangles_rounded_valid.shape
@@ -378,7 +668,10 @@ class Movie:
             edges = edges[:-1]
 
         # integer division to find out how many complete portraits we have
-        Nportraits = np.diff(edges).size / number_of_lines 
+        Nportraits = np.diff(edges).size / number_of_lines
+        if Nportraits < 1:
+            raise ValueError("Motor data does not contain a single complete portrait " \
+                                 "(%d valid frames, %d emission angles)" % (self.Nvalidframes, number_of_lines))
 
         indices = np.zeros( (Nportraits,2), dtype=np.int )
         for i in range(Nportraits):
@@ -408,17 +701,256 @@ class Movie:
 #        return emangles, emangles_rounded_valid, d
 
 
-    def assign_portrait_data( self ):  #startstop, data, mode ):
+    @profiled_stage()
+    def compute_motor_angles( self ):
+        """Works out excitation and emission angle for every frame of the movie.
+        This needs nothing but the motor data and the time axis (which comes
+        from the SPE header), so it can be done before any frames are read.
+        Invalid frames (shutter closed) have an emission angle of -1.
+        """
+        if self.which_setup=='cool new setup' or isinstance( getattr(self, 'motors', None), ArchiveMotors ):
+            exangles = self.motors.excitation_angles
+            emangles = self.motors.emission_angles
+            if not emangles.size==self.timeaxis.size:
+                raise ValueError("Motor file has %d frames, but the movie has %d frames" \
+                                     % (emangles.size, self.timeaxis.size))
+        else:
+            exangles = np.array( [self.excitation_motor.angle(t,exposuretime=self.camera_data.exposuretime) \
+                                      for t in self.timeaxis] )
+            emangles = np.array( [self.emission_motor.angle(t,exposuretime=self.camera_data.exposuretime) \
+                                      for t in self.timeaxis] )
+        self.exangles = exangles
+        self.emangles = emangles
+
+
+    def set_phase_offset( self, phase_offset_excitation, refit=None ):
+        """Changes the excitation phase offset (in radians) without reading any
+        files again: the excitation angles are worked out anew from the motor
+        data, and so are the excitation angles of data collected already.
+
+        Spots which have been analysed keep their results, brought up to date:
+        the offset adds to all excitation angles, so the line fits simply shift
+        by the change in offset, and if that is a whole number of steps of the
+        excitation angle grid, so do the portraits, from which the modulation
+        depths and phases are then recomputed (which is quick). This agrees with
+        a refit up to the resolution of the cosine fitter's trial phases.
+        Otherwise, or with refit=True, the portraits are fitted again (see
+        refit_analysed_spots()).
+        Results derived from the portraits (ETruler, ETmodel, bootstrap,
+        portrait stacks) have to be redone either way.
+        Returns True if the spots were fitted again.
+        """
+        delta = phase_offset_excitation - self.phase_offset_excitation
+        self.excitation_motor_object().set_phase_offset( phase_offset_excitation )
+        self.phase_offset_excitation = phase_offset_excitation
+        self.compute_motor_angles()
+        self.update_collected_angles()
+
+        grid = self.excitation_angles_grid
+        steps = delta/(grid[1]-grid[0])
+        can_shift = np.allclose( grid, np.linspace(0, np.pi, grid.size) ) and np.abs( steps-np.round(steps) ) < 1e-6
+        if refit or not can_shift:
+            return self.refit_analysed_spots()
+
+        steps = int( np.round(steps) )
+        analysed = [ s for s in self.spots if hasattr(s, 'portraits') ]
+        for s in analysed:
+            for p in s.portraits:
+                p.exangles = p.exangles + delta
+                for l in p.lines:
+                    l.exangles = l.exangles + delta
+                    if hasattr( l, 'phase' ):
+                        l.phase = l.phase + delta
+                if hasattr( p, 'vertical_fit_params' ):
+                    # the grid covers [0,pi] with both ends, which are the same angle
+                    p.vertical_fit_params = [ np.append( np.roll( v[:-1], steps ), np.roll( v[:-1], steps )[:1] ) \
+                                                  for v in p.vertical_fit_params ]
+        done = [ s for s in analysed if hasattr(s, 'M_ex') ]
+        if len(done) > 0:
+            self.find_modulation_depths_and_phases( spots=done )
+        return False
+
+
+    def set_optical_element( self, excitation_optical_element ):
+        """Changes the optical element in the excitation path ('L/2 Plate' or
+        'Polarizer'), without reading any files again. This scales the excitation
+        angles, so spots which have been analysed are fitted again (see
+        refit_analysed_spots()). Returns True if they were.
+        Where the motor data says which element there was (cool new setup,
+        archives), it can't be changed, and trying raises a ValueError."""
+        motor = self.excitation_motor_object()
+        if canonical_optical_element( excitation_optical_element )==motor.optical_element:
+            return False
+        motor.set_optical_element( excitation_optical_element )
+        self.compute_motor_angles()
+        self.update_collected_angles()
+        return self.refit_analysed_spots()
+
+
+    def excitation_motor_object( self ):
+        if hasattr( self, 'motors' ):
+            return self.motors
+        return self.excitation_motor
+
+
+    def update_collected_angles( self ):
+        """Puts the current excitation angles into the data of collect_data()."""
+        if not hasattr( self, 'data' ):
+            return
+        # portraits made from the old data may still look at it, so they get to keep it
+        self.data = self.data.copy()
+        frames = self.data[:,0].astype( np.int )
+        if self.datamode=='truedata':
+            self.data[:,2] = np.round( self.exangles[frames], decimals=2 )
+        else:
+            self.data[:,1] = np.round( self.exangles[frames], decimals=2 )
+
+
+    def refit_analysed_spots( self ):
+        """Makes the portraits of the collected spots anew from the collected data,
+        and repeats the stages that had been done for them: the fits, and the
+        modulation depths and phases. Returns True if there was anything to redo."""
+        analysed = [ s for s in getattr(self, 'data_spots', []) if hasattr(s, 'portraits') ]
+        if len(analysed)==0:
+            return False
+        fitted = [ s for s in analysed if hasattr(s.portraits[0], 'vertical_fit_params') ]
+        done   = [ s for s in fitted if hasattr(s, 'M_ex') ]
+        self.assign_portrait_data()
+        if len(fitted) > 0:
+            self.fit_all_portraits_spot_parallel( spots=fitted )
+        if len(done) > 0:
+            self.find_modulation_depths_and_phases( spots=done )
+        return True
+
+
+    @profiled_stage()
+    def calibrate_phase_offset( self, offsets=None, criterion='LS', target=0, regions=None, spots=None ):
+        """Finds the excitation phase offset for a reference measurement, by
+        trying all candidate offsets (in radians; default: the current offset
+        plus -90 to 89 degrees in steps of one) at once, without fitting again.
+
+        A change of offset d adds d to all excitation angles, so it turns the
+        excitation projection of each spot's average portrait by d. Its harmonic
+        coefficients, [a, b, c] on [1, cos(2ex), sin(2ex)], are worked out once
+        from the stored vertical fits, and for each candidate (b+ic) is turned by
+        exp(2id), which gives the excitation phase for that offset. The emission
+        phase does not depend on the offset.
+
+        criterion -- 'LS': the luminescence shift should be target (eg 0 for a
+                     sample whose absorbing and emitting dipoles are parallel)
+                     'phase_ex': the excitation phase should be target (eg the
+                     known orientation of the reference sample)
+        regions   -- image of integer region labels, of the frame shape; a spot
+                     belongs to the label most of its pixels have, labels < 1
+                     are not used. Default: all spots make up one region.
+        spots     -- the spots to use (default: all valid spots which have been
+                     fitted)
+
+        Each spot scores sin^2 of its deviation from the target, weighted by its
+        excitation modulation amplitude (I0*M_ex), so that spots without
+        modulation, whose phase means nothing, don't count.
+        Returns the best offset for each region (nan if a region has no spots;
+        for regions=None an array of one), the candidate offsets, and the
+        (Nregions, Noffsets) array of scores. The offset is then set with
+        set_phase_offset().
+        """
+        if not criterion in ['LS','phase_ex']:
+            raise ValueError("Unknown criterion for calibrate_phase_offset(): %s (should be 'LS' or 'phase_ex')" \
+                                 % criterion)
+        if offsets is None:
+            offsets = self.phase_offset_excitation + np.arange(-90,90)*np.pi/180.0
+        offsets = np.atleast_1d( np.asarray( offsets, dtype=np.float ) )
+        if spots is None:
+            spots = [ s for s in self.validspots if hasattr(s, 'portraits') \
+                          and hasattr(s.portraits[0], 'vertical_fit_params') ]
+        if len(spots)==0:
+            raise ValueError("No fitted spots to calibrate the phase offset with")
+
+        # harmonics of the projections of the average portraits, as in
+        # find_portrait_resolved_contrasts()
+        C = np.mean( self.portrait_coefficients( spots ), axis=0 )
+        Bem_mean = np.mean( basis_cache.get( self.emission_angles_grid, self.Nphases_for_cos_fitter ).harmonics, axis=0 )
+        proj_ex  = np.einsum( 'k,ksx->xs', Bem_mean, C )
+        Bex = basis_cache.get( self.excitation_angles_grid, self.Nphases_for_cos_fitter ).harmonics
+        a, b, c = np.linalg.lstsq( Bex, proj_ex, rcond=None )[0]
+        zem = np.mean( C[1]+1j*C[2], axis=1 )
+        phase_em = np.angle( zem )/2
+
+        # all candidates at once: (Noffsets, Nspots)
+        delta = offsets - self.phase_offset_excitation
+        phase_ex = np.angle( (b+1j*c)[None,:] * np.exp( 2j*delta )[:,None] )/2
+        if criterion=='LS':
+            deviation = phase_ex - phase_em[None,:] - target
+        else:
+            deviation = phase_ex - target
+        cost   = np.sin( deviation )**2
+        weight = np.abs( b+1j*c )
+
+        # region membership, (Nspots, Nregions)
+        if regions is None:
+            member = np.ones( (len(spots),1) )
+        else:
+            regions = np.asarray( regions, dtype=np.int )
+            Nregions = max( np.max(regions), 0 )
+            member = np.zeros( (len(spots), Nregions) )
+            for si,s in enumerate(spots):
+                labels = regions[ s.image_index ].ravel()
+                labels = labels[ labels > 0 ]
+                if labels.size > 0:
+                    member[ si, np.argmax( np.bincount(labels) )-1 ] = 1
+        member *= weight[:,None]
+
+        with np.errstate( invalid='ignore', divide='ignore' ):
+            scores = np.dot( cost, member ).T / np.sum( member, axis=0 )[:,None]
+        best = np.ones( scores.shape[0] )*np.nan
+        used = np.sum( member, axis=0 ) > 0
+        best[used] = offsets[ np.argmin( scores[used], axis=1 ) ]
+        return best, offsets, scores
+
+
+    @profiled_stage()
+    def plan_frames( self ):
+        """Determines, from the motor data alone, which frames are needed for
+        the analysis: valid frames (shutter open) which belong to one of the
+        complete portraits found by startstop(). Frames taken with the shutter
+        closed, or belonging to the trailing incomplete portrait, are not needed.
+        The result, self.frames_to_load, holds indices into all frames of the
+        movie and can be handed to CameraData.load_frames().
+        Malformed motor data raises a ValueError here, before any frames are read.
+        """
+        self.startstop()
+
+        needed = np.zeros( (self.timeaxis.size,), dtype=np.bool )
+        validindices = self.validframes.nonzero()[0]
+        for start,stop in self.portrait_indices:
+            if self.datamode=='validdata':
+                # portrait indices count valid frames only
+                needed[ validindices[start:stop+1] ] = True
+            else:
+                needed[ start:stop+1 ] = True
+        needed &= self.validframes
+
+        self.frames_to_load = needed.nonzero()[0]
+
+
+    @profiled_stage()
+    def assign_portrait_data( self, spots=None ):  #startstop, data, mode ):
         """Generates portrait list _for each spot_. 
         Each list element is a full portrait. 
         We basically split the output of collect_data(), using the indices
         provided by startstop(), and the spot index.
         The output is independent of _mode_, it only contains valid data.
+        Only the spots handed to collect_data() get portraits (default: all of them).
         """
         pind = self.portrait_indices
         Nportraits = pind.shape[0]
 
-        for si,spot in enumerate(self.spots):
+        if spots is None:
+            spots = self.data_spots
+        column = dict( [(id(s), si) for si,s in enumerate(self.data_spots)] )
+
+        for spot in spots:
+            si = column[ id(spot) ]
             # create empty list
             portraitlist = []
             # go through all portraits
@@ -465,6 +997,7 @@ class Movie:
         fhandle.close()
 
 
+    @profiled_stage()
     def fit_all_portraits( self, evaluate_portrait_matrices=True ):
         # we assume that the number of portraits and lines is the same 
         # for all spots (can't think of a reason why that shouldn't be the case).
@@ -503,7 +1036,8 @@ class Movie:
             # fit all verticals in parallel
 
             for si in range(len(self.spots)):
-                print "spot fit done (%d/%d)" % (si,pi)
+                if self.verbosity > 1:
+                    print "spot fit done (%d/%d)" % (si,pi)
                 # collect list of unique emission angles
                 emangles = [l.emangle for l in self.spots[si].portraits[pi].lines]
                 # turn into array, transpose and squeeze
@@ -539,6 +1073,7 @@ class Movie:
                 s.averagematrix = averagematrix
 
 
+    @profiled_stage()
     def fit_all_lines_spot_parallel( self ):
         # init average portrait matrices, so that we can write to them without
         # having to store a matrix for each portrait
@@ -621,18 +1156,25 @@ class Movie:
 
 
 
-    def fit_all_portraits_spot_parallel( self ):   #, evaluate_portrait_matrices=True ):
+    @profiled_stage()
+    def fit_all_portraits_spot_parallel( self, spots=None ):   #, evaluate_portrait_matrices=True ):
+        """Fits all portraits of the given spots (default: all valid spots).
+        Spots are fitted independently of each other, so this can be called
+        on chunks of self.validspots one after the other (see analysis_worker).
+        """
+        if spots is None:
+            spots = self.validspots
 
         # init average portrait matrices, so that we can write to them without
         # having to store a matrix for each portrait
-        for s in self.validspots:
+        for s in spots:
 #            s.averagematrix = np.zeros( (self.emission_angles_grid.size, self.excitation_angles_grid.size) )
             s.residual = 0
 
         # we assume that the number of portraits and lines is the same 
         # for all spots (can't think of a reason why that shouldn't be the case).
         Nportraits = self.portrait_indices.shape[0]
-        Nlines     = len( self.validspots[0].portraits[0].lines )
+        Nlines     = len( spots[0].portraits[0].lines )
 
         # for each portrait ---- outermost loop, we do portraits in series
         for pi in range(Nportraits):
@@ -645,14 +1187,17 @@ class Movie:
 
             # part I, 'horizontal fitting' of the lines of constant emission angles
 
+            # cosine-fits of the lines, by line, spot and excitation angle
+            fitintensities = np.zeros( (Nlines, len(spots), self.excitation_angles_grid.size) )
+
             # for each line ---- we do lines in series, __but all spots in parallel__:
             for li in range(Nlines):
 
                 # get excitation angle array (same for all spots!)
-                exangles    = self.validspots[0].portraits[pi].lines[li].exangles
+                exangles    = spots[0].portraits[pi].lines[li].exangles
 
                 # create list of intensity arrays (one array for each spot)
-                intensities = [spot.portraits[pi].lines[li].intensities for spot in self.validspots]
+                intensities = [spot.portraits[pi].lines[li].intensities for spot in spots]
 
                 # turn into numpy array and transpose
                 intensities = np.array( intensities ).T
@@ -672,30 +1217,28 @@ class Movie:
                 # raise hell
 
                 # write cosine parameters into line object
-                for si in range(len(self.validspots)):
-                    self.validspots[si].portraits[pi].lines[li].set_fit_params( phase[si], I0[si], M[si], resi[si] )
+                for si in range(len(spots)):
+                    spots[si].portraits[pi].lines[li].set_fit_params( phase[si], I0[si], M[si], resi[si] )
+
+                # evaluate cosine-fit at this em_angle, on a grid of ex_angles, for all spots
+                fitintensities[li] = cosine_values( self.excitation_angles_grid, phase, I0, M ).T
 
 
             # gather residuals for this protrait
-            for si in range(len(self.validspots)):
-                self.validspots[si].residual = np.sum( [ l.resi for l in self.validspots[si].portraits[pi].lines ] )
+            for si in range(len(spots)):
+                spots[si].residual = np.sum( [ l.resi for l in spots[si].portraits[pi].lines ] )
 
 
             # part II, 'vertical fitting' --- we do each spot by itself, but 
             # fit all verticals in parallel
 
             # collect list of unique emission angles (same for all spots!)                    
-            emangles = [l.emangle for l in self.validspots[0].portraits[pi].lines]
+            emangles = [l.emangle for l in spots[0].portraits[pi].lines]
             # turn into array, transpose and squeeze
             emangles = np.squeeze(np.array( emangles ).T)
 
-            # evaluate cosine-fit at these em_angles, on a grid of ex_angles:
-            fitintensities = [ np.array( [l.cosValue( self.excitation_angles_grid ) \
-                                             for l in s.portraits[pi].lines]) for s in self.validspots ]
-#            print 'l=',len(fitintensities)
-#            print 's=',fitintensities[0].shape
-            fitintensities = np.hstack( fitintensities )
-#            print fitintensities.shape
+            # one column for each excitation angle of each spot
+            fitintensities = fitintensities.reshape( (Nlines,-1) )
 
             # print "vertical, portrait %d" % (pi)
             # print fitintensities.shape
@@ -704,12 +1247,12 @@ class Movie:
                                                                            self.Nphases_for_cos_fitter ) 
                 
             # store vertical fit params
-            phase = np.hsplit(phase, len(self.validspots))
-            I0    = np.hsplit(I0, len(self.validspots))
-            M     = np.hsplit(M, len(self.validspots))
-            resi  = np.hsplit(resi, len(self.validspots))
-            mm    = np.hsplit(mm, len(self.validspots))
-            for si,s in enumerate(self.validspots):
+            phase = np.hsplit(phase.astype(self.dtype), len(spots))
+            I0    = np.hsplit(I0.astype(self.dtype), len(spots))
+            M     = np.hsplit(M.astype(self.dtype), len(spots))
+            resi  = np.hsplit(resi.astype(self.dtype), len(spots))
+            mm    = np.hsplit(mm, len(spots))
+            for si,s in enumerate(spots):
                 s.portraits[pi].vertical_fit_params = [ phase[si], I0[si], M[si], resi[si], mm[si] ]
 
 #                 if evaluate_portrait_matrices:
@@ -781,7 +1324,13 @@ class Movie:
 
 
 
-    def find_modulation_depths_and_phases( self ):
+    @profiled_stage()
+    def find_modulation_depths_and_phases( self, spots=None ):
+        """Finds modulation depths and phases in excitation and emission, and 
+        the luminescence shift, for the given spots (default: all valid spots).
+        """
+        if spots is None:
+            spots = self.validspots
 
         # test = np.outer( 2*(1+.5*np.cos(2*self.emission_angles_grid*np.pi/180.0+.4)), \
         #                      3*(1+.2*np.cos(2*self.excitation_angles_grid*np.pi/180.0+1)).reshape((\
@@ -800,7 +1349,7 @@ class Movie:
         # for all spots, one per column
         proj_ex = []
         proj_em = []
-        for s in self.validspots:
+        for s in spots:
             sam = s.recover_average_portrait_matrix()
             s.proj_ex = np.mean( sam, axis=0 )
             s.proj_em = np.mean( sam, axis=1 )
@@ -836,18 +1385,18 @@ class Movie:
         LS = ph_ex - ph_em
         LS[LS >  np.pi/2] -= np.pi
         LS[LS < -np.pi/2] += np.pi
-        for si,s in enumerate(self.validspots):
+        for si,s in enumerate(spots):
             s.phase_ex = ph_ex[si]
             s.M_ex     = M_ex[si]
             s.phase_em = ph_em[si]
             s.M_em     = M_em[si]
             s.LS       = LS[si]
             # store in coverage maps
-            self.M_ex_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = s.M_ex
-            self.M_em_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = s.M_em
-            self.phase_ex_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = s.phase_ex
-            self.phase_em_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = s.phase_em
-            self.LS_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = s.LS        
+            self.M_ex_image[ s.image_index ] = s.M_ex
+            self.M_em_image[ s.image_index ] = s.M_em
+            self.phase_ex_image[ s.image_index ] = s.phase_ex
+            self.phase_em_image[ s.image_index ] = s.phase_em
+            self.LS_image[ s.image_index ] = s.LS        
 
 
         # for spot in self.spots:
@@ -878,7 +1427,190 @@ class Movie:
         #     spot.LS = LS
 
 
-    def ETrulerFFT( self, slope=7, newdatalength=2048 ):
+    def portrait_coefficients( self, spots ):
+        """Returns the coefficients of the vertical fits of all portraits of the 
+        given spots, such that
+            I(em,ex) = a0(ex) + ac(ex)*cos(2em) + as(ex)*sin(2em),
+        as an array of shape (Nportraits, 3, Nspots, Nex), holding [a0,ac,as]."""
+        Nportraits = self.portrait_indices.shape[0]
+        C = np.zeros( (Nportraits, 3, len(spots), self.excitation_angles_grid.size) )
+        for pi in range(Nportraits):
+            phase = np.array( [ s.portraits[pi].vertical_fit_params[0] for s in spots ], dtype=np.float )
+            I0    = np.array( [ s.portraits[pi].vertical_fit_params[1] for s in spots ], dtype=np.float )
+            M     = np.array( [ s.portraits[pi].vertical_fit_params[2] for s in spots ], dtype=np.float )
+            C[pi,0] = I0
+            C[pi,1] = I0*M*np.cos(2*phase)
+            C[pi,2] = I0*M*np.sin(2*phase)
+        return C
+
+
+    @profiled_stage()
+    def find_portrait_resolved_contrasts( self, spots=None ):
+        """Like find_modulation_depths_and_phases(), but for each portrait by itself
+        instead of their average, for the given spots (default: all valid spots).
+        The results go to stacks of shape (Nportraits, y, x): M_ex_stack, M_em_stack,
+        phase_ex_stack, phase_em_stack, LS_stack and intensity_stack (the mean of 
+        the fitted portrait). Nothing is refitted except the projections, which 
+        are computed from the stored vertical fits. Use save_portrait_stacks() to 
+        write them to disk."""
+        if spots is None:
+            spots = self.validspots
+
+        Nportraits = self.portrait_indices.shape[0]
+        Nspots = len(spots)
+        Nex = self.excitation_angles_grid.size
+        Nem = self.emission_angles_grid.size
+
+        stackshape = (Nportraits,) + self.spot_coverage_image.shape
+        if not hasattr(self, 'M_ex_stack') or self.M_ex_stack.shape != stackshape:
+            for what in ['M_ex','M_em','phase_ex','phase_em','LS','intensity']:
+                setattr( self, what+'_stack', np.ones( stackshape, dtype=self.dtype )*np.nan )
+
+        Bem = basis_cache.get( self.emission_angles_grid, self.Nphases_for_cos_fitter ).harmonics
+        Bem_mean = np.mean( Bem, axis=0 )
+
+        # projections of all portraits of all spots, one per column, in the order (portrait, spot)
+        C = self.portrait_coefficients( spots )
+        proj_ex = np.einsum( 'k,pksx->xps', Bem_mean, C ).reshape( (Nex, Nportraits*Nspots) )
+        proj_em = np.einsum( 'ek,pks->eps', Bem, np.mean( C, axis=3 ) ).reshape( (Nem, Nportraits*Nspots) )
+
+        ph_ex, I_ex, M_ex, r_ex, fit_ex, rawfitpars_ex, mm = self.cos_fitter( self.excitation_angles_grid, \
+                                                                                  proj_ex, self.Nphases_for_cos_fitter )
+        ph_em, I_em, M_em, r_em, fit_em, rawfitpars_em, mm = self.cos_fitter( self.emission_angles_grid, \
+                                                                                  proj_em, self.Nphases_for_cos_fitter )
+        LS = ph_ex - ph_em
+        LS[LS >  np.pi/2] -= np.pi
+        LS[LS < -np.pi/2] += np.pi
+
+        results = { 'M_ex': M_ex, 'M_em': M_em, 'phase_ex': ph_ex, 'phase_em': ph_em, 'LS': LS, \
+                        'intensity': np.mean( proj_ex, axis=0 ) }
+        for what in results:
+            # with the portrait axis last, the image index of a spot picks its pixels
+            stack  = np.rollaxis( getattr( self, what+'_stack' ), 0, 3 )
+            values = results[what].reshape( (Nportraits, Nspots) )
+            for si,s in enumerate(spots):
+                stack[ s.image_index ] = values[:,si]
+
+
+    def save_portrait_stacks( self, filename ):
+        """Writes the stacks of find_portrait_resolved_contrasts() to a compressed 
+        .npz file, as float32, together with the frame indices of the portraits."""
+        np.savez_compressed( filename, \
+                                 portrait_indices=self.portrait_indices, \
+                                 **dict( [ (what, getattr(self, what+'_stack').astype(np.float32)) \
+                                               for what in ['M_ex','M_em','phase_ex','phase_em','LS','intensity'] ] ) )
+
+
+    @profiled_stage()
+    def bootstrap_modulation_depths_and_phases( self, Nboot=100, resample_lines=False, seed=None, \
+                                                    chunksize=50, spots=None ):
+        """Estimates standard errors of M_ex, M_em, phase_ex, phase_em and LS for the 
+        given spots (default: all valid spots), by resampling their portraits 
+        (with replacement) Nboot times, and redoing find_modulation_depths_and_phases()
+        for each resample. Results go to s.M_ex_se etc. and to the *_se_image maps.
+
+        Each portrait is reduced to the coefficients of its vertical fits,
+            I(em,ex) = a0(ex) + ac(ex)*cos(2em) + as(ex)*sin(2em),
+        so that the average portrait of a resample is a weighted sum of these, and
+        the projections of all resamples of all spots in a chunk are fitted in one
+        call of the cosine fitter.
+        If resample_lines is True, the lines (emission angles) within each portrait
+        are resampled as well, and the vertical fits are redone as (weighted) linear
+        fits of the coefficients above. With a single portrait, resampling the 
+        portraits alone would give the same data every time (and standard errors of
+        zero), so the lines are always resampled then.
+        """
+        if spots is None:
+            spots = self.validspots
+
+        rng = np.random.RandomState(seed)
+
+        Nportraits = self.portrait_indices.shape[0]
+        if Nportraits < 2 and not resample_lines:
+            if self.verbosity > 0:
+                print "bootstrap: the movie has a single portrait, resampling its lines instead."
+            resample_lines = True
+        Nex = self.excitation_angles_grid.size
+        Nem = self.emission_angles_grid.size
+
+        # harmonic basis on the emission grid
+        Bem = basis_cache.get( self.emission_angles_grid, self.Nphases_for_cos_fitter ).harmonics
+        Bem_mean = np.mean( Bem, axis=0 )
+
+        # deviations of phases from their (circular) mean, wrapped into [-pi/2,pi/2)
+        def phase_se( ph ):
+            mean = .5*np.angle( np.mean( np.exp(2j*ph), axis=0 ) )
+            dev  = np.mod( ph-mean+np.pi/2, np.pi )-np.pi/2
+            return np.sqrt( np.sum( dev**2, axis=0 )/(ph.shape[0]-1) )
+
+        for first in range(0, len(spots), chunksize):
+            chunk  = spots[first:first+chunksize]
+            Nspots = len(chunk)
+
+            # portrait weights for all resamples
+            wp = rng.multinomial( Nportraits, np.ones(Nportraits)/Nportraits, size=Nboot )/float(Nportraits)
+
+            # average coefficients for each resample, shape (Nboot, 3, Nspots*Nex)
+            if not resample_lines:
+                C = self.portrait_coefficients( chunk ).reshape((Nportraits,-1))
+                C = np.dot( wp, C ).reshape((Nboot,3,-1))
+            else:
+                C = np.zeros( (Nboot, 3, Nspots*Nex) )
+                for pi in range(Nportraits):
+                    lines    = chunk[0].portraits[pi].lines
+                    emangles = np.array( [ l.emangle for l in lines ], dtype=np.float ).flatten()
+                    Bl = basis_cache.get( emangles ).harmonics
+                    # line fits evaluated on the excitation grid, as in the vertical fitting
+                    Y  = np.hstack( [ np.array( [ l.cosValue( self.excitation_angles_grid ) \
+                                                      for l in s.portraits[pi].lines ] ) for s in chunk ] )
+                    wl = rng.multinomial( len(lines), np.ones(len(lines))/len(lines), size=Nboot )
+                    WB = wl[:,:,None]*Bl[None,:,:]
+                    normal = np.matmul( WB.transpose(0,2,1), Bl[None,:,:] )
+                    rhs    = np.matmul( WB.transpose(0,2,1), Y )
+                    C += wp[:,pi,None,None] * np.matmul( np.linalg.pinv(normal), rhs )
+
+            # projections of the average portraits of all resamples, one per column,
+            # in the order (resample, spot)
+            C = C.reshape( (Nboot, 3, Nspots, Nex) )
+            proj_ex = np.einsum( 'k,bksx->xbs', Bem_mean, C ).reshape( (Nex, Nboot*Nspots) )
+            proj_em = np.einsum( 'ek,bks->ebs', Bem, np.mean( C, axis=3 ) ).reshape( (Nem, Nboot*Nspots) )
+
+            ph_ex, I_ex, M_ex, r_ex, fit_ex, rawfitpars_ex, mm = self.cos_fitter( self.excitation_angles_grid, \
+                                                                                      proj_ex, self.Nphases_for_cos_fitter )
+            ph_em, I_em, M_em, r_em, fit_em, rawfitpars_em, mm = self.cos_fitter( self.emission_angles_grid, \
+                                                                                      proj_em, self.Nphases_for_cos_fitter )
+            ph_ex = ph_ex.reshape( (Nboot, Nspots) )
+            ph_em = ph_em.reshape( (Nboot, Nspots) )
+            M_ex  = M_ex.reshape( (Nboot, Nspots) )
+            M_em  = M_em.reshape( (Nboot, Nspots) )
+
+            M_ex_se  = np.std( M_ex, axis=0, ddof=1 )
+            M_em_se  = np.std( M_em, axis=0, ddof=1 )
+            ph_ex_se = phase_se( ph_ex )
+            ph_em_se = phase_se( ph_em )
+            LS_se    = phase_se( ph_ex-ph_em )
+
+            for si,s in enumerate(chunk):
+                s.M_ex_se     = M_ex_se[si]
+                s.M_em_se     = M_em_se[si]
+                s.phase_ex_se = ph_ex_se[si]
+                s.phase_em_se = ph_em_se[si]
+                s.LS_se       = LS_se[si]
+                self.M_ex_se_image[ s.image_index ]     = s.M_ex_se
+                self.M_em_se_image[ s.image_index ]     = s.M_em_se
+                self.phase_ex_se_image[ s.image_index ] = s.phase_ex_se
+                self.phase_em_se_image[ s.image_index ] = s.phase_em_se
+                self.LS_se_image[ s.image_index ]       = s.LS_se
+
+
+    @profiled_stage()
+    def ETrulerFFT( self, slope=7, newdatalength=2048, spots=None ):
+        """Computes the ET ruler for the given spots (default: all valid spots).
+        Note that self.peaks only holds the peaks of the spots of the last call.
+        """
+        if spots is None:
+            spots = self.validspots
+
         # we re-sample the 2D portrait matrix along a slanted line to
         # get a 1D array which contains information about both angular
         # dimensions
@@ -903,7 +1635,7 @@ class Movie:
         # the angular grids likely include redundancy at the edges, and
         # we need to exclude those to not oversample
         newdata = []
-        for s in self.validspots:
+        for s in spots:
             sam = s.recover_average_portrait_matrix()
             if self.excitation_angles_grid[-1]==np.pi:
                 sam = sam[:,:-1]
@@ -949,12 +1681,12 @@ class Movie:
         # plt.draw()
         # raise hell
 
-        self.peaks = np.array( [ np.sum(normpowerspectra[:, np.round(ii-df):np.round(ii+df)], axis=1) \
+        self.peaks = np.array( [ np.sum(normpowerspectra[:, int(np.round(ii-df)):int(np.round(ii+df))], axis=1) \
                       for ii in [i1,i2,i3,i4] ] )
 
         # now go over all spots
         cet=0
-        for si,s in enumerate(self.validspots):
+        for si,s in enumerate(spots):
 
 #            import sys
 #            sys.stdout.flush()
@@ -962,14 +1694,15 @@ class Movie:
             # if we deviate from the normalized sum by more than 5%,
             # we shouldn't use this ruler
             if np.abs(np.sum( self.peaks[:,si] )-1) > .08:
-                print 'fuck. Data peaks are weird... %f' % (np.sum(self.peaks[:,si]))
-                self.validspots[si].ET_ruler = np.nan
+                if self.verbosity > 1:
+                    print 'fuck. Data peaks are weird... %f' % (np.sum(self.peaks[:,si]))
+                spots[si].ET_ruler = np.nan
             
             # now let's rule
             crossdiff = self.peaks[1,si]-self.peaks[3,si]
             
             # 3-dipole model (all of same length, no ET) starts here
-            kappa     = .5 * np.arccos( .5*(3*self.validspots[si].M_ex-1) ) 
+            kappa     = .5 * np.arccos( .5*(3*spots[si].M_ex-1) ) 
             alpha     = np.array([ -kappa, 0, kappa ])
             
             phix =   np.linspace(0,newdatalength-1,newdatalength)*2*np.pi/180
@@ -986,14 +1719,15 @@ class Movie:
             # plt.plot( np.arange(MYpower.size), MYpower, 'b' )
             # raise hell
             
-            MYpeaks = np.array( [ np.sum( MYpower[np.round(ii-df):np.round(ii+df)] ) \
+            MYpeaks = np.array( [ np.sum( MYpower[int(np.round(ii-df)):int(np.round(ii+df))] ) \
                                       for ii in [i1,i2,i3,i4] ] )
             MYpeaks /= np.sum(MYpeaks)
             
             # test again if peaks make sense
             if np.abs(np.sum( MYpeaks )-1) > .08:
-                print 'fuck. MYpeaks is off... %f' % (np.sum( MYpeaks ))
-                self.validspots[si].ET_ruler = np.nan
+                if self.verbosity > 1:
+                    print 'fuck. MYpeaks is off... %f' % (np.sum( MYpeaks ))
+                spots[si].ET_ruler = np.nan
 
             MYcrossdiff = MYpeaks[1]-MYpeaks[3]
             # model done
@@ -1001,29 +1735,35 @@ class Movie:
             ruler = 1-(crossdiff/MYcrossdiff)
 
             if (ruler < -.1) or (ruler > 1.1):
-                print "Shit, ruler has gone bonkers (ruler=%f). Spot #%d" % (ruler,si)
-                print "Will continue anyways and set ruler to zero or one (whichever is closer)."
-                print "You can thank me later."
                 cet+=1
-                print cet
+                if self.verbosity > 1:
+                    print "Shit, ruler has gone bonkers (ruler=%f). Spot #%d" % (ruler,si)
+                    print "Will continue anyways and set ruler to zero or one (whichever is closer)."
+                    print "You can thank me later."
+                    print cet
 
             if ruler < 0:
                 ruler = 0
             if ruler > 1:
                 ruler = 1
 
-            self.validspots[si].ET_ruler = ruler
-            self.ET_ruler_image[ self.validspots[si].coords[1]:self.validspots[si].coords[3]+1, \
-                               self.validspots[si].coords[0]:self.validspots[si].coords[2]+1 ] = ruler
+            spots[si].ET_ruler = ruler
+            self.ET_ruler_image[ spots[si].image_index ] = ruler
+
+        if cet > 0 and self.verbosity > 0:
+            print "ETruler: the ruler of %d spots was out of bounds, and has been clipped to [0,1]." % cet
         #print i1,i2,i3,i4,df
 
 
+    @profiled_stage()
     def ETmodel( self, fac=1e4, pg=1e-9, epsi=1e-11 ):
 
+        import scipy.optimize as so
         from fitting import fit_portrait_single_funnel_symmetric
 
         for si,s in enumerate(self.validspots):
-            print 'ETmodel fitting spot %d' % si
+            if self.verbosity > 1:
+                print 'ETmodel fitting spot %d' % si
 
             # we 'correct' the modulation in excitation to be within 
             # limits of reason (and proper arccos functionality)
@@ -1035,8 +1775,9 @@ class Movie:
 
             LB = [0.001,   -np.pi/2, 0]
             UB = [0.999999, np.pi/2, 2*(1+mex)/(1-mex)*.999]
-            print "upper limit: ", 2*(1+s.M_ex)/(1-s.M_ex)
-            print "upper limit (fixed): ", 2*(1+mex)/(1-mex)
+            if self.verbosity > 1:
+                print "upper limit: ", 2*(1+s.M_ex)/(1-s.M_ex)
+                print "upper limit (fixed): ", 2*(1+mex)/(1-mex)
 
             a = so.fmin_l_bfgs_b( func=fit_portrait_single_funnel_symmetric, \
                                       x0=a0, \
@@ -1055,72 +1796,88 @@ class Movie:
             s.ETmodel_gr    = a[0][2]
             s.ETmodel_et    = et            
 
-            self.ET_model_md_fu_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = a[0][0]
-            self.ET_model_th_fu_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = a[0][1]
-            self.ET_model_gr_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = a[0][2]
-            self.ET_model_et_image[ s.coords[1]:s.coords[3]+1, s.coords[0]:s.coords[2]+1 ] = et
+            self.ET_model_md_fu_image[ s.image_index ] = a[0][0]
+            self.ET_model_th_fu_image[ s.image_index ] = a[0][1]
+            self.ET_model_gr_image[ s.image_index ] = a[0][2]
+            self.ET_model_et_image[ s.image_index ] = et
 
-            print 'fit done\t',a[0],
-            print ' et=',et,
-            print ' A=',A
+            if self.verbosity > 1:
+                print 'fit done\t',a[0],
+                print ' et=',et,
+                print ' A=',A
 
             # et, bla = fit_portrait_single_funnel_symmetric( a[0], EX, EM, \
             #                                                     s.averagematrix, \
             #                                                     mex, s.phase_ex, mode='display' )
 
 
-    def ETmodel_de( self, fac=1e2, pg=1e-10, epsi=1e-12 ):
+    @profiled_stage()
+    def ETmodel_de( self, Npop=40, maxiter=1000, tol=1e-8, patience=30, seed=None, \
+                        chunksize=50, spots=None ):
+        """Fits the single funnel ET model (with et as a free parameter) to the average
+        portraits of the valid spots by differential evolution, see 
+        fitting.differential_evolution(). The populations of chunksize spots are
+        evolved together, and scored in one go by fitting.single_funnel_scores().
+        Give a seed to get reproducible results."""
 
-        from fitting import fit_portrait_single_funnel_symmetric, wrapper_for_de
+        from fitting import single_funnel_scores, differential_evolution
 
-        import sys
-        sys.path.insert(1,'/home/kiwimatto/Desktop/python_libs')
-        import diffevol
-        
+        if spots is None:
+            spots = self.validspots
 
-        for si,s in enumerate(self.validspots):
-            print 'ETmodel fitting spot %d' % si
-            mex = np.clip( s.M_ex, .000001, .999999 )
-            a0 = [mex, .5, 0, 1]
-            EX, EM = np.meshgrid( self.excitation_angles_grid, self.emission_angles_grid )
-            funargs = (EX, EM, s.averagematrix, mex, s.phase_ex, 'fitting', False)
+        for first in range(0, len(spots), chunksize):
+            chunk = spots[first:first+chunksize]
 
-            LB = [0.001, -np.pi/2, 0, 0]
-            UB = [0.999,  np.pi/2, 2*(1+mex)/(1-mex)*.999, 1]
+            mex   = np.clip( np.array([s.M_ex for s in chunk]), .000001, .999999 )
+            phex  = np.array([s.phase_ex for s in chunk])
+            Ftot  = np.array([s.recover_average_portrait_matrix() for s in chunk], dtype=np.float)
 
-            ds = diffevol.scenario( scorefunction=wrapper_for_de, \
-                                        parameter_limits=np.array( zip(LB,UB) ), \
-                                        Npop=40, \
-                                        goal='min', \
-                                        extras=funargs )
+            LB = np.zeros( (len(chunk),4) )
+            UB = np.zeros( (len(chunk),4) )
+            LB[:] = [0.001, -np.pi/2, 0, 0]
+            UB[:] = [0.999,  np.pi/2, 0, 1]
+            UB[:,2] = 2*(1+mex)/(1-mex)*.999
 
-            a = ds.run_until( )
+            score = lambda params, active: single_funnel_scores( params, \
+                                                                     self.excitation_angles_grid, \
+                                                                     self.emission_angles_grid, \
+                                                                     Ftot[active], mex[active], phex[active] )
 
-            print 'fit done\t',a
-            s.ETmodel_md_fu = a[0]
-            s.ETmodel_th_fu = a[1]
-            s.ETmodel_gr    = a[2]
-            s.ETmodel_et    = a[3]
+            # each chunk gets its own seed, derived from the one given
+            chunkseed = None if seed is None else seed+first
+            a, resi, generations = differential_evolution( score, LB, UB, Npop=Npop, maxiter=maxiter, \
+                                                               tol=tol, patience=patience, seed=chunkseed )
 
+            for si,s in enumerate(chunk):
+                if self.verbosity > 1:
+                    print 'ETmodel fitting spot %d done after %d generations\t' % (first+si, generations[si]), a[si]
+                s.ETmodel_md_fu = a[si,0]
+                s.ETmodel_th_fu = a[si,1]
+                s.ETmodel_gr    = a[si,2]
+                s.ETmodel_et    = a[si,3]
 
-        #     et, bla = fit_portrait_single_funnel_symmetric( a[0], EX, EM, \
-        #                                                         s.averagematrix/np.sum(s.averagematrix), \
-        #                                                         s.M_ex, s.phase_ex, mode='display' )
-        # return bla
-
-        # fit_portrait_single_funnel_symmetric( params, ex_angles, em_angles, Ftot, \
-        #                                           mod_depth_excitation, phase_excitation, mode )
+                self.ET_model_md_fu_image[ s.image_index ] = a[si,0]
+                self.ET_model_th_fu_image[ s.image_index ] = a[si,1]
+                self.ET_model_gr_image[ s.image_index ]    = a[si,2]
+                self.ET_model_et_image[ s.image_index ]    = a[si,3]
 
+            if self.verbosity > 0:
+                print "ETmodel_de: %d of %d spots done (%d generations at most)" % \
+                    (first+len(chunk), len(spots), np.max(generations))
 
 
+    @profiled_stage()
     def chew( self, quiet=False, loud=False ):
-        print "collecting data..."
-        self.collect_data()
-        print "startstop..."
+        # time spent in each of these stages can be recorded with a profiler,
+        # see profiler.Profiler
+        # invalid spots are dropped before any portraits are made of them
+        self.are_spots_valid()
+        if self.verbosity > 0: print "collecting data..."
+        self.collect_data( spots=self.validspots )
+        if self.verbosity > 0: print "startstop..."
         self.startstop()
-        print "assigning portrait data..."
+        if self.verbosity > 0: print "assigning portrait data..."
         self.assign_portrait_data()        
-        self.are_spots_valid()
 
         # for s in self.validspots:       
         #     print s.intensity
@@ -1129,21 +1886,17 @@ class Movie:
                                      # (are these all just pointers??)
 #        self.camera_data = None      # this helps (as expected)
 
-        print "fitting all portraits"
+        if self.verbosity > 0: print "fitting all portraits"
 #        self.fit_all_portraits()
 
-        import time as stopwatch
         self.fit_all_portraits_spot_parallel()
 
-        print "finding mod depths and phases..."
+        if self.verbosity > 0: print "finding mod depths and phases..."
         self.find_modulation_depths_and_phases()
-        print "ETruler..."
+        if self.verbosity > 0: print "ETruler..."
         self.ETrulerFFT()
-        print "ETmodel..."
-
-        tstart = stopwatch.time()
+        if self.verbosity > 0: print "ETmodel..."
         self.ETmodel()
-        print "time taken: %fs" % (stopwatch.time()-tstart)
 
         if not quiet:
             print "Quick report:"
@@ -1170,11 +1923,12 @@ class Movie:
     #     plt.ylim( 0, 180 )      
 
 
+    @profiled_stage()
     def chew_a_bit( self, SNR=30, quiet=False, loud=False ):
-        self.collect_data()
+        self.are_spots_valid( SNR )
+        self.collect_data( spots=self.validspots )
         self.startstop()
         self.assign_portrait_data()        
-        self.are_spots_valid( SNR )
         self.fit_all_portraits_spot_parallel()
         self.find_modulation_depths_and_phases()
 
@@ -1185,13 +1939,64 @@ class Movie:
 #            print "M_ex=%3.2f\tM_em=%3.2f\tphase_ex=%3.2fdeg\tphase_em=%3.2fdeg\tLS=%3.2fdeg" % \
 #                ( s.M_ex,s.M_em, s.phase_ex*180/np.pi, s.phase_em*180/np.pi, s.LS*180/np.pi )
 
+    @profiled_stage()
+    def update_analysis( self, SNR=None ):
+        """Brings the analysis up to date after spots have been added: the
+        stages of chew_a_bit() are run for the spots which have not been
+        through them yet (those which still have their intensity, see
+        collect_data()), and only for them. The portrait indices are reused, and
+        the results of all other spots are kept. SNR defaults to the threshold
+        of the last validity check; after changing it, use chew_a_bit() again.
+        Returns the list of spots which have been analysed.
+        """
+        if SNR is None:
+            SNR = getattr( self, 'SNR_threshold', 10 )
+        newindices = [ si for si,s in enumerate(self.spots) if hasattr(s, 'intensity') ]
+        self.are_spots_valid( SNR, quiet=True, spotindices=newindices )
+        newspots = [ self.spots[si] for si in newindices if self.spot_is_valid[si] ]
+        if len(newspots)==0:
+            return newspots
+
+        self.collect_data( spots=newspots, append=True )
+        if not hasattr( self, 'portrait_indices' ):
+            self.startstop()
+        self.assign_portrait_data( spots=newspots )
+        self.fit_all_portraits_spot_parallel( spots=newspots )
+        self.find_modulation_depths_and_phases( spots=newspots )
+        return newspots
+
+
+    def remove_spot( self, spotindex ):
+        """Removes spot #spotindex and its results; the pixels it covered are
+        blanked in all contrast images (also where another spot overlaps it)."""
+        s = self.spots.pop( spotindex )
+        if s in getattr( self, 'data_spots', [] ):
+            column = self.data_spots.index( s ) + self.data.shape[1] - len(self.data_spots)
+            self.data = np.delete( self.data, column, axis=1 )
+            self.data_spots.remove( s )
+        for attr, image in vars(self).items():
+            if attr.endswith('_image') and attr not in ['spot_label_image', 'blank_image'] \
+                    and isinstance( image, np.ndarray ) and image.shape==self.spot_label_image.shape:
+                image[ s.image_index ] = np.nan
+        # the spots after this one move up by one
+        labels = self.spot_label_image
+        labels[ labels==spotindex ] = -1
+        labels[ labels>spotindex ] -= 1
+        if spotindex < self.spot_is_valid.size:
+            self.spot_is_valid = np.delete( self.spot_is_valid, spotindex )
+        if hasattr( self, 'validspots' ):
+            self.validspotindices = np.flatnonzero( self.spot_is_valid ).tolist()
+            self.validspots = [ self.spots[si] for si in self.validspotindices ]
+
+
+    @profiled_stage()
     def chew_AM( self, quiet=False, loud=False, SNR=10 ):
-        self.collect_data()
-        self.startstop()
-        self.assign_portrait_data()        
         self.are_spots_valid( SNR=SNR )
         if len(self.validspots)<1:
             raise ValueError("No valid spots found! Reduce SNR demands or re-measure...")
+        self.collect_data( spots=self.validspots )
+        self.startstop()
+        self.assign_portrait_data()        
 
         self.fit_all_portraits_spot_parallel()
         self.find_modulation_depths_and_phases()
@@ -1202,7 +2007,13 @@ class Movie:
                 ( s.M_ex,s.M_em, s.phase_ex*180/np.pi, s.phase_em*180/np.pi, s.LS*180/np.pi )
 
 
-    def are_spots_valid(self, SNR=10, quiet=False):
+    @profiled_stage()
+    def are_spots_valid(self, SNR=10, quiet=False, spotindices=None):
+        """Picks the spots whose SNR (mean intensity over background standard
+        deviation) exceeds SNR. This only needs the spots' mean intensities, so
+        it can (and should) be done before collect_data(), see chew_a_bit().
+        If spotindices is given, only these spots are checked, and the others
+        keep their validity (see update_analysis())."""
         # do we actually have the background std
         bgstd = 0
         if hasattr( self, 'bg_spot' ):
@@ -1210,61 +2021,347 @@ class Movie:
         else:
             print "Dude --- no background spot defined, therefore no standard deviation. Will treat all spots as valid (i.e. as having sufficient intensity)."
 
-        # then we create a new list containing valid spots only
-        validspots = []   
-        validspotindices = []
-        for si,s in enumerate(self.spots):
-            s.SNR = s.mean_intensity/bgstd
-            if s.SNR > SNR:
-                validspots.append(s)
-                validspotindices.append(si)
+        spot_is_valid = np.zeros( (len(self.spots),), dtype=np.bool )
+        if spotindices is None:
+            spotindices = range( len(self.spots) )
+        else:
+            Nknown = min( self.spot_is_valid.size, len(self.spots) )
+            spot_is_valid[:Nknown] = self.spot_is_valid[:Nknown]
+        spots = [ self.spots[si] for si in spotindices ]
+
+        mean_intensities = np.array( [s.mean_intensity for s in spots], dtype=np.float64 )
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            SNRs = mean_intensities/bgstd
+        spot_is_valid[ list(spotindices) ] = SNRs > SNR
+        for s,snr in zip( spots, SNRs ):
+            s.SNR = snr
             # store SNR in SNR_image
-            s.store_property_in_image( self.SNR_image, 'SNR' )    # let's see if this works...
-
+            self.SNR_image[ s.image_index ] = snr
 
         # and store in movie object
-        self.validspots = validspots
-        self.validspotindices = validspotindices        
+        self.validspotindices = np.flatnonzero( spot_is_valid ).tolist()
+        self.validspots = [ self.spots[si] for si in self.validspotindices ]
+        self.SNR_threshold = SNR
+        self.spot_is_valid = spot_is_valid
 
         if not quiet: print "Got %d valid spots" % len(self.validspots)
 
                 
 
 class CameraData:
-    def __init__( self, spe_filename, compute_frame_average=False, in_counts_per_sec=True ):
+    def __init__( self, spe_filename, compute_frame_average=False, in_counts_per_sec=True, \
+                      load_data=True, dtype=np.float64 ):
         # load SPE  ---- this will work for SPE format version 2.5 (probably not for 3...)
 
         self.filename           = spe_filename
+        self.in_counts_per_sec  = in_counts_per_sec
+        # frames are converted to this floating point type when they are read
+        self.dtype              = np.dtype(dtype)
 
+        # first only the header (size and exposure time), the frames come later
         if self.filename.split('.')[-1]=='npy':   # we got test data, presumably
             print "======== TEST DATA IT SEEMS =========="
-            self.rawdata      = np.load(self.filename)
-            self.datasize     = self.rawdata.shape
+            self.datasize     = np.load(self.filename, mmap_mode='r').shape
             self.exposuretime = .1    # in seconds
 
-        else:                                     # we got real data 
+        elif is_archive( self.filename ):         # converted data, see archive.py
+            self.archive      = PolimArchive( self.filename )
+            self.datasize     = self.archive.shape
+            self.exposuretime = self.archive.exposure
+
+        else:                                     # we got real data
             self.rawdata_fileobject = MyPrincetonSPEFile( self.filename )
-            self.rawdata            = self.rawdata_fileobject.return_Array()#.astype(np.float64)
             self.datasize           = self.rawdata_fileobject.getSize()
             self.exposuretime       = self.rawdata_fileobject.Exposure   # in seconds
-            # scale signal to counts/second:
-            if in_counts_per_sec:
-                self.rawdata           /= self.rawdata_fileobject.Exposure
             self.rawdata_fileobject.close_file()
             del(self.rawdata_fileobject)
-        if compute_frame_average:
-            self.average_image      = np.mean( self.rawdata, axis=0 )
+        self.Nframes = self.datasize[0]
 
         ###  extract or generate time stamps ###
         #  here we do not have timestamps for each frame, so we
         #  generate time axis from SPE exposure data and number of frames
-        self.timestamps = np.linspace( 0, self.exposuretime*self.rawdata.shape[0], \
-                                           self.rawdata.shape[0], endpoint=False )
+        self.timestamps = np.linspace( 0, self.exposuretime*self.Nframes, \
+                                           self.Nframes, endpoint=False )
+
+        if load_data:
+            self.load_frames( compute_frame_average=compute_frame_average )
+
+
+    def load_frames( self, frameindices=None, compute_frame_average=False ):
+        """Reads frames from the file into self.rawdata. If frameindices is None
+        all frames are read, otherwise only the frames listed (through a memory
+        map, so the others are never touched). self.frameindices records which
+        frames of the file the rows of self.rawdata correspond to.
+        """
+        if frameindices is None:
+            frameindices = np.arange( self.Nframes )
+        self.frameindices = np.asarray( frameindices )
+        all_frames = self.frameindices.size==self.Nframes
+
+        if self.filename.split('.')[-1]=='npy':   # test data
+            if all_frames:
+                self.rawdata = np.load(self.filename).astype( self.dtype, copy=False )
+            else:
+                self.rawdata = np.load(self.filename, mmap_mode='r')[self.frameindices].astype( self.dtype, copy=False )
+
+        elif hasattr(self, 'archive'):            # converted data
+            self.rawdata = self.archive.read_frames( self.frameindices ).astype( self.dtype )
+            if self.in_counts_per_sec:
+                self.rawdata /= self.exposuretime
+
+        else:                                     # real data
+            self.rawdata_fileobject = MyPrincetonSPEFile( self.filename )
+            if all_frames:
+                self.rawdata        = self.rawdata_fileobject.return_Array().astype( self.dtype )
+            else:
+                self.rawdata        = self.rawdata_fileobject.return_Frames( self.frameindices ).astype( self.dtype )
+            # scale signal to counts/second:
+            if self.in_counts_per_sec:
+                self.rawdata           /= self.rawdata_fileobject.Exposure
+            self.rawdata_fileobject.close_file()
+            del(self.rawdata_fileobject)
+
+        if compute_frame_average:
+            self.average_image      = np.mean( self.rawdata, axis=0, dtype=np.float64 ).astype( self.dtype )
+        # drift estimates were for the frames loaded before
+        if hasattr(self, 'shifts'):
+            del(self.shifts)
+
+
+    def drift_cache_filename( self ):
+        if hasattr(self, 'archive'):
+            return os.path.join( self.filename, 'drift.npz' )
+        return self.filename + '.drift.npz'
+
+
+    def estimate_drift( self, reference=None, chunksize=64, use_cache=True ):
+        """Works out how far the content of each loaded frame is shifted with
+        respect to the reference image (default: the average of the loaded
+        frames), see frame_shifts(), and stores the result in self.shifts
+        (one row [rows, columns] per row of self.rawdata). Frames are done in
+        chunks of chunksize.
+
+        Shifts with respect to the default reference are cached next to the
+        data file (see drift_cache_filename()), for each frame of the file,
+        and reused as long as the data file does not change.
+        """
+        source = os.path.join(self.filename, 'meta.json') if hasattr(self, 'archive') else self.filename
+        mtime  = os.path.getmtime( source )
+        cachefile = self.drift_cache_filename()
+        use_cache = use_cache and reference is None
+
+        allshifts = np.ones( (self.Nframes,2) )*np.nan
+        if use_cache and os.path.isfile( cachefile ):
+            cache = np.load( cachefile )
+            if cache['mtime']==mtime and cache['shifts'].shape==allshifts.shape:
+                allshifts = cache['shifts']
+            cache.close()
+            if not np.any( np.isnan( allshifts[self.frameindices] ) ):
+                self.shifts = allshifts[self.frameindices]
+                return self.shifts
+
+        if reference is None:
+            if hasattr(self, 'average_image'):
+                reference = self.average_image
+            else:
+                reference = np.mean( self.rawdata, axis=0, dtype=np.float64 )
+        reference = reference.astype( np.float64 )
+
+        shifts = np.zeros( (self.rawdata.shape[0],2) )
+        for c in range( 0, self.rawdata.shape[0], chunksize ):
+            shifts[c:c+chunksize] = frame_shifts( self.rawdata[c:c+chunksize], reference )
+        self.shifts = shifts
+
+        if use_cache:
+            allshifts[self.frameindices] = shifts
+            try:
+                np.savez( cachefile, shifts=allshifts, mtime=mtime )
+            except (IOError, OSError) as e:
+                print "Could not cache the drift in %s: %s" % (cachefile, str(e))
+        return self.shifts
+
+
+    def get_frame( self, frameindex ):
+        """Returns frame #frameindex of the file (counting all frames of the 
+        movie, whether they have been loaded or not). If the frame is not in
+        self.rawdata it is read through a memory map, so going through the 
+        movie frame by frame never needs the whole stack in memory.
+        """
+        if hasattr(self, 'frameindices') and self.frameindices.size==self.Nframes:
+            return self.rawdata[frameindex]
+
+        if hasattr(self, 'archive'):
+            frame = self.archive.read_frames( [frameindex] )[0].astype( self.dtype )
+            if self.in_counts_per_sec:
+                frame /= self.exposuretime
+            return frame
+
+        if not hasattr(self, 'frame_memmap'):
+            if self.filename.split('.')[-1]=='npy':   # test data
+                self.frame_memmap = np.load(self.filename, mmap_mode='r')
+            else:
+                spefile = MyPrincetonSPEFile( self.filename )
+                self.frame_memmap = spefile.getMemmap()
+                spefile.close_file()
+
+        frame = np.array( self.frame_memmap[frameindex], dtype=self.dtype )
+        if self.in_counts_per_sec and not self.filename.split('.')[-1]=='npy':
+            frame /= self.exposuretime
+        return frame
+
+
+def spot_weight_matrix( pixel_lists, Npixels ):
+    """Compiles spots into one sparse (Npixels x Nspots) weight matrix.
+    Each spot is given as an array of flat indices into a frame; column j of 
+    the matrix averages over the pixels of spot j.
+    """
+    import scipy.sparse
+
+    counts = np.array( [p.size for p in pixel_lists] )
+    if np.any( counts==0 ):
+        raise ValueError("Cannot compile a spot without any pixels")
+    rows   = np.concatenate( pixel_lists )
+    cols   = np.repeat( np.arange(len(pixel_lists)), counts )
+    values = np.repeat( 1.0/counts, counts )
+    return scipy.sparse.csc_matrix( (values, (rows, cols)), shape=(Npixels, len(pixel_lists)) )
+
+
+def spot_intensities( rawdata, pixel_lists, int_type='mean', chunksize=32, dtype=np.float64, shifts=None ):
+    """Computes the frame-dependent intensities of many spots at once.
+    The spots are given as arrays of flat pixel indices (pixel_lists), so
+    their shape is arbitrary. Returns an array of shape (Nframes, Nspots).
+
+    For int_type 'mean' this is one sparse matrix product of the flattened
+    frames with the spot weight matrix, for 'max' and 'min' the pixels of
+    all spots are gathered and reduced segment-wise. Frames are processed
+    in chunks of chunksize, so that no float copy of the whole movie is made;
+    only the frames of one chunk are converted to float64 (in which the means
+    are accumulated) at a time. The result is of type dtype.
+
+    If shifts (Nframes x 2, see frame_shifts()) are given, each chunk of frames
+    is shifted back by them before the spots are read out, which corrects for
+    drift without making a corrected copy of the movie. Only the box around
+    all spots, with a margin for the largest shift, is shifted, a few frames
+    at a time (the FFTs need several complex copies of each frame). Near the
+    edges of the frame, what the shift brings in from beyond them is made up
+    either way, and differs from shifting whole frames.
+    """
+    Nframes = rawdata.shape[0]
+    Nspots  = len(pixel_lists)
+
+    if shifts is not None:
+        # cut the movie down to the spots' bounding box plus margin, and
+        # express the pixels in that box; the shift wraps around the edges 
+        # of the box, and its ringing from them has died down to about 1e-5
+        # of the intensity some ten pixels further in
+        margin = int( np.ceil( np.max( np.abs(shifts) ) ) ) + 10
+        left, bottom, right, top = bounding_box( np.concatenate( pixel_lists ), rawdata.shape[1:] )
+        rows = slice( max(bottom-margin, 0), min(top+margin+1, rawdata.shape[1]) )
+        cols = slice( max(left-margin, 0), min(right+margin+1, rawdata.shape[2]) )
+        pixel_lists = [ np.ravel_multi_index( ( r-rows.start, c-cols.start ), (rows.stop-rows.start, cols.stop-cols.start) ) \
+                            for r,c in [ np.unravel_index( p, rawdata.shape[1:] ) for p in pixel_lists ] ]
+        rawdata = rawdata[ :, rows, cols ]
+        chunksize = max( 1, min( chunksize, 2**21//(rawdata.shape[1]*rawdata.shape[2]) ) )
+
+    Npixels = rawdata.shape[1]*rawdata.shape[2]
+    if shifts is None:
+        frames = rawdata.reshape( (Nframes, Npixels) )
+    I = np.zeros( (Nframes, Nspots), dtype=dtype )
+
+    def chunk( c ):
+        if shifts is None:
+            return frames[c:c+chunksize,:]
+        return shift_frames( rawdata[c:c+chunksize], -shifts[c:c+chunksize] ).reshape( (-1, Npixels) )
+
+    if int_type=='mean':
+        W = spot_weight_matrix( pixel_lists, Npixels ).T.tocsr()
+        for c in range( 0, Nframes, chunksize ):
+            I[c:c+chunksize,:] = W.dot( np.ascontiguousarray( chunk(c).T, dtype=np.float64 ) ).T
+    elif int_type=='max' or int_type=='min':
+        reducer = {'max': np.maximum, 'min': np.minimum}[int_type]
+        counts  = np.array( [p.size for p in pixel_lists] )
+        if np.any( counts==0 ):
+            raise ValueError("Cannot compute intensities for a spot without any pixels")
+        allpixels = np.concatenate( pixel_lists )
+        segments  = np.concatenate( ([0], np.cumsum(counts)[:-1]) )
+        for c in range( 0, Nframes, chunksize ):
+            I[c:c+chunksize,:] = reducer.reduceat( chunk(c)[:, allpixels], segments, axis=1 )
+    else:
+        raise ValueError("spot_intensities did not understand int_type='%s' (should be mean|max|min)" % (int_type))
+
+    return I
+
+
+def frame_shifts( frames, reference ):
+    """Works out by how much (rows, columns; to sub-pixel precision) the
+    content of each of the frames is shifted with respect to the reference
+    image, from the peak of their cross-correlation. The cross-correlations
+    of all frames are computed with one batched FFT, the sub-pixel position
+    of the peak from a parabola through the peak and its neighbours.
+    Returns an array of shape (Nframes, 2).
+    """
+    shape = reference.shape
+    R = np.conj( np.fft.rfft2( reference - np.mean(reference) ) )
+    frames = frames - np.mean( frames, axis=(1,2), dtype=np.float64 ).reshape((-1,1,1))
+    xcorr  = np.fft.irfft2( np.fft.rfft2( frames )*R, s=shape )
+
+    Nframes = xcorr.shape[0]
+    peak = np.argmax( xcorr.reshape((Nframes,-1)), axis=1 )
+    rows, cols = np.unravel_index( peak, shape )
+    fi = np.arange( Nframes )
+
+    shifts = np.zeros( (Nframes,2) )
+    for axis, (i, n) in enumerate( [(rows, shape[0]), (cols, shape[1])] ):
+        if axis==0:
+            c0, cm, cp = xcorr[fi,i,cols], xcorr[fi,(i-1)%n,cols], xcorr[fi,(i+1)%n,cols]
+        else:
+            c0, cm, cp = xcorr[fi,rows,i], xcorr[fi,rows,(i-1)%n], xcorr[fi,rows,(i+1)%n]
+        curvature = cm - 2*c0 + cp
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            subpixel = np.where( curvature < 0, (cm-cp)/(2*curvature), 0 )
+        # the correlation is periodic, shifts beyond half the frame are negative
+        shifts[:,axis] = (i + n//2) % n - n//2 + subpixel
+    return shifts
+
+
+def shift_frames( frames, shifts ):
+    """Shifts the content of each frame by shifts (Nframes x 2: rows, columns;
+    may be fractional) by multiplying its Fourier transform with a phase ramp.
+    What moves out on one side comes back in on the other."""
+    shape = frames.shape[1:]
+    ky = np.fft.fftfreq( shape[0] ).reshape((1,-1,1))
+    kx = np.fft.rfftfreq( shape[1] ).reshape((1,1,-1))
+    ramp = np.exp( -2j*np.pi*( ky*shifts[:,0].reshape((-1,1,1)) + kx*shifts[:,1].reshape((-1,1,1)) ) )
+    return np.fft.irfft2( np.fft.rfft2( frames )*ramp, s=shape )
+
+
+def bounding_box( pixels, framesize ):
+    """Returns the box [left, bottom, right, top] which encloses the given 
+    flat pixel indices (see Spot for the coordinate convention).
+    """
+    rows, cols = np.unravel_index( pixels, framesize )
+    return [ np.min(cols), np.min(rows), np.max(cols), np.max(rows) ]
+
+
+def circle_mask( framesize, center, radius ):
+    """Boolean mask of all pixels whose centers are within radius of center=[x,y]."""
+    rows, cols = np.ogrid[ :framesize[0], :framesize[1] ]
+    return (cols-center[0])**2 + (rows-center[1])**2 <= radius**2
+
+
+def polygon_mask( framesize, vertices ):
+    """Boolean mask of all pixels whose centers are inside the polygon given 
+    by vertices=[[x0,y0],[x1,y1],...]."""
+    from matplotlib.path import Path
+    rows, cols = np.mgrid[ :framesize[0], :framesize[1] ]
+    points = np.vstack( (cols.flatten(), rows.flatten()) ).T
+    return Path( vertices ).contains_points( points ).reshape( framesize )
+
 
 
 class Spot:
     def __init__(self, rawdata, coords, bg, int_type, label, parent, is_bg_spot=False, \
-                     blankdata=False):
+                     blankdata=False, pixels=None, intensity=None):
         """
         There's something noteworthy (speak: important) about the coordinates
         which define the box that is the 'spot'. First of all, the convention
@@ -1276,6 +2373,12 @@ class Spot:
         boundaries, so that [3,3,5,5] gives a 3x3 spot from which intensities 
         are computed. This explains the occurence of various +1s in the code 
         below...
+
+        Spots need not be boxes: if pixels (flat indices into a frame) are 
+        given, the spot consists of exactly these pixels, and coords is their
+        bounding box. If intensity is given, it is used as the frame-dependent
+        intensity (before background correction), as computed in bulk by 
+        spot_intensities(), and rawdata is not looked at for it.
         """
 
         self.coords = coords    #[left, bottom, right, top]
@@ -1283,45 +2386,44 @@ class Spot:
         self.width  = coords[2] -coords[0] +1
         self.height = coords[3] -coords[1] +1
         self.parent = parent
+        self.pixels = pixels
 
-        # work out frame-dependent intensities for that spot
-        # - mean:
-        if int_type=='mean':
-            I  = np.sum( np.sum( \
-                    rawdata[:, coords[1]:coords[3]+1, coords[0]:coords[2]+1 ], \
-                        axis=2), axis=1 ).astype( np.float )
-            I /= self.width*self.height
-            # work out blank signal if present
-            if blankdata:
-                Iblank  = np.sum( self.blank_image[ coords[1]:coords[3]+1, coords[0]:coords[2]+1 ] )
-                Iblank /= self.width*self.height
+        # index into an image (or a frame) which picks the pixels of this spot
+        if pixels is None:
+            self.image_index = ( slice(coords[1],coords[3]+1), slice(coords[0],coords[2]+1) )
+        else:
+            self.image_index = np.unravel_index( pixels, rawdata.shape[1:] )
 
-        elif int_type=='max':
-            # - maximum:
-            I = np.max( np.max( \
-                    rawdata[:, coords[1]:coords[3]+1, coords[0]:coords[2]+1 ], \
-                        axis=2), axis=1 ).astype( np.float )
-            # work out blank signal if present
-            if blankdata:
-                Iblank  = np.max( self.blank_image[ coords[1]:coords[3]+1, coords[0]:coords[2]+1 ] )
-                Iblank /= self.width*self.height
+        dtype = self.parent.dtype
 
+        if int_type=='mean':
+            reduction = np.mean
+        elif int_type=='max':
+            reduction = np.max
         elif int_type=='min':
-            # - minimum:
-            I = np.min( np.min( \
-                    self.camera_data.rawdata[:, coords[1]:coords[3]+1, coords[0]:coords[2]+1 ], \
-                        axis=2), axis=1 ).astype( np.float )
-            # work out blank signal if present
-            if blankdata:
-                Iblank  = np.min( self.blank_image[ coords[1]:coords[3]+1, coords[0]:coords[2]+1 ] )
-                Iblank /= self.width*self.height
-
+            reduction = np.min
         else:
             raise ValueError("Spot __init__ did not understand int_type='%s' (should be mean|max|min)" % (int_type))
 
+        # work out frame-dependent intensities for that spot
+        if intensity is not None:
+            I = intensity
+        elif pixels is None:
+            roi = rawdata[ (slice(None),)+self.image_index ].reshape((rawdata.shape[0],-1))
+            if int_type=='mean':
+                I = np.mean( roi, axis=1, dtype=np.float64 ).astype( dtype )
+            else:
+                I = reduction( roi, axis=1 ).astype( dtype )
+        else:
+            I = spot_intensities( rawdata, [pixels], int_type, dtype=dtype )[:,0]
+
+        # work out blank signal if present
+        if blankdata:
+            Iblank  = reduction( self.parent.blank_image[ self.image_index ] )
+
         # special: take standard deviation if this is the background spot
         if is_bg_spot:
-            self.std  = np.std( rawdata[:, coords[1]:coords[3]+1, coords[0]:coords[2]+1 ] )
+            self.std  = np.std( rawdata[ (slice(None),)+self.image_index ], dtype=np.float64 )
 
         # remove background
         I -= bg
@@ -1331,12 +2433,10 @@ class Spot:
 
         self.intensity_type = int_type
         self.intensity      = I
-        self.mean_intensity = np.mean(I)
+        self.mean_intensity = np.mean(I, dtype=np.float64)
         self.bg_correction  = bg
         if not is_bg_spot:
-            self.parent.mean_intensity_image[ \
-                self.coords[1]:self.coords[3]+1, self.coords[0]:self.coords[2]+1 \
-                    ] = self.mean_intensity
+            self.parent.mean_intensity_image[ self.image_index ] = self.mean_intensity
 
 
     def __str__(self):
@@ -1345,7 +2445,7 @@ class Spot:
                  self.coords[2]-self.coords[0]+1, self.coords[3]-self.coords[1]+1, self.label)
 
     def store_property_in_image(self, image, prop):
-        image[ self.coords[1]:self.coords[3]+1, self.coords[0]:self.coords[2]+1 ] = getattr(self,prop)
+        image[ self.image_index ] = getattr(self,prop)
 
     def export_averagematrix(self,filename):
         np.save(filename,self.averagematrix)
@@ -1362,15 +2462,11 @@ class Spot:
 
     def collect_and_assign(self):
         # grab angles
-        if self.parent.which_setup=='cool new setup':
-            exangles = self.parent.motors.excitation_angles
-            emangles = self.parent.motors.emission_angles
-        else:
-            exptime = self.parent.camera_data.exposuretime
-            exangles = np.array( [self.parent.excitation_motor.angle(t,exposuretime=exptime) \
-                                      for t in self.parent.timeaxis] )
-            emangles = np.array( [self.parent.emission_motor.angle(t,exposuretime=exptime) \
-                                      for t in self.parent.timeaxis] )
+        exangles = self.parent.exangles
+        emangles = self.parent.emangles
+        # intensities for all frames (frames which have not been read stay zero)
+        intensity = np.zeros( (self.parent.timeaxis.size,), dtype=self.parent.dtype )
+        intensity[ self.parent.camera_data.frameindices ] = self.intensity
         # truth value array for frame validity
         validframes = emangles != -1
         self.parent.Nvalidframes = np.sum(validframes)
@@ -1390,7 +2486,7 @@ class Spot:
         for i in range( np.sum(validframes) ):
             ex.append( exangles[i] )
             em.append( emangles[i] )
-            I.append( self.intensity[trueindices[i]] )
+            I.append( intensity[trueindices[i]] )
         ex = np.array(ex)
         em = np.array(em)
         I  = np.array(I)
@@ -1529,11 +2625,11 @@ class Spot:
         self.M_em     = M_em[0]
         self.LS       = LS[0]
         # store in coverage maps
-        self.parent.M_ex_image[ self.coords[1]:self.coords[3]+1, self.coords[0]:self.coords[2]+1 ] = self.M_ex
-        self.parent.M_em_image[ self.coords[1]:self.coords[3]+1, self.coords[0]:self.coords[2]+1 ] = self.M_em
-        self.parent.phase_ex_image[ self.coords[1]:self.coords[3]+1, self.coords[0]:self.coords[2]+1 ] = self.phase_ex
-        self.parent.phase_em_image[ self.coords[1]:self.coords[3]+1, self.coords[0]:self.coords[2]+1 ] = self.phase_em
-        self.parent.LS_image[ self.coords[1]:self.coords[3]+1, self.coords[0]:self.coords[2]+1 ] = self.LS
+        self.parent.M_ex_image[ self.image_index ] = self.M_ex
+        self.parent.M_em_image[ self.image_index ] = self.M_em
+        self.parent.phase_ex_image[ self.image_index ] = self.phase_ex
+        self.parent.phase_em_image[ self.image_index ] = self.phase_em
+        self.parent.LS_image[ self.image_index ] = self.LS
 
 
     # def cos_fit_and_find_mod_depths(self):
@@ -1677,6 +2773,7 @@ class Portrait:
         self.lines = lines
 
     def show_portrait_matrix( self ):
+        import matplotlib.pyplot as plt
         plt.matshow( self.matrix, origin='bottom')
         plt.plot( [0,180], [0,180], 'k-' )
         plt.xlim( 0, 180 )
@@ -1685,7 +2782,6 @@ class Portrait:
 
     def recover_portrait_matrix(self):
         # print dir(self)
-        mycos = lambda a, ph, I, M: I*( 1+M*( np.cos(2*(a-ph)) ) )
 
         # print self.vertical_fit_params
         # print self.vertical_fit_params[0].shape
@@ -1701,11 +2797,8 @@ class Portrait:
         #     pic2.append( I0[exi]*(1+M[exi]*self.parent.parent.precomputed_cosines[mm[exi]]) )
         # return np.array(pic).T
 
-        pic = np.zeros( (self.parent.parent.emission_angles_grid.size, self.parent.parent.excitation_angles_grid.size) )
-        for exi in range( self.parent.parent.excitation_angles_grid.size ):
-            pic[:,exi] = mycos( self.parent.parent.emission_angles_grid, phase[exi], I0[exi], M[exi] )
-
-        return pic
+        pic = cosine_values( self.parent.parent.emission_angles_grid, phase, I0, M )
+        return pic.astype( self.parent.parent.dtype )
 
 #                     s.averagematrix += pic
 # #                    s.portraits[pi].matrix = pic
@@ -1739,7 +2832,7 @@ class Line:
         self.resi = residuals
         
     def cosValue( self, angle ):
-        return self.I0 * ( 1+self.M0*np.cos( 2*(angle-self.phase) ) )
+        return cosine_values( angle, self.phase, self.I0, self.M0 )
 
 
 
@@ -1,10 +1,8 @@
 import os
 import time
 import numpy as np
-import matplotlib.pyplot as plt
-plt.interactive(True)
+import profiler
 from datetime import datetime, timedelta
-from mpl_toolkits.axes_grid1 import AxesGrid
 
 
 def deal_with_date_time_string( motorobj, datetimestring ):        
@@ -38,11 +36,96 @@ def grid_image_section_into_squares_and_define_spots( movie, res, bounds ):
     if topedges[-1]+res > rb[2]:
         topedges = topedges[:-1]
 
+    coords_list = []
     for xi in leftedges:
         for yi in topedges:
-            movie.define_spot( [yi,xi,yi-1+res,xi-1+res] )
+            coords_list.append( [yi,xi,yi-1+res,xi-1+res] )
+    movie.define_spots( coords_list )
 
-    return 
+    return
+
+
+def analyse_adaptive( movie, bounds, start_res=8, SNR=10, min_modulation=0.1 ):
+    """Coarse-to-fine analysis of the image section bounds (same convention as
+    in grid_image_section_into_squares_and_define_spots()). The section is first
+    cut into start_res x start_res squares, and those with sufficient SNR are
+    analysed as spots (see Movie.chew_a_bit()). Squares whose modulation depth
+    (in excitation or emission) reaches min_modulation are then cut into four,
+    and their quarters analysed in turn, and so on down to single pixels.
+    The SNR of the squares is known beforehand from the average image, so
+    squares which fail it are never made into spots. A section reaching past
+    the frame is cut off at its edge.
+
+    The contrast images hold the results at the finest resolution reached for
+    each pixel, the spots left in the movie are those of the finest level.
+    Returns an image of the square size each pixel was analysed at (nan where
+    it wasn't analysed at all).
+    """
+    if start_res < 1 or start_res & (start_res-1):
+        raise ValueError("analyse_adaptive needs start_res to be a power of two, got %d" % start_res)
+
+    # the section, cut to the frame and to a whole number of squares; x0,x1 are
+    # columns, y0,y1 rows
+    Nrows, Ncols = movie.camera_data.datasize[1], movie.camera_data.datasize[2]
+    x0, y0 = max( bounds[0], 0 ), max( bounds[1], 0 )
+    x1 = x0 + (min( bounds[2], Ncols )-x0)//start_res*start_res
+    y1 = y0 + (min( bounds[3], Nrows )-y0)//start_res*start_res
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError("analyse_adaptive: section %s is smaller than one square, or outside the frame" % str(bounds))
+
+    # mean intensity of each pixel, corrected as in Spot
+    if hasattr( movie.camera_data, 'average_image' ):
+        average = movie.camera_data.average_image[y0:y1,x0:x1].astype( np.float64 )
+    else:
+        average = np.mean( movie.camera_data.rawdata[:,y0:y1,x0:x1], axis=0, dtype=np.float64 )
+    if hasattr( movie, 'bg_spot' ):
+        average -= movie.bg_spot.mean_intensity
+    if hasattr( movie, 'blank_image' ):
+        average -= movie.blank_image[y0:y1,x0:x1]
+
+    images = ['spot_coverage','mean_intensity','SNR','M_ex','M_em','phase_ex','phase_em','LS']
+    results = dict( [(what, getattr(movie, what+'_image').copy()) for what in images] )
+    resolution_image = np.ones( results['SNR'].shape )*np.nan
+
+    res = start_res
+    # squares still in the running, on the grid of the current resolution
+    candidates = np.ones( ((y1-y0)//res, (x1-x0)//res), dtype=np.bool )
+    while True:
+        ny, nx = candidates.shape
+        blockmeans = average.reshape( (ny,res,nx,res) ).mean( axis=3 ).mean( axis=1 )
+        if hasattr( movie, 'bg_spot' ):
+            candidates &= blockmeans/movie.bg_spot.std > SNR
+        rows, cols = np.nonzero( candidates )
+        if rows.size==0:
+            break
+
+        movie.clear_spots()
+        movie.define_spots( [ [x0+c*res, y0+r*res, x0+(c+1)*res-1, y0+(r+1)*res-1] \
+                                  for r,c in zip(rows,cols) ] )
+        with profiler.stage( getattr(movie,'profiler',None), 'adaptive level %dx%d' % (res,res), \
+                                 spots=rows.size ):
+            movie.chew_a_bit( SNR=SNR )
+
+        done = ~np.isnan( movie.M_ex_image )
+        for what in images:
+            results[what][done] = getattr( movie, what+'_image' )[done]
+        resolution_image[done] = res
+
+        if res==1:
+            break
+        M_ex = movie.M_ex_image[y0:y1:res, x0:x1:res]
+        M_em = movie.M_em_image[y0:y1:res, x0:x1:res]
+        # squares that were not analysed are nan, compare only the others
+        refine = np.zeros( M_ex.shape, dtype=np.bool )
+        for M in [M_ex, M_em]:
+            analysed = ~np.isnan( M )
+            refine[analysed] |= M[analysed] >= min_modulation
+        res //= 2
+        candidates = np.repeat( np.repeat( refine, 2, axis=0 ), 2, axis=1 )
+
+    for what in images:
+        setattr( movie, what+'_image', results[what] )
+    return resolution_image
 
 
 def trim_noisy_data( movie, what='M_ex', threshold=None ):
@@ -130,6 +213,7 @@ def show_spot_data( movie, what='M_ex', which_cmap=None, show_bg_spot=True ):
     import matplotlib.pyplot as plt
     import matplotlib.cm as cmap
     from matplotlib.patches import Rectangle
+    plt.interactive(True)
 
     if which_cmap==None:
         colormap = cmap.jet
@@ -252,6 +336,9 @@ def show_spot_data( movie, what='M_ex', which_cmap=None, show_bg_spot=True ):
 
 def run_self_test():
     import util_2d
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.axes_grid1 import AxesGrid
+    plt.interactive(True)
 
     print "Creating test data set"
     create_test_data_set()
@@ -349,7 +436,103 @@ def run_self_test():
     plt.draw()
 
 
-def create_test_data_set( illumination='flat', peakphotons=1000, noise=False, SNR=100, flat_bg=0, debug=False):
+def run_precision_check( spe_filename=None, motor_filename=None, bg_coords=[0,0,3,3], \
+                             bounds=[4,4,16,16], res=1, SNR=10, which_setup='new setup', \
+                             excitation_optical_element='Polarizer', \
+                             tolerance={'M_ex':1e-3, 'M_em':1e-3, 'phase_ex':1e-3, 'phase_em':1e-3, 'LS':1e-3} ):
+    """Analyses the same data in float64 and float32 precision (see Movie's
+    precision argument), and reports the largest differences of the results,
+    over the spots which are valid in both runs. Modulation depths are compared
+    relative to their float64 value, phases and LS (in radians) absolutely.
+    Returns a dictionary of the differences, and whether they are all within
+    tolerance. Without a file name, this runs on a test data set with a flat
+    background, whose dark corner holds the background spot (the test files
+    are written with the prefix precisioncheck_).
+    """
+    import util_2d
+
+    if spe_filename is None:
+        create_test_data_set( noise=True, flat_bg=100, dark_corner=True, fileprefix='precisioncheck_' )
+        spe_filename   = 'precisioncheck_testdata.npy'
+        motor_filename = 'precisioncheck_testmotordata.txt'
+
+    images = {}
+    for precision in ['float64','float32']:
+        m = util_2d.Movie( spe_filename, motor_filename, phase_offset_excitation=0, \
+                               use_new_fitter=True, which_setup=which_setup, precision=precision, \
+                               excitation_optical_element=excitation_optical_element, verbosity=0 )
+        m.define_background_spot( bg_coords )
+        grid_image_section_into_squares_and_define_spots( m, res=res, bounds=bounds )
+        m.chew_a_bit( SNR=SNR, quiet=True )
+        images[precision] = dict( [ (what, getattr(m, what+'_image').astype(np.float64)) for what in tolerance ] )
+
+    deltas = {}
+    all_ok = True
+    for what in tolerance:
+        ref = images['float64'][what]
+        d   = ref-images['float32'][what]
+        # only spots which are valid in both runs (a spot may be valid in
+        # one run only if it is right at the SNR threshold)
+        valid = ~np.isnan(d)
+        nanmismatch = np.sum( np.isnan(ref) != np.isnan(images['float32'][what]) )
+        if what in ['phase_ex','phase_em','LS']:
+            # phases live on a circle of circumference pi
+            d = np.mod( d+np.pi/2, np.pi )-np.pi/2
+        else:
+            d = d/ref
+        deltas[what] = np.max( np.abs(d[valid]) ) if np.any(valid) else np.nan
+        ok = np.any(valid) and deltas[what] <= tolerance[what]
+        all_ok = all_ok and ok
+        print "%-10s max difference float64-float32 = %g   (tolerance %g, %s, %d valid spots, %d pixels valid in one run only)" % \
+            (what, deltas[what], tolerance[what], 'ok' if ok else 'NOT OK', np.sum(valid)/res**2, nanmismatch)
+
+    return deltas, all_ok
+
+
+def run_blank_check( fileprefix='blankcheck_', bounds=[4,4,16,16], tolerance=1e-6 ):
+    """Checks the blank correction (see Movie's blank_sample_filename): a test
+    movie (with the background spot [0,0,3,3] in its dark corner) is analysed
+    once as it is, and once with a pattern added to all its frames, which 
+    a blank file holds as well, on top of a background level of its own. The 
+    blank correction has to take the pattern off again, so that both give the 
+    same results. Writes the test files with fileprefix in front of their 
+    names. Returns the largest difference of the results, and whether it is 
+    within tolerance.
+    """
+    import util_2d
+
+    create_test_data_set( noise=True, flat_bg=100, dark_corner=True, fileprefix=fileprefix )
+    data = np.load( fileprefix+'testdata.npy' )
+    # zero in the background spot, so that the blank's own background is just its level
+    Y, X = np.indices( data.shape[1:] )
+    pattern = 50.0*(X+Y)
+    pattern[:4,:4] = 0
+    np.save( fileprefix+'testdata_plus_blank.npy', data+pattern )
+    np.save( fileprefix+'blank.npy', np.ones( (20,)+data.shape[1:] )*30.0 + pattern )
+
+    images = []
+    for spe, blank in [ ('testdata.npy', None), ('testdata_plus_blank.npy', fileprefix+'blank.npy') ]:
+        m = util_2d.Movie( fileprefix+spe, fileprefix+'testmotordata.txt', blank_sample_filename=blank, \
+                               use_new_fitter=True, excitation_optical_element='Polarizer', verbosity=0 )
+        m.define_background_spot( [0,0,3,3] )
+        grid_image_section_into_squares_and_define_spots( m, res=1, bounds=bounds )
+        m.chew_a_bit( SNR=10, quiet=True )
+        images.append( np.array( [ m.mean_intensity_image, m.M_ex_image, m.M_em_image, m.LS_image ] ) )
+
+    valid = ~np.isnan( images[0] ) & ~np.isnan( images[1] )
+    delta = np.max( np.abs( images[0]-images[1] )[valid] )
+    ok = np.array_equal( np.isnan(images[0]), np.isnan(images[1]) ) and delta <= tolerance
+    print "blank correction: max difference = %g   (tolerance %g, %s)" % (delta, tolerance, 'ok' if ok else 'NOT OK')
+    return delta, ok
+
+
+def create_test_data_set( illumination='flat', peakphotons=1000, noise=False, SNR=100, flat_bg=0, debug=False, \
+                              dark_corner=False, fileprefix='' ):
+    """Writes a test movie (testdata.npy), its motor file (testmotordata.txt)
+    and the parameters it was made from (testdataparams.npy), each name with 
+    fileprefix in front. With dark_corner, the top left 4x4 pixels are not 
+    illuminated (they still get the flat background and the noise), so that 
+    they can serve as the background spot [0,0,3,3]."""
 
     Npixel_x = 16
     Npixel_y = 16
@@ -433,9 +616,9 @@ def create_test_data_set( illumination='flat', peakphotons=1000, noise=False, SN
         # store into data array
         data[i,:,:] = (et*Fet + (1-et)*Fnoet) * laserspot
 
-        # # if flat illumination, then make room for a background spot in the top left 4x4 pixel
-        # if illumination=='flat':
-        #     data[i,:4,:4] = 0
+        # make room for a background spot in the top left 4x4 pixel
+        if dark_corner:
+            data[i,:4,:4] = 0
 
         # add flat bg
         data[i,:,:] += flat_bg
@@ -469,9 +652,9 @@ def create_test_data_set( illumination='flat', peakphotons=1000, noise=False, SN
         print emaframe.shape
 
     # write all this into files!
-    writeTestDataMotorFile(timer,exa,ema,shutter)
-    writeTestDataFile(data)
-    writeTestDataParameters( md_ex, md_fu, phase_ex, phase_fu, gr, et )
+    writeTestDataMotorFile(timer,exa,ema,shutter, fileprefix=fileprefix)
+    writeTestDataFile(data, fileprefix=fileprefix)
+    writeTestDataParameters( md_ex, md_fu, phase_ex, phase_fu, gr, et, fileprefix=fileprefix )
 
     if debug:
         import matplotlib.pyplot as plt
@@ -487,7 +670,7 @@ def create_test_data_set( illumination='flat', peakphotons=1000, noise=False, SN
     return
 
 
-def writeTestDataMotorFile(timer,exa,ema,shutter):
+def writeTestDataMotorFile(timer,exa,ema,shutter, fileprefix=''):
     towrite = ['Date       Time         Motor Em        Motor Ex        Shutter Status\n']
     starttime = time.time()
     for i in range(len(timer)):
@@ -503,22 +686,23 @@ def writeTestDataMotorFile(timer,exa,ema,shutter):
         line += '\n'
         towrite.append( line )
 
-    f = open('testmotordata.txt','w')
+    f = open(fileprefix+'testmotordata.txt','w')
     f.writelines( towrite )
     f.close()
 
-def writeTestDataFile(data):
-    np.save( 'testdata.npy', data )
+def writeTestDataFile(data, fileprefix=''):
+    np.save( fileprefix+'testdata.npy', data )
 
-def writeTestDataParameters( md_ex, md_fu, phase_ex, phase_fu, gr, et ):
+def writeTestDataParameters( md_ex, md_fu, phase_ex, phase_fu, gr, et, fileprefix='' ):
     arr = np.dstack( [md_ex, md_fu, phase_ex, phase_fu, gr, et] )
-    np.save( 'testdataparams.npy', arr )
+    np.save( fileprefix+'testdataparams.npy', arr )
 
 def compareTestParamsWithOutput( movie, paramfilename ):
     
     import matplotlib.pyplot as plt
     import matplotlib.cm as cmap
     from matplotlib.patches import Rectangle
+    plt.interactive(True)
 
     params = np.load( paramfilename )
 